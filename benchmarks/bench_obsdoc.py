@@ -0,0 +1,173 @@
+#!/usr/bin/env python2.7
+#
+# Obsdoc pipeline micro-benchmarks.
+#
+"""
+Times each stage of the obsdoc path on synthetic documents:
+
+  parse_full    obsdocxml_parser.parseString (generateDS build)
+  parse_fast    obsdoc_fastparse.parseString
+  prefilter     ObsdocPrefilter.accept on the raw datagram
+  sequence      SequenceTracker.observe on the raw datagram
+  coalesce      ScanCoalescer.accept on the raw datagram
+
+(sequence and coalesce keep state across documents, so each pass gets
+a fresh tracker; otherwise every pass after the first would only time
+the duplicate path)
+  mcast_config  MCAST_Config construction plus the properties the
+                controller reads
+  add_obsdoc    FRBController.add_obsdoc in listening mode
+
+Each stage is timed per document and reported as mean/p50/p90/p99 in
+microseconds.  Results are written to a JSON file (with the git commit
+when available) so runs can be compared across commits:
+
+  bench_obsdoc.py -o new.json --compare old.json --threshold 0.2
+
+exits with status 1 if any stage's p50 is more than threshold slower
+than in old.json.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+
+import obsdocxml_parser
+import obsdoc_fastparse
+import obsdoc_prefilter
+import obsdoc_sequence
+import obsdoc_coalesce
+import mcaf_library
+import dispatcher
+from eventloop import monotonic
+from obsdoc_generator import ObsdocGenerator
+
+
+def _percentile(samples, pct):
+    idx = int(round(pct / 100.0 * (len(samples) - 1)))
+    return samples[idx]
+
+
+def _time_stage(func, inputs, repeat, fresh=None):
+    samples = []
+    for i in xrange(repeat):
+        if fresh is not None:
+            func = fresh()
+        for item in inputs:
+            t0 = monotonic()
+            func(item)
+            samples.append(monotonic() - t0)
+    samples.sort()
+    return {'n': len(samples),
+            'mean_us': 1e6 * sum(samples) / len(samples),
+            'p50_us': 1e6 * _percentile(samples, 50),
+            'p90_us': 1e6 * _percentile(samples, 90),
+            'p99_us': 1e6 * _percentile(samples, 99)}
+
+
+def _config_fields(obsdoc):
+    config = mcaf_library.MCAST_Config(obsdoc=obsdoc)
+    return (config.projectID, config.scan, config.scan_intent, config.source,
+            config.ra_deg, config.dec_deg, config.ra_str, config.dec_str, config.startTime)
+
+
+def run(ndocs=500, repeat=5, seed=0, intent='TARGET', project=''):
+    """Run every stage and return the results dictionary."""
+    docs = ObsdocGenerator(seed=seed).take(ndocs)
+    parsed = [obsdocxml_parser.parseString(doc) for doc in docs]
+
+    # The controller logs every document; keep that off the console
+    logging.getLogger('dispatcher').setLevel(logging.WARNING)
+    controller = dispatcher.FRBController(intent=intent, project=project, dispatch=False)
+    prefilter = obsdoc_prefilter.ObsdocPrefilter(intent=intent, project=project)
+    logging.getLogger('obsdoc_sequence').setLevel(logging.WARNING)
+
+    # (name, function, inputs, factory of a fresh function per pass)
+    stages = [('parse_full', obsdocxml_parser.parseString, docs, None),
+              ('parse_fast', obsdoc_fastparse.parseString, docs, None),
+              ('prefilter', prefilter.accept, docs, None),
+              ('sequence', None, docs, lambda: obsdoc_sequence.SequenceTracker().observe),
+              ('coalesce', None, docs, lambda: obsdoc_coalesce.ScanCoalescer().accept),
+              ('mcast_config', _config_fields, parsed, None),
+              ('add_obsdoc', controller.add_obsdoc, parsed, None)]
+    results = {}
+    for name, func, inputs, fresh in stages:
+        results[name] = _time_stage(func, inputs, repeat, fresh)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Return (stage, old p50, new p50) for stages slower than threshold."""
+    regressions = []
+    for name, new in sorted(results.items()):
+        try:
+            old = baseline['stages'][name]['p50_us']
+        except KeyError:
+            continue
+        if old > 0 and (new['p50_us'] - old) / old > threshold:
+            regressions.append((name, old, new['p50_us']))
+    return regressions
+
+
+if __name__ == '__main__':
+    cmdline = OptionParser()
+    cmdline.add_option('-n', '--docs', dest="ndocs",
+        action="store", type="int", default=500,
+        help="[500] Number of synthetic documents")
+    cmdline.add_option('-r', '--repeat', dest="repeat",
+        action="store", type="int", default=5,
+        help="[5] Passes over the documents per stage")
+    cmdline.add_option('-s', '--seed', dest="seed",
+        action="store", type="int", default=0,
+        help="[0] Document generator seed")
+    cmdline.add_option('-o', '--output', dest="output",
+        action="store", default="bench_obsdoc.json",
+        help="[bench_obsdoc.json] Results file to write")
+    cmdline.add_option('-c', '--compare', dest="compare",
+        action="store", default=None,
+        help="[None] Baseline results file to compare against")
+    cmdline.add_option('-t', '--threshold', dest="threshold",
+        action="store", type="float", default=0.2,
+        help="[0.2] Allowed fractional p50 slowdown per stage")
+    (opt,args) = cmdline.parse_args()
+
+    stages = run(ndocs=opt.ndocs, repeat=opt.repeat, seed=opt.seed)
+    report = {'commit': _git_commit(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'python': platform.python_version(),
+              'ndocs': opt.ndocs, 'repeat': opt.repeat, 'seed': opt.seed,
+              'stages': stages}
+    with open(opt.output, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+    print "%-14s %8s %10s %10s %10s %10s" % ('stage', 'n', 'mean(us)', 'p50(us)', 'p90(us)', 'p99(us)')
+    for name in ('parse_full', 'parse_fast', 'prefilter', 'sequence', 'coalesce', 'mcast_config', 'add_obsdoc'):
+        r = stages[name]
+        print "%-14s %8i %10.1f %10.1f %10.1f %10.1f" % (name, r['n'], r['mean_us'], r['p50_us'], r['p90_us'], r['p99_us'])
+    print "Results written to %s" % opt.output
+
+    if opt.compare:
+        with open(opt.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(stages, baseline, opt.threshold)
+        for name, old, new in regressions:
+            print "REGRESSION %s: p50 %.1f us -> %.1f us (+%.0f%%)" % (name, old, new, 100*(new - old)/old)
+        if regressions:
+            sys.exit(1)
+        print "No stage regressed by more than %.0f%% against %s (%s)" % (100*opt.threshold, opt.compare,
+                                                                          baseline.get('commit'))
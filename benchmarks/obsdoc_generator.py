@@ -0,0 +1,180 @@
+#!/usr/bin/env python2.7
+#
+# Synthetic obsdoc generator.
+#
+"""
+Generates realistic synthetic MCAF obsdoc documents for benchmarks and
+offline tests of the dispatcher.
+
+Documents are produced as a stream of observing sessions: each session
+(scheduling block) has a project code, a run of scans with several
+subscans each, a mix of calibrator and target intents, optional
+ephemeris objects, between zero and eight sslo entries, and ends with
+a FINISH document.  Both the old datasetID and the new datasetId
+attribute spellings are used.
+
+Run as a script to write a batch of documents to a capture file that
+obsdoc_capture.py can replay:
+
+  obsdoc_generator.py [-n N] [-s SEED] FILE
+"""
+
+import os
+import sys
+import math
+import random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+
+SCAN_INTENTS = ('OBSERVE_TARGET', 'CALIBRATE_PHASE', 'CALIBRATE_AMPLI,CALIBRATE_BANDPASS',
+                'CALIBRATE_FLUX', 'CALIBRATE_POINTING', 'SYSTEM_CONFIGURATION')
+RECEIVERS = ('4', 'P', 'L', 'S', 'C', 'X', 'Ku', 'K', 'Ka', 'Q')
+IFIDS = ('AC', 'BD', 'AC1', 'AC2', 'BD1', 'BD2', 'A1C1', 'B2D2')
+PROJECT_CODES = ('15A-105', '16A-459', '16B-392', 'TSKY0001', 'TRSR0002', 'BB357')
+SOURCES = ('J0332+5434', 'J1331+3030', 'J0542+4951', 'FRB121102', 'J0555+3948', '3C286', 'SUN', 'JUPITER')
+EPHEMERIS_SOURCES = ('SUN', 'JUPITER')
+
+_template = '''<?xml version="1.0" encoding="UTF-8"?>
+<Observation xmlns="http://www.aoc.nrao.edu/schemas/evla/obs" subarrayId="%(subarray)s" seq="%(seq)i" configUrl="http://mcmonitor.evla.nrao.edu/evla-mcm/config/%(seq)i" %(dataset_attr)s="%(dataset)s" startTime="%(start)r" configId="%(dataset)s.%(subarray)s">
+  <name>%(name)s</name>
+  <ra>%(ra)r</ra>
+  <dec>%(dec)r</dec>
+  <dra>0.0</dra>
+  <ddec>0.0</ddec>
+%(ephemeris)s  <azoffs>0.0</azoffs>
+  <eloffs>0.0</eloffs>
+  <startLST>%(lst)r</startLST>
+%(intents)s  <state>0</state>
+  <scanNo>%(scan)i</scanNo>
+  <subscanNo>%(subscan)i</subscanNo>
+  <correlator>WIDAR</correlator>
+%(sslo)s</Observation>
+'''
+
+_ephemeris_template = '''  <ephemeris>
+    <referenceTime>%(ref)r</referenceTime>
+    <ra_polynomial>%(ra)s</ra_polynomial>
+    <dec_polynomial>%(dec)s</dec_polynomial>
+    <dist_polynomial>%(dist)s</dist_polynomial>
+    <origin>JPL HORIZONS</origin>
+  </ephemeris>
+'''
+
+
+def _poly(rng, order):
+    return ''.join('<coeff order="%i">%r</coeff>' % (i, rng.uniform(-1, 1)) for i in xrange(order))
+
+
+class ObsdocGenerator(object):
+    """Iterator over synthetic obsdoc strings.
+
+    target_fraction is the fraction of scans with OBSERVE_TARGET intent,
+    ephemeris_fraction the fraction of sessions on an ephemeris source,
+    and datasetId_fraction the fraction of sessions using the new
+    datasetId spelling.
+    """
+
+    def __init__(self, seed=0, scans=(5, 30), subscans=(1, 8), max_sslo=8,
+                 target_fraction=0.5, ephemeris_fraction=0.1, datasetId_fraction=0.5, subarrays=('default',)):
+        self.rng = random.Random(seed)
+        self.scans = scans
+        self.subscans = subscans
+        self.max_sslo = max_sslo
+        self.target_fraction = target_fraction
+        self.ephemeris_fraction = ephemeris_fraction
+        self.datasetId_fraction = datasetId_fraction
+        self.subarrays = subarrays
+        self.seq = dict((subarray, 0) for subarray in subarrays)
+        self.mjd = 57000.0
+        self.session = 0
+
+    def __iter__(self):
+        while True:
+            for doc in self.session_documents():
+                yield doc
+
+    def take(self, n):
+        """Return a list of the next n documents."""
+        docs = []
+        for doc in self:
+            docs.append(doc)
+            if len(docs) == n:
+                return docs
+
+    def session_documents(self):
+        rng = self.rng
+        self.session += 1
+        subarray = rng.choice(self.subarrays)
+        project = rng.choice(PROJECT_CODES)
+        dataset = '%s.sb%i.eb%i.%.5f' % (project, rng.randint(1e6, 1e7), rng.randint(1e6, 1e7), self.mjd)
+        dataset_attr = 'datasetId' if rng.random() < self.datasetId_fraction else 'datasetID'
+        ephemeris = rng.random() < self.ephemeris_fraction
+        nsslo = rng.randint(0, self.max_sslo)
+        receiver = rng.choice(RECEIVERS)
+        sslo = ''.join('  <sslo SolarCal="0" IFid="%s" Sideband="%i" Receiver="%s"><freq>%r</freq></sslo>\n' % (
+                       IFIDS[i % len(IFIDS)], rng.choice((-1, 1)), receiver, rng.uniform(1000.0, 40000.0))
+                       for i in xrange(nsslo))
+        observer = 'ObserverName="Observer %i"' % rng.randint(1, 50)
+
+        for scan in xrange(1, rng.randint(*self.scans) + 1):
+            if rng.random() < self.target_fraction:
+                scan_intent = 'OBSERVE_TARGET'
+                name = rng.choice(EPHEMERIS_SOURCES if ephemeris else SOURCES)
+            else:
+                scan_intent = rng.choice(SCAN_INTENTS[1:])
+                name = rng.choice(SOURCES)
+            ra = rng.uniform(0, 2*math.pi)
+            dec = rng.uniform(-0.7, math.pi/2)
+            for subscan in xrange(1, rng.randint(*self.subscans) + 1):
+                self.mjd += rng.uniform(5, 60) / 86400.0
+                yield self._document(subarray, dataset_attr, dataset, name, ra, dec, scan_intent,
+                                     observer, project, scan, subscan, sslo,
+                                     ephemeris and name in EPHEMERIS_SOURCES)
+
+        # End of the scheduling block
+        self.mjd += 10 / 86400.0
+        yield self._document(subarray, dataset_attr, dataset, 'FINISH', 0.0, 0.0, 'OBSERVE_TARGET',
+                             observer, project, scan + 1, 1, '', False)
+
+    def _document(self, subarray, dataset_attr, dataset, name, ra, dec, scan_intent, observer,
+                  project, scan, subscan, sslo, ephemeris):
+        rng = self.rng
+        self.seq[subarray] += 1
+        intents = '  <intent>ScanIntent="%s"</intent>\n  <intent>%s</intent>\n  <intent>ProjectID="%s"</intent>\n' % (
+                  scan_intent, observer, project)
+        if ephemeris:
+            ephemeris = _ephemeris_template % {'ref': self.mjd, 'ra': _poly(rng, 4), 'dec': _poly(rng, 4),
+                                               'dist': _poly(rng, 2)}
+        else:
+            ephemeris = ''
+        return _template % {'subarray': subarray, 'seq': self.seq[subarray], 'dataset_attr': dataset_attr,
+                            'dataset': dataset, 'start': self.mjd, 'name': name, 'ra': ra, 'dec': dec,
+                            'ephemeris': ephemeris, 'lst': rng.random(), 'intents': intents,
+                            'scan': scan, 'subscan': subscan, 'sslo': sslo}
+
+
+if __name__ == '__main__':
+    import time
+    import obsdoc_capture
+
+    cmdline = OptionParser(usage="%prog [options] CAPTUREFILE")
+    cmdline.add_option('-n', '--count', dest="count",
+        action="store", type="int", default=1000,
+        help="[1000] Number of documents to generate")
+    cmdline.add_option('-s', '--seed', dest="seed",
+        action="store", type="int", default=0,
+        help="[0] Random seed")
+    cmdline.add_option('-r', '--rate', dest="rate",
+        action="store", type="float", default=10.0,
+        help="[10] Documents per second in the capture timestamps")
+    (opt,args) = cmdline.parse_args()
+    if len(args) != 1:
+        cmdline.error("need an output capture file")
+
+    writer = obsdoc_capture.CaptureWriter(args[0], '239.192.3.2', 53001)
+    t0 = time.time()
+    for i, doc in enumerate(ObsdocGenerator(seed=opt.seed).take(opt.count)):
+        writer.write(doc, t0 + i / opt.rate)
+    writer.close()
+    print "Wrote %i documents to %s" % (len(writer), args[0])
@@ -26,6 +26,12 @@ except ImportError:
 from collections import deque
 from datetime import datetime, timedelta
 
+# Metrics are optional; they need fcn_metrics from the vla_server directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher', 'vla_server'))
+try:
+	import fcn_metrics
+except ImportError:
+	fcn_metrics = None
 
 
 __version__ = '0.0'
@@ -35,14 +41,22 @@ __all__ = ['Communicate', '__version__', '__revision__', '__date__', '__all__']
 
 
 # Maximum number of bytes to receive from FRB and MCS
-FRB_RCV_BYTES = 4*40
+FRB_RCV_BYTES = 16*1024
 MCS_RCV_BYTES = 16*1024
 
 
+# Size of a VLA/FRB notification packet
+FRB_PACKET_BYTES = 4*40
+
+
 # Kill packet indicator
 FIRST_BYTE_KILL = struct.pack('>l', 4)
 
 
+# Notification types reported by parsePacket
+NOTIFY_TYPES = ('Test', 'Iamalive', 'Kill', 'VLA_FRB_SESSION', 'VLA_FRB_TRIGGER', 'Unknown')
+
+
 def usage(exitCode=None):
         print """receiver_test.py - Test client for VLA/FRB Coordination Network
 
@@ -50,6 +64,8 @@ Usage: receiver_test.py [OPTIONS] HOSTIP PORT
 
 Options:
 -h, --help             Display this help information
+-m, --metrics-port     Serve Prometheus metrics on this localhost port
+                       (Default = no metrics)
 -d, --debug            Run in debugging mode (Default = no)
 """
 	
@@ -63,11 +79,12 @@ def parseConfig(args):
 	config = {}
 	# Command line flags - default values
 	config['debug'] = False
+	config['metrics'] = None
 	config['args'] = []
 	
 	# Read in and process the command line flags
 	try:
-		opts, arg = getopt.getopt(args, "hd", ["help", "debug"])
+		opts, arg = getopt.getopt(args, "hm:d", ["help", "metrics-port=", "debug"])
 	except getopt.GetoptError, err:
 		# Print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -77,6 +94,8 @@ def parseConfig(args):
 	for opt, value in opts:
 		if opt in ('-h', '--help'):
 			usage(exitCode=0)
+		elif opt in ('-m', '--metrics-port'):
+			config['metrics'] = int(value, 10)
 		elif opt in ('-d', '--debug'):
 			config['debug'] = True
 		else:
@@ -86,7 +105,7 @@ def parseConfig(args):
 	config['args'] = arg
 	
 	# Validate
-	if len(args) != 2:
+	if len(arg) != 2:
 		raise RuntimeError("Must provide a valid IP address and port for this host")
 		
 	# Return configuration
@@ -171,6 +190,16 @@ class Communicate(object):
 		# Setup an attribute to keep track of the last packet
 		self.lastPacket = None
 		
+		# Bytes received that do not make up a whole packet yet
+		self.buffer = ''
+		
+		# Counters
+		self.connections = 0
+		self.packetsReceived = 0
+		self.packetsByType = dict((notifyType, 0) for notifyType in NOTIFY_TYPES)
+		self.echoFailures = 0
+		self.processingErrors = 0
+		
 	def updateConfig(self, config=None):
 		"""
 		Using the configuration file, update the list of boards.
@@ -223,30 +252,53 @@ class Communicate(object):
 		
 	def receiveNotification(self):
 		"""
-		Receive and process a VLA/FRB packet over the network and add it to 
-		the packet processing queue.
+		Receive and process VLA/FRB packets over the network and add them to 
+		the packet processing queue.  The server sends several packets at a
+		time and TCP does not keep them apart, so the data are buffered and
+		only whole packets are echoed back and queued.
 		"""
 		
 		if self.client is None:
 			self.client, self.address = self.socketIn.accept()
 			self.client.settimeout(1800)
+			# Echo each packet straight back, even with several in flight
+			self.client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self.connections += 1
+			self.buffer = ''
 			
 		try:
 			data = self.client.recv(FRB_RCV_BYTES)
 		except socket.timeout:
-			data = ''
+			data = None
 			
 		if data:
-			if data[:4] != FIRST_BYTE_KILL:
-				self.client.sendall(data)
+			self.buffer += data
+			packets = []
+			while len(self.buffer) >= FRB_PACKET_BYTES:
+				packets.append(self.buffer[:FRB_PACKET_BYTES])
+				self.buffer = self.buffer[FRB_PACKET_BYTES:]
+				
+			for packet in packets:
+				self.packetsReceived += 1
+				if packet[:4] != FIRST_BYTE_KILL:
+					try:
+						self.client.sendall(packet)
+					except socket.error:
+						self.echoFailures += 1
+						raise
+						
+				self.queueIn.append((packet,self.address[0]))
+				
+			if packets:
+				fh = open('log', 'ab')
+				fh.write(''.join(packets))
+				fh.close()
 				
-			self.queueIn.append((data,self.address[0]))
-			
-			fh = open('log', 'ab')
-			fh.write(data)
-			fh.close()
-			
 			self.lastPacket = time.time()
+		elif data is not None:
+			self.logger.debug("Connection closed by the server")
+			self.client.close()
+			self.client = None
 		else:
 			if time.time() - self.lastPacket > 3600.0:
 				self.logger.debug("No packets received in the last hour, shutting down connection")
@@ -321,6 +373,7 @@ class Communicate(object):
 
 
 				except Exception, e:
+					self.processingErrors += 1
 					exc_type, exc_value, exc_traceback = sys.exc_info()
 					self.logger.error("packetProcessor failed with: %s at line %i", str(e), traceback.tb_lineno(exc_traceback))
 						
@@ -352,8 +405,8 @@ class Communicate(object):
 		     DM for a VLA_FRB_TRIGGER)
 		"""
 		
-		# Unpack 40 4-byte intgers
-		data = struct.unpack('>40l', rawData)
+		# Unpack 40 4-byte intgers; the ID (YYMMDDHHMM for a session) is unsigned
+		data = struct.unpack('>4lL35l', rawData)
 		
 		# Figure out the notification type
 		notifyType = data[0]
@@ -403,6 +456,7 @@ class Communicate(object):
 		"""
 		
 		notifyType, sn, eventName, eventTimestamp, eventRA, eventDec, eventAdd = self.parsePacket(data)
+		self.packetsByType[notifyType] += 1
 		
 		self.logger.debug("Checking packet type %s" % notifyType)
 		if notifyType in ('Unknown', 'Invalid'):
@@ -436,6 +490,22 @@ class Communicate(object):
 			return destination, command, packed_data, reference
 
 
+def registerMetrics(registry, comms):
+	"""
+	Expose the counters of a Communicate instance on a fcn_metrics.Registry.
+	"""
+	
+	registry.counter('client_connections_total', 'Connections accepted from fcn_server', func=lambda: comms.connections)
+	registry.counter('client_packets_received_total', 'Notification packets received', func=lambda: comms.packetsReceived)
+	for notifyType in NOTIFY_TYPES:
+		registry.counter('client_packets_total', 'Notification packets processed, by type',
+					func=lambda notifyType=notifyType: comms.packetsByType[notifyType], type=notifyType)
+	registry.counter('client_echo_failures_total', 'Packets that could not be echoed back', func=lambda: comms.echoFailures)
+	registry.counter('client_processing_errors_total', 'Packets that failed processing', func=lambda: comms.processingErrors)
+	registry.gauge('client_queue_depth', 'Packets waiting to be processed', func=lambda: len(comms.queueIn))
+	registry.gauge('client_last_packet_age_seconds', 'Time since the last packet', func=lambda: time.time() - comms.lastPacket)
+
+
 def main(args):
 	"""
 	Main function of receiver_test.py.  This sets up the various configuration options 
@@ -446,6 +516,7 @@ def main(args):
 	config = parseConfig(args)
 	ip, port = config['args']
 	port = int(port, 10)
+	metricsPort = config['metrics']
 	
 	# Setup logging
 	logger = logging.getLogger(__name__)
@@ -480,6 +551,15 @@ def main(args):
 	frbComms = Communicate(config)
 	frbComms.start()
 	
+	# Serve the metrics
+	if metricsPort:
+		if fcn_metrics is None:
+			logger.critical('Metrics need fcn_metrics.py from vla_dispatcher/vla_server')
+			sys.exit(1)
+		registerMetrics(fcn_metrics.REGISTRY, frbComms)
+		metrics = fcn_metrics.MetricsServer(fcn_metrics.REGISTRY, port=metricsPort).start()
+		logger.info('Serving metrics at http://%s:%i/metrics', *metrics.address)
+	
 	# Setup handler for SIGTERM so that we aren't left in a funny state
 	def HandleSignalExit(signum, frame, logger=logger, CommInstance=frbComms):
 		logger.info('Exiting on signal %i', signum)
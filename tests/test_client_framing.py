@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Packet framing of client_tools/client_software.py: packets pipelined by
+fcn_server arrive in arbitrary TCP chunks, and only whole packets may be
+echoed back and queued for processing.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'client_tools'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher', 'vla_server'))
+import client_software
+import fcn_packet
+
+
+class ClientFramingTest(unittest.TestCase):
+	def setUp(self):
+		# receiveNotification() appends every packet to ./log
+		self.cwd = os.getcwd()
+		self.tempdir = tempfile.mkdtemp()
+		os.chdir(self.tempdir)
+
+		self.comms = client_software.Communicate({'MESSAGEINHOST': '127.0.0.1', 'MESSAGEINPORT': 0})
+		self.server, client = socket.socketpair()
+		self.server.settimeout(5)
+		client.settimeout(5)
+		self.comms.client = client
+		self.comms.address = ('127.0.0.1', 0)
+		self.comms.lastPacket = 0.0
+
+		encoder = fcn_packet.PacketEncoder()
+		self.packets = [encoder.encode('VLA_FRB_SESSION', sn, 1710010203, 1.5e9 + sn, 123.4, -12.3, eventDuration=600)
+					 for sn in xrange(1, 9)]
+
+	def tearDown(self):
+		self.server.close()
+		if self.comms.client is not None:
+			self.comms.client.close()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tempdir)
+
+	def _receive(self, chunks):
+		echoed = ''
+		for chunk in chunks:
+			self.server.sendall(chunk)
+			self.comms.receiveNotification()
+			self.server.setblocking(0)
+			try:
+				echoed += self.server.recv(65536)
+			except socket.error:
+				pass
+			self.server.settimeout(5)
+		return echoed
+
+	def _assertReceived(self, echoed):
+		data = ''.join(self.packets)
+		self.assertEqual(echoed, data)
+		self.assertEqual([packet for packet, address in self.comms.queueIn], self.packets)
+		self.assertEqual(self.comms.packetsReceived, len(self.packets))
+		self.assertEqual(self.comms.buffer, '')
+		self.assertEqual(open('log', 'rb').read(), data)
+		for packet in self.packets:
+			self.assertEqual(self.comms.parsePacket(packet)[0], 'VLA_FRB_SESSION')
+
+	def test_split_chunks(self):
+		# Chunk sizes that never line up with the packet boundaries
+		data = ''.join(self.packets)
+		chunks = []
+		i = 0
+		for size in (1, 7, 159, 161, 3, 320, 100, 500):
+			chunks.append(data[i:i+size])
+			i += size
+		chunks.append(data[i:])
+		self.assertEqual(''.join(chunks), data)
+		self._assertReceived(self._receive(chunks))
+
+	def test_byte_at_a_time(self):
+		data = ''.join(self.packets[:2])
+		self.packets = self.packets[:2]
+		self._assertReceived(self._receive(list(data)))
+
+	def test_partial_packet_not_echoed(self):
+		echoed = self._receive([self.packets[0][:100],])
+		self.assertEqual(echoed, '')
+		self.assertEqual(len(self.comms.queueIn), 0)
+		self.assertEqual(self.comms.buffer, self.packets[0][:100])
+
+	def test_connection_closed(self):
+		self.server.sendall(self.packets[0][:100])
+		self.server.shutdown(socket.SHUT_WR)
+		self.comms.receiveNotification()
+		self.comms.receiveNotification()
+		self.assertTrue(self.comms.client is None)
+		self.assertEqual(len(self.comms.queueIn), 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
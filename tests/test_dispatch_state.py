@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recovery of vla_dispatcher/dispatch_state.py: the snapshot plus the
+write-ahead log are replayed on start-up, and a record torn by a crash
+in the middle of an append is ignored without losing the ones before it.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import dispatch_state
+
+logging.getLogger('dispatch_state').setLevel(logging.ERROR)
+
+
+class DispatchStateTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _log(self):
+        return os.path.join(self.directory, dispatch_state.LOG)
+
+    def test_replay(self):
+        state = dispatch_state.DispatchState(self.directory)
+        state['P1'] = ('J0332+5434', 2610181200, 1e9, 53.2, 54.6)
+        state['P2'] = ('3C48', 2610181201)
+        del state['P1']
+        state.close()
+
+        state = dispatch_state.DispatchState(self.directory)
+        self.assertEqual(sorted(state.keys()), ['P2'])
+        self.assertEqual(state['P2'], ('3C48', 2610181201))
+        state.close()
+
+    def test_torn_last_record(self):
+        state = dispatch_state.DispatchState(self.directory)
+        state['P1'] = ('J0332+5434', 2610181200)
+        state['P2'] = ('3C48', 2610181201)
+        state.close()
+        # A crash part way through appending a third record
+        with open(self._log(), 'a') as fh:
+            fh.write('{"op": "set", "project": "P3", "val')
+
+        state = dispatch_state.DispatchState(self.directory)
+        self.assertEqual(sorted(state.keys()), ['P1', 'P2'])
+        self.assertEqual(state['P2'], ('3C48', 2610181201))
+
+        # The torn line was compacted away, so later records replay too
+        self.assertEqual(os.path.getsize(self._log()), 0)
+        state['P3'] = ('3C286', 2610181202)
+        del state['P1']
+        state.close()
+
+        state = dispatch_state.DispatchState(self.directory)
+        self.assertEqual(sorted(state.keys()), ['P2', 'P3'])
+        self.assertEqual(state['P3'], ('3C286', 2610181202))
+        state.close()
+
+    def test_compaction(self):
+        state = dispatch_state.DispatchState(self.directory, compact_every=3)
+        for i in xrange(10):
+            state['P%i' % i] = ('source', i)
+        for i in xrange(0, 10, 2):
+            del state['P%i' % i]
+        state.close()
+        self.assertTrue(os.path.exists(os.path.join(self.directory, dispatch_state.SNAPSHOT)))
+
+        state = dispatch_state.DispatchState(self.directory, compact_every=3)
+        self.assertEqual(sorted(state.keys()), ['P%i' % i for i in xrange(1, 10, 2)])
+        state.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Event routing of vla_dispatcher/vla_server/fcn_hosts.py: clients get the
+event types and projects they subscribed to, a session's STOP follows
+its START, and unknown event types are refused (by the router and,
+before that, by the command channel).
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher', 'vla_server'))
+import fcn_hosts
+import fcn_command
+from fcn_packet import notificationEventTypes
+
+logging.getLogger('fcn_hosts').setLevel(logging.CRITICAL)
+logging.getLogger('fcn_command').setLevel(logging.CRITICAL)
+
+
+_HOSTS = """# Test clients
+10.0.0.1 5000
+10.0.0.2 5000 types=VLA_FRB_TRIGGER
+10.0.0.3 5000 types=VLA_FRB_SESSION projects=19A-,20B-123
+10.0.0.4 5000 ra=350:10
+10.0.0.5 5000 not-a-filter
+10.0.0.6
+"""
+
+ALL = ('10.0.0.1', 5000)
+TRIGGERS = ('10.0.0.2', 5000)
+PROJECTS = ('10.0.0.3', 5000)
+WRAP = ('10.0.0.4', 5000)
+
+
+class RoutingTest(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		filename = os.path.join(self.tempdir, 'hosts.cfg')
+		with open(filename, 'w') as fh:
+			fh.write(_HOSTS)
+		self.hosts = fcn_hosts.readHosts(filename)
+		self.routing = fcn_hosts.RoutingTable(self.hosts, notificationEventTypes)
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def _route(self, eventType, eventSN=1, eventRA=180.0, eventDuration=None, project=None):
+		return sorted(self.routing.route(eventType, eventSN, 1710010203.0, eventRA, 10.0, eventDuration=eventDuration,
+									eventProject=project))
+
+	def test_read_hosts(self):
+		# The malformed lines are skipped
+		self.assertEqual([dest for dest, hostFilter in self.hosts], [ALL, TRIGGERS, PROJECTS, WRAP])
+
+	def test_control_types(self):
+		for eventType in fcn_hosts.CONTROL_TYPES:
+			self.assertEqual(self._route(eventType), [ALL, TRIGGERS, PROJECTS, WRAP])
+
+	def test_by_type(self):
+		self.assertEqual(self._route('TEST'), [ALL])
+		self.assertEqual(self._route('VLA_FRB_TRIGGER'), [ALL, TRIGGERS])
+		self.assertEqual(self.routing.subscribers('VLA_FRB_SESSION'), 3)
+
+	def test_by_project(self):
+		self.assertEqual(self._route('VLA_FRB_SESSION', 1, eventDuration=600, project='19A-001'), [ALL, PROJECTS])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 2, eventDuration=600, project='20B-123.sb1'), [ALL, PROJECTS])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 3, eventDuration=600, project='20B-124'), [ALL])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 4, eventDuration=600), [ALL])
+
+	def test_ra_wrap(self):
+		self.assertEqual(self._route('VLA_FRB_SESSION', 1, eventRA=355.0, eventDuration=600), [ALL, WRAP])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 2, eventRA=5.0, eventDuration=600), [ALL, WRAP])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 3, eventRA=-5.0, eventDuration=600), [ALL, WRAP])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 4, eventRA=20.0, eventDuration=600), [ALL])
+
+	def test_stop_follows_start(self):
+		self.assertEqual(self._route('VLA_FRB_SESSION', 7, eventDuration=600, project='19A-001'), [ALL, PROJECTS])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 7, eventRA=355.0, eventDuration=600, project='20B-124'), [ALL, WRAP])
+		# Same serial number, told apart by project
+		self.assertEqual(self._route('VLA_FRB_SESSION', 7, eventDuration=-1, project='20B-124'), [ALL, WRAP])
+		self.assertEqual(self._route('VLA_FRB_SESSION', 7, eventDuration=-1, project='19A-001'), [ALL, PROJECTS])
+		# A STOP whose START is not known goes to every session subscriber
+		self.assertEqual(self._route('VLA_FRB_SESSION', 7, eventDuration=-1, project='19A-001'), [ALL, PROJECTS, WRAP])
+
+	def test_unknown_type(self):
+		self.assertRaises(ValueError, self.routing.route, 'VLA_FRB_NOTHING', 1, 0.0, 0.0, 0.0)
+		self.assertRaises(ValueError, fcn_command.parseCommand, 'VLA_FRB_NOTHING 1 0 0 0')
+
+	def test_unknown_type_command(self):
+		server = fcn_command.CommandServer(os.path.join(self.tempdir, 'fcn_server.sock'))
+		try:
+			self.assertTrue(server.submit('VLA_FRB_NOTHING 1 0 0 0').startswith('ERR '))
+			self.assertEqual(server.submit('TEST 1 0 0 0'), 'OK 1')
+			self.assertEqual((server.count, server.rejected), (1, 1))
+			self.assertEqual(server.next()['eventType'], 'TEST')
+			self.assertEqual(server.next(), None)
+		finally:
+			server.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+vla_dispatcher/vla_server/fcn_packet.py against the packets fcn_server.py
+used to build with struct.pack('>40l'): byte for byte the same wherever
+the old encoding could represent the event.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher', 'vla_server'))
+import fcn_packet
+from fcn_packet import getGCNTime, notificationEventTypes
+
+
+def _reference(eventType, packetSN, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None, packetTime=None):
+	# The packing of the original createPacket()
+	packetTJD, packetSoD = getGCNTime(packetTime)
+	eventTJD, eventSoD = getGCNTime(eventTime)
+	data = [notificationEventTypes[eventType], int(packetSN), 1, packetSoD, int(eventSN), eventTJD, eventSoD,
+		   int(eventRA * 10000), int(eventDec * 10000)]
+	if eventDuration is not None:
+		data.append( int(eventDuration) )
+	if eventDM is not None:
+		data.append( eventDM )
+	while len(data) < 39:
+		data.append( 0 )
+	data.append( 10 )
+	return struct.pack('>40l', *data)
+
+
+# (eventType, packetSN, eventSN, eventTime, eventRA, eventDec, extra)
+_EVENTS = [('TEST', 1, 17, 1710010203.25, 123.4567, -12.3456, {}),
+		 ('IAMALIVE', 2, 0, 1710010203.0, 0, 0, {}),
+		 ('KILL', 3, 0, 1710010203.0, 0, 0, {}),
+		 ('VLA_FRB_SESSION', 4, 1710181200, 1710010203.99, 359.9999, 89.9999, {'eventDuration': 10800}),
+		 ('VLA_FRB_SESSION', 5, 1710181200, 1710010203.99, 0.0001, -89.9999, {'eventDuration': -1}),
+		 ('VLA_FRB_TRIGGER', 6, 99, 1710010203.5, 83.6331, 22.0145, {'eventDM': 557}),
+		 ('VLA_FRB_TRIGGER', 2**31 - 1, 2**31 - 1, 0.0, -180.0, -90.0, {'eventDM': 0})]
+
+
+class PacketEncoderTest(unittest.TestCase):
+	def setUp(self):
+		self.encoder = fcn_packet.PacketEncoder()
+		self.packetTime = 1710010204.75
+
+	def test_matches_reference(self):
+		for eventType, packetSN, eventSN, eventTime, eventRA, eventDec, extra in _EVENTS:
+			packet = self.encoder.encode(eventType, packetSN, eventSN, eventTime, eventRA, eventDec, packetTime=self.packetTime, **extra)
+			self.assertEqual(len(packet), fcn_packet.PACKET_SIZE)
+			self.assertEqual(packet, _reference(eventType, packetSN, eventSN, eventTime, eventRA, eventDec, packetTime=self.packetTime, **extra),
+						  eventType)
+
+	def test_batch(self):
+		events = [dict(eventType=eventType, packetSN=packetSN, eventSN=eventSN, eventTime=eventTime, eventRA=eventRA, eventDec=eventDec, **extra)
+				for eventType, packetSN, eventSN, eventTime, eventRA, eventDec, extra in _EVENTS]
+		data = self.encoder.encodeBatch(events, packetTime=self.packetTime)
+		self.assertEqual(data, ''.join(self.encoder.encode(packetTime=self.packetTime, **event) for event in events))
+
+	def test_unsigned_session_number(self):
+		# YYMMDDHHMM session numbers from 2022 on do not fit a signed word
+		packet = self.encoder.encode('VLA_FRB_SESSION', 1, 2610181200, 1792293969.0, 1.0, 2.0, eventDuration=600, packetTime=self.packetTime)
+		self.assertRaises(struct.error, _reference, 'VLA_FRB_SESSION', 1, 2610181200, 1792293969.0, 1.0, 2.0, eventDuration=600)
+		words = struct.unpack('>4lL35l', packet)
+		self.assertEqual(words[4], 2610181200)
+		self.assertEqual(words[9], 600)
+		self.assertEqual(words[39], fcn_packet.PACKET_TERMINATOR)
+		self.assertEqual(packet[:16], _reference('VLA_FRB_SESSION', 1, 0, 1792293969.0, 1.0, 2.0, eventDuration=600, packetTime=self.packetTime)[:16])
+
+	def test_errors(self):
+		self.assertRaises(ValueError, self.encoder.encode, 'NOT_A_TYPE', 1, 1, 0.0, 0.0, 0.0)
+		self.assertRaises(ValueError, self.encoder.encode, 'TEST', 1, 1, 0.0, 0.0, 0.0, eventDuration=10)
+		self.assertRaises(ValueError, self.encoder.encode, 'VLA_FRB_SESSION', 1, 1, 0.0, 0.0, 0.0, eventDM=10)
+		self.assertRaises(ValueError, self.encoder.encode, 'VLA_FRB_SESSION', 1, 2**32, 0.0, 0.0, 0.0, eventDuration=10)
+		self.assertRaises(ValueError, self.encoder.encode, 'TEST', 2**31, 1, 0.0, 0.0, 0.0)
+
+
+if __name__ == '__main__':
+	unittest.main()
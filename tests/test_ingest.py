@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Ordering in vla_dispatcher/ingest.py: documents are decoded in parallel
+by the IngestWorkers but must be dispatched in the order they were
+queued, even when the workers finish out of order or a decode fails.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import logging
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import ingest
+
+logging.getLogger('ingest').setLevel(logging.CRITICAL)
+
+
+class _Client(object):
+    """Decodes '<n>' datagrams; the first one only finishes once all of
+    the others have, and 'bad' ones fail."""
+
+    name = 'test'
+
+    def __init__(self, ndocs):
+        self.ndocs = ndocs
+        self.dispatched = []
+        self.decoded = 0
+        self._lock = threading.Lock()
+        self._others = threading.Event()
+        self.done = threading.Event()
+
+    def decode(self, data):
+        data = str(data)
+        if data == '0':
+            self._others.wait(5.0)
+        else:
+            with self._lock:
+                self.decoded += 1
+                if self.decoded == self.ndocs - 1:
+                    self._others.set()
+        if data == 'bad':
+            raise ValueError('cannot decode')
+        return data
+
+    def dispatch(self, doc):
+        self.dispatched.append(doc)
+        if len(self.dispatched) == self.ndocs - 1:
+            self.done.set()
+
+
+class IngestOrderTest(unittest.TestCase):
+    def _run(self, queue, nworkers=4):
+        docs = [str(i) for i in xrange(16)]
+        docs[7] = 'bad'
+        client = _Client(len(docs))
+        pool = ingest.IngestWorkers(queue, nworkers=nworkers)
+        pool.start()
+        try:
+            for doc in docs:
+                self.assertTrue(queue.put(client, doc))
+            self.assertTrue(client.done.wait(5.0))
+        finally:
+            pool.stop(timeout=5.0)
+        self.assertEqual(client.dispatched, [doc for doc in docs if doc != 'bad'])
+        self.assertEqual(queue.stats.processed, len(docs) - 1)
+        self.assertEqual(queue.stats.errors, 1)
+
+    def test_out_of_order_workers(self):
+        self._run(ingest.IngestQueue(maxsize=64))
+
+    def test_out_of_order_workers_ring(self):
+        self._run(ingest.RingIngestQueue(nslots=64, slot_size=256))
+
+    def test_full_queue(self):
+        queue = ingest.IngestQueue(maxsize=2)
+        client = _Client(3)
+        self.assertTrue(queue.accepts(10))
+        self.assertTrue(queue.put(client, '1'))
+        self.assertTrue(queue.put(client, '2'))
+        self.assertFalse(queue.accepts(10))
+        self.assertFalse(queue.put(client, '3'))
+        self.assertEqual((queue.stats.received, queue.stats.dropped), (3, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Duplicate, gap and restart handling of vla_dispatcher/obsdoc_sequence.py.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import obsdoc_sequence
+from obsdoc_sequence import ACCEPT, DROP, HOLD
+
+logging.getLogger('obsdoc_sequence').setLevel(logging.WARNING)
+
+
+def _doc(seq, subarray='default'):
+    return '<Observation subarrayId="%s" seq="%i"><name>J0332+5434</name></Observation>' % (subarray, seq)
+
+
+class _Timer(object):
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Loop(object):
+    """Holds call_later() timers until fire() is called."""
+
+    def __init__(self):
+        self.timers = []
+
+    def call_later(self, delay, callback, *args):
+        timer = _Timer(callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def fire(self):
+        timers, self.timers = self.timers, []
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+
+
+class SequenceTrackerTest(unittest.TestCase):
+    def _observe(self, tracker, seqs, subarray='default'):
+        return [tracker.observe(_doc(seq, subarray)) for seq in seqs]
+
+    def test_duplicates(self):
+        tracker = obsdoc_sequence.SequenceTracker(window=16)
+        self.assertEqual(self._observe(tracker, [1, 2, 2, 4, 3, 3, 1]), [ACCEPT, ACCEPT, DROP, ACCEPT, ACCEPT, DROP, DROP])
+        self.assertEqual(tracker.duplicates, 3)
+        self.assertEqual(tracker.gaps, 1)
+        self.assertEqual(tracker.reordered, 1)
+        self.assertEqual(tracker.missing, 0)
+
+    def test_subarrays_independent(self):
+        tracker = obsdoc_sequence.SequenceTracker(window=16)
+        self.assertEqual(self._observe(tracker, [1, 2], 'a'), [ACCEPT, ACCEPT])
+        self.assertEqual(self._observe(tracker, [1, 2], 'b'), [ACCEPT, ACCEPT])
+        self.assertEqual(self._observe(tracker, [2], 'a'), [DROP])
+
+    def test_unsequenced(self):
+        tracker = obsdoc_sequence.SequenceTracker()
+        self.assertEqual(tracker.observe('<Observation/>'), ACCEPT)
+        self.assertEqual(tracker.observe('<Observation/>'), ACCEPT)
+        self.assertEqual(tracker.unsequenced, 2)
+
+    def test_restart(self):
+        # A seq more than window behind is a restart of the numbering
+        tracker = obsdoc_sequence.SequenceTracker(window=16)
+        self._observe(tracker, xrange(1000, 1010))
+        self.assertEqual(self._observe(tracker, [1, 1, 2]), [ACCEPT, DROP, ACCEPT])
+        self.assertEqual(tracker.resets, 1)
+        # Within the window behind is a late arrival, not a restart
+        self.assertEqual(self._observe(tracker, [10, 5]), [ACCEPT, ACCEPT])
+        self.assertEqual(tracker.resets, 1)
+
+    def test_window_edge(self):
+        tracker = obsdoc_sequence.SequenceTracker(window=16)
+        self._observe(tracker, xrange(1, 21))
+        # 5 is the oldest seq still in the window, 4 is a restart
+        self.assertEqual(self._observe(tracker, [5, 4]), [DROP, ACCEPT])
+        self.assertEqual(tracker.resets, 1)
+
+    def test_large_jump(self):
+        tracker = obsdoc_sequence.SequenceTracker(window=16)
+        big = 1 + 10**9
+        self.assertEqual(self._observe(tracker, [1, big, big, big - 1]), [ACCEPT, ACCEPT, DROP, ACCEPT])
+        self.assertEqual(tracker.gaps, 1)
+        self.assertEqual(tracker.streams['default'].mask, 0x3)
+
+    def test_forget(self):
+        tracker = obsdoc_sequence.SequenceTracker(window=16)
+        self._observe(tracker, [1, 2, 3])
+        tracker.forget(_doc(2))
+        tracker.forget(_doc(3))
+        self.assertEqual(self._observe(tracker, [2, 3, 3, 1]), [ACCEPT, ACCEPT, DROP, DROP])
+
+    def test_hold_fills_gap(self):
+        loop = _Loop()
+        delivered = []
+        deliver = lambda data, received: delivered.append((data, received))
+        tracker = obsdoc_sequence.SequenceTracker(window=16, hold=1.0, loop=loop)
+        self.assertEqual(tracker.observe(_doc(1), deliver), ACCEPT)
+        self.assertEqual(tracker.observe(_doc(3), deliver), HOLD)
+        self.assertEqual(tracker.observe(_doc(3), deliver), DROP)
+        self.assertEqual(delivered, [])
+        self.assertEqual(tracker.observe(_doc(2), deliver), HOLD)
+        self.assertEqual([data for data, received in delivered], [_doc(2), _doc(3)])
+        self.assertTrue(delivered[0][1] is None)
+        self.assertTrue(delivered[1][1] is not None)
+        self.assertTrue(loop.timers[0].cancelled)
+        self.assertEqual(tracker.gaps, 0)
+
+    def test_hold_expires(self):
+        loop = _Loop()
+        delivered = []
+        deliver = lambda data, received: delivered.append(data)
+        tracker = obsdoc_sequence.SequenceTracker(window=16, hold=1.0, loop=loop)
+        tracker.observe(_doc(1), deliver)
+        tracker.observe(_doc(5), deliver)
+        tracker.observe(_doc(4), deliver)
+        loop.fire()
+        self.assertEqual(delivered, [_doc(4), _doc(5)])
+        self.assertEqual(tracker.gaps, 1)
+        self.assertEqual(tracker.missing, 2)
+        # The missing ones are late arrivals now
+        self.assertEqual(tracker.observe(_doc(2), deliver), ACCEPT)
+        self.assertEqual(tracker.observe(_doc(4), deliver), DROP)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Deadline handling of vla_dispatcher/timer_wheel.py, on a loop with a
+simulated clock: timers fire in deadline order (to the tick), never
+early and within a tick of their deadline, cancelled ones never fire,
+and the wheel only keeps one call_at pending.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import timer_wheel
+
+
+class _Handle(object):
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Loop(object):
+    """The parts of eventloop.EventLoop the wheel uses, on a clock that
+    only moves in run()."""
+
+    def __init__(self, now=100.0):
+        self.now = now
+        self.ready = []
+        self.scheduled = []
+
+    def time(self):
+        return self.now
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_at(self, when, callback, *args):
+        handle = _Handle(when, callback, args)
+        self.scheduled.append(handle)
+        return handle
+
+    def pending(self):
+        return [handle for handle in self.scheduled if not handle.cancelled]
+
+    def run(self, until):
+        while True:
+            while self.ready:
+                callback, args = self.ready.pop(0)
+                callback(*args)
+            due = [handle for handle in self.pending() if handle.when <= until]
+            if not due:
+                break
+            handle = min(due, key=lambda handle: handle.when)
+            self.scheduled.remove(handle)
+            self.now = max(self.now, handle.when)
+            handle.callback(*handle.args)
+        self.now = until
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = _Loop()
+        self.wheel = timer_wheel.TimerWheel(self.loop, tick=1.0)
+        self.fired = []
+
+    def _schedule(self, delay, name):
+        deadline = self.loop.time() + delay
+        return self.wheel.schedule(delay, lambda: self.fired.append((name, deadline, self.loop.time())))
+
+    def test_deadline_order(self):
+        for delay, name in ((3.5, 'c'), (1.0, 'a'), (7.25, 'e'), (2.2, 'b'), (4.9, 'd')):
+            self._schedule(delay, name)
+        self.assertEqual(len(self.wheel), 5)
+        self.loop.run(self.loop.time() + 20.0)
+        self.assertEqual([name for name, deadline, fired in self.fired], ['a', 'b', 'c', 'd', 'e'])
+        for name, deadline, fired in self.fired:
+            self.assertTrue(deadline <= fired < deadline + self.wheel.tick, name)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.loop.pending(), [])
+
+    def test_same_tick(self):
+        # Timers within a tick of each other share a bucket and fire together
+        self._schedule(3.1, 'a')
+        self._schedule(3.9, 'b')
+        self.loop.run(self.loop.time() + 10.0)
+        self.assertEqual(sorted(name for name, deadline, fired in self.fired), ['a', 'b'])
+        self.assertEqual(self.fired[0][2], self.fired[1][2])
+
+    def test_not_early(self):
+        self._schedule(2.5, 'a')
+        self.loop.run(self.loop.time() + 2.4)
+        self.assertEqual(self.fired, [])
+        self.loop.run(self.loop.time() + 1.0)
+        self.assertEqual([name for name, deadline, fired in self.fired], ['a'])
+
+    def test_cancel(self):
+        a = self._schedule(1.0, 'a')
+        self._schedule(1.0, 'b')
+        c = self._schedule(5.0, 'c')
+        a.cancel()
+        a.cancel()
+        c.cancel()
+        self.assertEqual(len(self.wheel), 1)
+        self.loop.run(self.loop.time() + 10.0)
+        self.assertEqual([name for name, deadline, fired in self.fired], ['b'])
+        # Nothing is left on the loop for the cancelled bucket
+        self.assertEqual(self.loop.pending(), [])
+
+    def test_single_wakeup(self):
+        for delay in (50.0, 40.0, 30.0):
+            self._schedule(delay, str(delay))
+            self.loop.run(self.loop.time())
+            self.assertEqual(len(self.loop.pending()), 1)
+            self.assertEqual(self.loop.pending()[0].when, self.loop.time() + delay)
+        # A later timer does not move the wakeup
+        self._schedule(60.0, 'late')
+        self.loop.run(self.loop.time())
+        self.assertEqual([handle.when for handle in self.loop.pending()], [self.loop.time() + 30.0])
+
+    def test_callback_error(self):
+        logging.getLogger('timer_wheel').setLevel(logging.CRITICAL)
+        self.wheel.schedule(1.0, lambda: 1/0)
+        self._schedule(1.0, 'a')
+        self.loop.run(self.loop.time() + 5.0)
+        self.assertEqual([name for name, deadline, fired in self.fired], ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
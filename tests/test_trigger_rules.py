@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Indexes of vla_dispatcher/trigger_rules.py: RuleSet.match() finds the
+same rules as checking every Rule in full, whichever field a rule is
+indexed on, including regions across RA 0 and over the poles.
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import random
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vla_dispatcher'))
+import trigger_rules
+from trigger_rules import Rule, RuleSet
+
+logging.getLogger('trigger_rules').setLevel(logging.CRITICAL)
+
+
+def _scan(rules, projectID, scan_intent, source, ra, dec):
+    # What match() has to agree with: every rule checked in full
+    tokens = set(intent.strip() for intent in (scan_intent or '').split(','))
+    return [rule for rule in rules if rule.matches(projectID or '', tokens, source, ra, dec)]
+
+
+class RuleSetTest(unittest.TestCase):
+    def test_each_index(self):
+        rules = [Rule('region', region=(82.99, 33.15, 1.5)),
+                 Rule('source', sources=['FRB121102', 'FRB180916']),
+                 Rule('project', projects=['16A-459', 'TRSR']),
+                 Rule('intent', intents=['OBSERVE_TARGET']),
+                 Rule('any'),
+                 Rule('combined', projects=['19A-'], intents=['OBSERVE_TARGET'], region=(10.0, -20.0, 2.0))]
+        ruleset = RuleSet(rules)
+        names = lambda *args: [rule.name for rule in ruleset.match(*args)]
+        self.assertEqual(names('99Z-000', 'CALIBRATE_PHASE', 'J0332', 83.5, 33.5), ['region', 'any'])
+        self.assertEqual(names('99Z-000', None, 'FRB180916', 0.0, 0.0), ['source', 'any'])
+        self.assertEqual(names('TRSR0001', '', 'J0332', 0.0, 0.0), ['project', 'any'])
+        self.assertEqual(names(None, 'CALIBRATE_PHASE, OBSERVE_TARGET', 'J0332', 0.0, 0.0), ['intent', 'any'])
+        # Indexed on its region, the other fields still have to match
+        self.assertEqual(names('19A-001', 'OBSERVE_TARGET', 'J0332', 11.0, -20.5), ['intent', 'any', 'combined'])
+        self.assertEqual(names('20A-001', 'OBSERVE_TARGET', 'J0332', 11.0, -20.5), ['intent', 'any'])
+
+    def test_region_edges(self):
+        ruleset = RuleSet([Rule('wrap', region=(359.5, 0.0, 1.0)),
+                           Rule('pole', region=(45.0, 89.5, 1.0)),
+                           Rule('south', region=(200.0, -60.0, 5.0))])
+        names = lambda ra, dec: [rule.name for rule in ruleset.match('', '', '', ra, dec)]
+        self.assertEqual(names(0.3, 0.2), ['wrap'])
+        self.assertEqual(names(-0.3, 0.2), ['wrap'])
+        self.assertEqual(names(358.7, 0.0), ['wrap'])
+        self.assertEqual(names(225.0, 89.8), ['pole'])
+        # Near -60 a degree of RA is half a degree on the sky
+        self.assertEqual(names(209.5, -60.0), ['south'])
+        self.assertEqual(names(211.0, -60.0), [])
+
+    def test_matches_full_scan(self):
+        rng = random.Random(1234)
+        projects = ['16A-459', '19A-', '19A-123', 'TRSR', '20B-']
+        intents = ['OBSERVE_TARGET', 'CALIBRATE_PHASE', 'CALIBRATE_FLUX']
+        sources = ['FRB121102', 'FRB180916', '3C286', 'J0332+5434']
+        rules = []
+        for i in xrange(300):
+            region = None
+            if rng.random() < 0.4:
+                region = (rng.uniform(-10, 370), rng.uniform(-90, 90), rng.uniform(0.1, 20))
+            rules.append(Rule(str(i), rng.sample(projects, rng.randint(0, 2)), rng.sample(intents, rng.randint(0, 2)),
+                              rng.sample(sources, rng.randint(0, 2)), region))
+        ruleset = RuleSet(rules)
+        for i in xrange(2000):
+            if rng.random() < 0.5 and rules[i % len(rules)].region is not None:
+                # Land near a region so that regions do match
+                ra, dec, radius = rules[i % len(rules)].region
+                ra, dec = ra + rng.uniform(-radius, radius), max(-90, min(90, dec + rng.uniform(-radius, radius)))
+            else:
+                ra, dec = rng.uniform(0, 360), rng.uniform(-90, 90)
+            args = (rng.choice(projects) + rng.choice(['', '001', '.sb2']), ','.join(rng.sample(intents, rng.randint(0, 2))),
+                    rng.choice(sources), ra, dec)
+            self.assertEqual(ruleset.match(*args), _scan(rules, *args), args)
+
+    def test_empty(self):
+        self.assertEqual(RuleSet().match('19A-001', 'OBSERVE_TARGET', 'FRB121102', 0.0, 0.0), [])
+
+
+class PrefixTrieTest(unittest.TestCase):
+    def test_lookup(self):
+        trie = trigger_rules.PrefixTrie()
+        trie.add('19A-', 1)
+        trie.add('19A-123', 2)
+        trie.add('', 3)
+        self.assertEqual(trie.lookup('19A-123.sb1'), set([1, 2, 3]))
+        self.assertEqual(trie.lookup('19A-12'), set([1, 3]))
+        self.assertEqual(trie.lookup('20A'), set([3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
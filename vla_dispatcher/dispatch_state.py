@@ -0,0 +1,148 @@
+"""
+Crash-safe record of the projects the dispatcher has sent a START for.
+
+FRBController needs to remember every START it dispatched so that the
+FINISH obsdoc of the same project can be turned into a STOP.  A
+DispatchState is a dictionary of projectID -> (source, eventSN,
+deadline, RA, Dec) (older records only have the first two) whose
+every change is first appended to a write-ahead log (one JSON line,
+flushed and fsync'd) in the state directory.  Every compact_every
+changes the whole mapping is written to a snapshot (temporary file,
+fsync, rename) and the log is truncated.  On start-up the snapshot is
+loaded and the log replayed on top of it; log records are idempotent,
+so a crash between the snapshot rename and the log truncation is
+harmless, and a torn final line is ignored.
+
+Without a directory the state is only kept in memory.
+"""
+
+import os
+import json
+import logging
+
+from eventloop import monotonic
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT = 'dispatched.snap'
+LOG = 'dispatched.wal'
+
+
+class DispatchState(object):
+    """projectID -> session tuple mapping backed by a WAL."""
+
+    def __init__(self, directory=None, compact_every=100):
+        self.directory = directory
+        self.compact_every = compact_every
+        self._state = {}
+        self._log = None
+        self._appended = 0
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            torn = self._recover()
+            self._log = open(self._path(LOG), 'a')
+            if torn:
+                # Later appends must not follow the torn line
+                self.compact()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _recover(self):
+        """Load the snapshot and replay the log.  Returns True if the log
+        ended in a torn record."""
+        t0 = monotonic()
+        torn = False
+        try:
+            with open(self._path(SNAPSHOT)) as fh:
+                self._state = dict((project, tuple(value)) for project, value in json.load(fh).items())
+        except IOError:
+            pass
+        nrecords = 0
+        try:
+            with open(self._path(LOG)) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning('Ignoring torn record at the end of %s' % self._path(LOG))
+                        torn = True
+                        break
+                    self._apply(record)
+                    nrecords += 1
+        except IOError:
+            pass
+        self._appended = nrecords
+        logger.info('Recovered %i dispatched project(s) from %s (%i log records) in %.1f ms' % (
+                    len(self._state), self.directory, nrecords, 1e3*(monotonic() - t0)))
+        return torn
+
+    def _apply(self, record):
+        if record['op'] == 'set':
+            self._state[record['project']] = tuple(record['value'])
+        elif record['op'] == 'del':
+            self._state.pop(record['project'], None)
+
+    def _append(self, record):
+        if self._log is None:
+            self._apply(record)
+            return
+        self._log.write(json.dumps(record) + '\n')
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._apply(record)
+        self._appended += 1
+        if self._appended >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """Write a snapshot of the current state and empty the log."""
+        if self.directory is None:
+            return
+        tmpname = self._path(SNAPSHOT + '.tmp')
+        with open(tmpname, 'w') as fh:
+            json.dump(self._state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmpname, self._path(SNAPSHOT))
+        dirfd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        self._log.close()
+        self._log = open(self._path(LOG), 'w')
+        os.fsync(self._log.fileno())
+        self._appended = 0
+
+    def __setitem__(self, project, value):
+        self._append({'op': 'set', 'project': project, 'value': list(value)})
+
+    def __delitem__(self, project):
+        if project not in self._state:
+            raise KeyError(project)
+        self._append({'op': 'del', 'project': project})
+
+    def __getitem__(self, project):
+        return self._state[project]
+
+    def __contains__(self, project):
+        return project in self._state
+
+    def __len__(self):
+        return len(self._state)
+
+    def __iter__(self):
+        return iter(self._state)
+
+    def keys(self):
+        return self._state.keys()
+
+    def items(self):
+        return self._state.items()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
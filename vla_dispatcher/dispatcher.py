@@ -19,9 +19,13 @@ Still to do;
 
 
 import datetime
+import functools
 import os
-import asyncore
+import sys
+import time
 import logging
+import threading
+import Queue
 from time import gmtime,strftime
 from optparse import OptionParser
 
@@ -29,32 +33,116 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 import mcaf_library
+import eventloop
+import ingest
+import obsdoc_prefilter
+import obsdoc_sequence
+import obsdoc_coalesce
+import dispatch_state
+import trigger_rules
+import timer_wheel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vla_server'))
+import fcn_command
+import fcn_trace
+import fcn_metrics
 
 # GLOBAL VARIABLES
 workdir = os.getcwd() # assuming we start in workdir
-dispatched = {};      # Keep global list of dispatched commands
 MJD_OFFSET = 2400000.5 # Offset in days between standard Julian day and MJD
 
 class FRBController(object):
     """Listens for OBS packets and tells FRB processing about any
-    notable scans."""
+    notable scans.
+
+    Dispatch commands go to fcn_server over commands (a
+    fcn_command.CommandClient on the default socket unless given).  If
+    the server is not listening they are left in the spool directory
+    (a fcn_command.CommandSpool) for it to pick up.  A command the
+    server may have queued without acknowledging it is only counted
+    as unknown, never spooled as well.
+
+    dispatched records the projects a START was sent for, as a
+    dispatch_state.DispatchState (in memory only unless given).
+
+    Scans are selected by the intent and project substrings, or, if
+    rules (a trigger_rules.RuleSet) is given, by any of its rules.
 
-    def __init__(self, intent='', project='', dispatch=False, verbose=False):
+    Sessions are started for session_timeout seconds.  With a scheduler
+    (a timer_wheel.TimerWheel) each dispatched session also gets a
+    deadline that far out, cancelled by its FINISH obsdoc; if the
+    FINISH never arrives the session is expired when the deadline
+    passes: expire_action 'stop' sends its STOP and forgets it,
+    'reap' only forgets it.  Deadlines are kept in dispatched, so they
+    survive a restart.  Deadlines fire on the event loop, so their STOPs
+    are handed to a sender thread rather than sent there; close() lets
+    it finish.
+    """
+
+    def __init__(self, intent='', project='', dispatch=False, verbose=False, commands=None, spool=None, dispatched=None,
+                 rules=None, scheduler=None, session_timeout=10800., expire_action='stop'):
         # Mode can be project, intent
         self.intent = intent
         self.project = project
         self.dispatch = dispatch
         self.verbose = verbose
+        if commands is None:
+            commands = fcn_command.CommandClient()
+        self.commands = commands
+        self.spool = spool
+        if dispatched is None:
+            dispatched = dispatch_state.DispatchState()
+        self.dispatched = dispatched
+        self.rules = rules
+        if expire_action not in ('stop', 'reap'):
+            raise ValueError("Unknown expire action '%s'" % expire_action)
+        self.scheduler = scheduler
+        self.session_timeout = session_timeout
+        self.expire_action = expire_action
+        self._timers = {}
+        self.starts = 0
+        self.stops = 0
+        self.expired = 0
+        self.handed_off = 0
+        self.spooled = 0
+        self.unknown = 0
+        # add_obsdoc() runs on the ingest workers, _expire() on the loop
+        self._lock = threading.RLock()
+        # One command on the fcn_server connection at a time
+        self._send_lock = threading.Lock()
+        self._outbox = Queue.Queue()
+        self._sender = None
+        for projectID, value in dispatched.items():
+            self._arm(projectID, value)
+
+    def selects(self, config):
+        """Is this scan of interest?  With trigger rules, returns the names
+        of the matching rules; the end of a dispatched project is always
+        of interest so its STOP goes out."""
+        if self.rules is None:
+            return (self.intent in config.scan_intent or self.intent is "") and (self.project in config.projectID or self.project is "")
+        if config.source in "FINISH" and config.projectID in self.dispatched:
+            return True
+        return [rule.name for rule in self.rules.match_config(config)]
 
     def add_obsdoc(self, obsdoc):
+        with self._lock:
+            self._add_obsdoc(obsdoc)
+
+    def _add_obsdoc(self, obsdoc):
         config = mcaf_library.MCAST_Config(obsdoc=obsdoc)
+        trace = fcn_trace.current()
 
         # If intent and project are good, print stuff.
-        if (self.intent in config.scan_intent or self.intent is "") and (self.project in config.projectID or self.project is ""):
+        matched = self.selects(config)
+        if matched:
             if config.source in "FINISH":
                 logger.info("*** Project %s has finished (source=%s)" % (config.projectID,config.source))
             else:
-                logger.info("*** Scan %d contains desired intent (%s=%s) and project (%s=%s)." % (config.scan, config.scan_intent,self.intent, config.projectID,self.project))
+                if self.rules is not None:
+                    logger.info("*** Scan %d (%s, %s) matches trigger rule(s) %s." % (config.scan, config.scan_intent, config.projectID, ', '.join(matched)))
+                else:
+                    logger.info("*** Scan %d contains desired intent (%s=%s) and project (%s=%s)." % (config.scan, config.scan_intent,self.intent, config.projectID,self.project))
                 logger.info("*** Position of source %s is (%s , %s) and start time (%s; unixtime %s)." % (config.source,config.ra_str,config.dec_str,str(config.startTime),str(mcaf_library.utcjd_to_unix(config.startTime+MJD_OFFSET))))
 
             # If we're not in listening mode, take action
@@ -63,77 +151,242 @@ class FRBController(object):
                 # Check whether obs has completed, obs is continuing, or obs is a new obs.
                 do_dispatch = False
                 if config.source in 'FINISH':
-                    if config.projectID in dispatched:
+                    if config.projectID in self.dispatched:
                         # Set "finish" parameters.
                         eventType = 'VLA_FRB_SESSION'
                         eventTime = mcaf_library.utcjd_to_unix(config.startTime+MJD_OFFSET)
                         eventRA   = config.ra_deg
                         eventDec  = config.dec_deg
                         eventDur  = -1. # To signify "stop obs" command.
-                        eventSN = int(dispatched[config.projectID][1])
+                        eventSN = int(self.dispatched[config.projectID][1])
                         do_dispatch = True
                         
                         # Remove project from dispatched tracker and check for unresolved jobs.
-                        del dispatched[config.projectID]
-                        if len(dispatched) is not 0:
-                            logger.debug("Dispatched jobs remaining:" % '\n'.join(['%s %s' % (key, value) for (key, value) in dispatched.items()]))
+                        del self.dispatched[config.projectID]
+                        self._disarm(config.projectID)
+                        if len(self.dispatched) is not 0:
+                            logger.debug("Dispatched jobs remaining:\n%s" % '\n'.join(['%s %s' % (key, value) for (key, value) in self.dispatched.items()]))
                     else:
                         logger.debug("Finished SB is not in dispatched list.")
 
                 elif ('TARGET' not in config.scan_intent):
                     logger.info("This is not a target scan. Will take no action.")
-                elif (config.projectID in list(dispatched.keys())) and (config.source in dispatched[config.projectID]):
+                elif (config.projectID in self.dispatched) and (config.source in self.dispatched[config.projectID]):
                     logger.info("Project %s already dispatched for target %s" % (config.projectID, config.source))
                 else:
                 #!!! CHECK FOR FINAL MESSAGE; SHOULD WE SEND A STOP COMMAND? REMOVE FROM dispatched IF SENT.
                     logger.info("Will dispatch %s for position %s %s" % (config.projectID,config.ra_str,config.dec_str))
                     
                     # Event serial number (eventSN) is UTC YYMMDDHHMM.
-                    # This convention will work up to and including the year 2021.
+                    # It goes out as an unsigned packet word, so this convention
+                    # will work up to and including the year 2042.
                     eventType = 'VLA_FRB_SESSION'
                     eventTime = mcaf_library.utcjd_to_unix(config.startTime+MJD_OFFSET)
                     eventRA   = config.ra_deg
                     eventDec  = config.dec_deg
-                    eventDur  = 10800. # In seconds. 1 hour + 5 minutes auto stop-obs. Positive number signifies "start obs" command"
+                    eventDur  = self.session_timeout # In seconds, auto stop-obs. Positive number signifies "start obs" command"
                     eventSN = int(strftime("%y%m%d%H%M",gmtime()))
                     do_dispatch = True
 
-                    # Add dispatched project and target to dispatched tracker.
-                    dispatched[config.projectID] = (config.source,eventSN)
+                    # Add dispatched project and target to dispatched tracker, with the
+                    # session deadline and position for a STOP if no FINISH arrives.
+                    self.dispatched[config.projectID] = (config.source,eventSN,time.time()+eventDur,eventRA,eventDec)
+                    self._arm(config.projectID, self.dispatched[config.projectID])
 
                 
                 # Is this a command we actually want to dispatch?
                 if do_dispatch:
-                    # Wait until last command disappears (i.e. cmd file is deleted by server)
-                    cmdfile = 'incoming.cmd'
-                    if os.path.exists(cmdfile):
-                        logger.info("Waiting for cmd queue to clear...")
-                    while os.path.exists(cmdfile):
-                        time.sleep(1)
-
-                    # Enqueue command
                     if (eventDur>0):
                         logger.info("Dispatching START command for obs serial# %s." % eventSN)
+                        self.starts += 1
                     else:
                         logger.info("Dispatching STOP command for obs serial# %s." % eventSN)
-                    fh = open(cmdfile,'w')
-                    fh.write("%s %i %f %f %f %f" % (eventType, eventSN, eventTime, eventRA, eventDec, eventDur))
-                    fh.close()
-                    logger.info("Done, wrote %i bytes.\n" % os.path.getsize(cmdfile))
+                        self.stops += 1
+                    if trace is not None:
+                        trace.record('select')
+                    self.send_command(fcn_command.formatCommand(eventType, eventSN, eventTime, eventRA, eventDec,
+                                                                eventDuration=eventDur, project=config.projectID,
+                                                                trace=trace.id if trace is not None else None),
+                                      trace)
 
                 
         else:
             logger.info("*** Skipping scan %d (%s, %s)." % (config.scan, config.scan_intent,config.projectID))
             #logger.info("*** Position is (%s , %s) and start time (%s; LST %s).\n" % (config.ra_str,config.dec_str,str(config.startTime),str(config.startLST)))
 
+    def _arm(self, projectID, value):
+        """Schedule the deadline of a dispatched session."""
+        if self.scheduler is None:
+            return
+        # Sessions recorded before deadlines were kept get a full timeout
+        deadline = value[2] if len(value) > 2 else time.time() + self.session_timeout
+        self._disarm(projectID)
+        self._timers[projectID] = self.scheduler.schedule(deadline - time.time(), self._expire, projectID, value[1])
+
+    def _disarm(self, projectID):
+        timer = self._timers.pop(projectID, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _expire(self, projectID, eventSN):
+        """Deadline of a session whose FINISH never arrived.  Runs on the
+        event loop, so the STOP is only queued for the sender thread."""
+        line = None
+        with self._lock:
+            self._timers.pop(projectID, None)
+            if projectID not in self.dispatched or self.dispatched[projectID][1] != eventSN:
+                return
+            value = self.dispatched[projectID]
+            logger.warning("No FINISH for project %s within %.0f s of its START (serial# %s)." % (projectID,
+                           self.session_timeout, eventSN))
+            del self.dispatched[projectID]
+            self.expired += 1
+            if self.expire_action == 'stop' and self.dispatch:
+                eventRA, eventDec = value[3:5] if len(value) >= 5 else (0.0, 0.0)
+                logger.info("Dispatching STOP command for obs serial# %s." % eventSN)
+                self.stops += 1
+                line = fcn_command.formatCommand('VLA_FRB_SESSION', int(eventSN), time.time(), eventRA, eventDec,
+                                                 eventDuration=-1., project=projectID)
+            else:
+                logger.info("Forgetting session serial# %s of project %s." % (eventSN, projectID))
+        if line is not None:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._send_outbox, name='expire-sender')
+                self._sender.daemon = True
+                self._sender.start()
+            self._outbox.put(line)
+
+    def _send_outbox(self):
+        while True:
+            line = self._outbox.get()
+            if line is None:
+                return
+            try:
+                self.send_command(line)
+            except Exception:
+                logger.exception("error sending '%s'" % line)
+
+    def close(self, timeout=None):
+        """Send any queued STOPs and stop the sender thread."""
+        if self._sender is not None:
+            self._outbox.put(None)
+            self._sender.join(timeout)
+            self._sender = None
+
+    def send_command(self, line, trace=None):
+        """Hand a command line to fcn_server and wait for its ack."""
+        with self._send_lock:
+            self._send_command(line, trace)
+
+    def _send_command(self, line, trace=None):
+        if self.commands.available():
+            try:
+                number = self.commands.send(line)
+                self.handed_off += 1
+                if trace is not None:
+                    trace.record('handoff', command=number)
+                logger.info("Done, fcn_server queued command %i.\n" % number)
+                return
+            except fcn_command.CommandUnknown as exp:
+                self.unknown += 1
+                if trace is not None:
+                    trace.record('handoff', unknown=True)
+                logger.error("%s; not sending it again" % exp)
+                return
+            except fcn_command.CommandError as exp:
+                logger.warning("%s; spooling the command instead" % exp)
+
+        if self.spool is None:
+            self.spool = fcn_command.CommandSpool()
+        name = self.spool.put(line)
+        self.spooled += 1
+        if trace is not None:
+            trace.record('handoff', spooled=name)
+        logger.info("Done, spooled as %s.\n" % name)
+
+    def summary(self):
+        return ['dispatch starts=%i stops=%i expired=%i handed_off=%i spooled=%i unknown=%i sessions=%i timers=%i' % (
+                self.starts, self.stops, self.expired, self.handed_off, self.spooled, self.unknown, len(self.dispatched),
+                len(self._timers))]
+
 
 
             
 
-def monitor(intent, project, dispatch, verbose):
+def log_document(name, doc):
+    logger.debug('Read %s document: %s' % (name, doc))
+
+
+def export_metrics(registry, queue, controller, prefilter=None, sequencer=None, coalescer=None):
+    """Expose the counters the pipeline already keeps on registry (a
+    fcn_metrics.Registry).  They are read when scraped, so this adds
+    nothing to the receive or dispatch path."""
+    stats = queue.stats
+    for name, help in (('received', 'Obsdoc datagrams received'), ('dropped', 'Datagrams dropped on a full ingest queue'),
+                       ('processed', 'Datagrams parsed and dispatched'), ('errors', 'Datagrams that raised while handled')):
+        registry.counter('dispatcher_ingest_%s_total' % name, help, func=functools.partial(getattr, stats, name))
+    registry.gauge('dispatcher_ingest_queue_depth', 'Datagrams waiting for a worker', func=queue.__len__)
+    registry.gauge('dispatcher_ingest_queue_high_water', 'Largest ingest queue depth seen',
+                   func=functools.partial(getattr, stats, 'high_water'))
+    registry.gauge('dispatcher_ingest_queue_size', 'Capacity of the ingest queue', func=lambda: queue.maxsize)
+    for stage in stats.stages:
+        timer = stats.timers[stage]
+        registry.summary('dispatcher_stage_seconds', 'Latency of each ingest stage (recent samples)',
+                         func=lambda timer=timer: (timer.count, timer.total, [(0.5, timer.percentile(50)), (0.99, timer.percentile(99))]),
+                         stage=stage)
+
+    def export(reporter, prefix, names):
+        for name in names:
+            registry.counter('dispatcher_%s_%s_total' % (prefix, name), '%s obsdocs counted as %s' % (prefix, name),
+                             func=functools.partial(getattr, reporter, name))
+    if prefilter is not None:
+        export(prefilter, 'prefilter', ('seen', 'passed', 'rejected_project', 'rejected_intent', 'unparsed'))
+    if sequencer is not None:
+        export(sequencer, 'sequence', ('seen', 'duplicates', 'gaps', 'missing', 'reordered', 'resets', 'unsequenced'))
+    if coalescer is not None:
+        export(coalescer, 'coalesce', ('seen', 'passed', 'coalesced', 'finish', 'unparsed'))
+
+    for name, help in (('starts', 'START commands dispatched'), ('stops', 'STOP commands dispatched'),
+                       ('expired', 'Sessions expired without a FINISH'), ('handed_off', 'Commands queued by fcn_server'),
+                       ('spooled', 'Commands left in the spool'),
+                       ('unknown', 'Commands sent to fcn_server but never acknowledged')):
+        registry.counter('dispatcher_%s_total' % name, help, func=functools.partial(getattr, controller, name))
+    registry.gauge('dispatcher_sessions', 'Dispatched sessions awaiting their FINISH', func=lambda: len(controller.dispatched))
+
+
+def monitor(intent, project, dispatch, verbose, queue_size=1024, workers=1, stats_interval=300.0, ring=False, slot_size=65536, parser='full', prefilter=True,
+            seq_window=1024, reorder_hold=0.0, streams=(), state_dir='.', rules_file=None, rules_interval=5.0,
+            trace_log=None, session_timeout=10800., expire_action='stop', coalesce=True, metrics_port=None):
     """ Monitor of mcaf observation files. 
     Scans that match intent and project are searched (unless --dispatch).
     Blocking function.
+
+    Datagrams are copied into a bounded ingest queue of queue_size
+    documents and parsed/dispatched by workers threads; queue and
+    latency statistics are logged every stats_interval seconds.  With
+    ring=True the queue is a ring of queue_size preallocated slots of
+    slot_size bytes that datagrams are received into directly.
+    parser selects the obsdoc parser ('full' or 'fast').  With
+    prefilter=True documents that cannot match intent and project are
+    dropped from the raw datagram before parsing, and with
+    coalesce=True so are subscans that repeat their scan's project,
+    scan number, source, position and intent.  Unless seq_window
+    is 0, duplicate obsdocs (by subarray and seq) are dropped on
+    receipt and gaps counted; reorder_hold > 0 holds documents that
+    arrive after a gap for up to that many seconds so they are
+    dispatched in sequence order.  streams lists extra (name, group,
+    port) MCAF streams to follow alongside the obsdocs; their documents
+    are only logged (in verbose mode).  In dispatch mode the record of
+    dispatched projects is kept in a write-ahead log and snapshot in
+    state_dir and recovered from there on start-up.  rules_file names
+    a trigger_rules file to select scans with instead of intent and
+    project; it is checked for changes every rules_interval seconds.
+    With trace_log, per-stage latencies of every obsdoc are appended
+    to that file (see vla_server/fcn_trace.py).  Dispatched sessions
+    last session_timeout seconds; one whose FINISH does not arrive in
+    that time is stopped or forgotten according to expire_action.
+    With metrics_port, counters and queue depths are served in the
+    Prometheus text format at http://localhost:metrics_port/metrics.
     """
 
     # Set up verbosity level for log
@@ -146,7 +399,10 @@ def monitor(intent, project, dispatch, verbose):
     logger.info('* * * * * * * * * * * * * * * * * * * * *')
     logger.info('* * * VLA Dispatcher is now running * * *')
     logger.info('* * * * * * * * * * * * * * * * * * * * *')
-    logger.info('*   Looking for intent = %s, project = %s' % (intent, project))
+    if rules_file:
+        logger.info('*   Looking for scans matching the rules in %s' % rules_file)
+    else:
+        logger.info('*   Looking for intent = %s, project = %s' % (intent, project))
     logger.debug('*   Running in verbose mode')
     if dispatch:
         logger.info('*   Running in dispatch mode. Will dispatch obs commands.')
@@ -155,13 +411,69 @@ def monitor(intent, project, dispatch, verbose):
     logger.info('* * * * * * * * * * * * * * * * * * * * *\n')
 
     # This starts the receiving/handling loop
-    controller = FRBController(intent=intent, project=project, dispatch=dispatch, verbose=verbose)
-    obsdoc_client = mcaf_library.ObsdocClient(controller)
+    dispatched = dispatch_state.DispatchState(state_dir) if dispatch else None
+    loop = eventloop.get_event_loop()
+    rules = None
+    if rules_file:
+        rules = trigger_rules.RuleSet.from_file(rules_file)
+        loop.call_later(rules_interval, rules.watch, loop, rules_interval)
+    scheduler = timer_wheel.TimerWheel(loop) if dispatch else None
+    controller = FRBController(intent=intent, project=project, dispatch=dispatch, verbose=verbose, dispatched=dispatched,
+                               rules=rules, scheduler=scheduler, session_timeout=session_timeout,
+                               expire_action=expire_action)
+    if ring:
+        queue = ingest.RingIngestQueue(nslots=queue_size, slot_size=slot_size)
+    else:
+        queue = ingest.IngestQueue(maxsize=queue_size)
+    pool = ingest.IngestWorkers(queue, nworkers=workers)
+    pool.start()
+    reporters = []
+    if prefilter and (intent or project) and rules is None:
+        prefilter = obsdoc_prefilter.ObsdocPrefilter(intent=intent, project=project)
+        reporters.append(prefilter)
+    else:
+        prefilter = None
+    sequencer = None
+    if seq_window > 0:
+        sequencer = obsdoc_sequence.SequenceTracker(window=seq_window, hold=reorder_hold, loop=loop)
+        reporters.append(sequencer)
+    subscriber = mcaf_library.McastSubscriber(loop=loop, ingest=queue)
+    tracer = fcn_trace.Tracer(trace_log, 'dispatcher') if trace_log else None
+    coalescer = None
+    if coalesce:
+        coalescer = obsdoc_coalesce.ScanCoalescer()
+        reporters.append(coalescer)
+    subscriber.add_stream('obsdoc', parser=parser, prefilter=prefilter, sequencer=sequencer, tracer=tracer,
+                          coalescer=coalescer)
+    subscriber.register('obsdoc', controller.add_obsdoc)
+    for name, group, port in streams:
+        subscriber.add_stream(name, group, port)
+        subscriber.register(name, functools.partial(log_document, name))
+    if dispatch:
+        reporters.append(controller)
+    metrics = None
+    if metrics_port:
+        export_metrics(fcn_metrics.REGISTRY, queue, controller, prefilter, sequencer, coalescer)
+        metrics = fcn_metrics.MetricsServer(fcn_metrics.REGISTRY, port=metrics_port).start()
+        logger.info('Serving metrics at http://%s:%i/metrics' % metrics.address)
+    if stats_interval > 0:
+        loop.call_later(stats_interval, ingest.log_stats, loop, queue, stats_interval, reporters)
     try:
-        asyncore.loop()
+        loop.run_forever()
     except KeyboardInterrupt:
         # Just exit without the trace barf
         logger.info('Escaping mcaf_monitor')
+    subscriber.close()
+    pool.stop(timeout=5.0)
+    controller.close(timeout=5.0)
+    if dispatched is not None:
+        dispatched.close()
+    if tracer is not None:
+        tracer.close()
+    if metrics is not None:
+        metrics.close()
+    for line in ingest.report_lines(queue, reporters):
+        logger.info('ingest: %s', line)
 
 
 
@@ -189,6 +501,70 @@ if __name__ == '__main__':
     cmdline.add_option('-v', '--verbose', dest="verbose",
         action="store_true", default=False,
         help="[False] Verbose output")
+    cmdline.add_option('-q', '--queue-size', dest="queue_size",
+        action="store", type="int", default=1024,
+        help="[1024] Maximum number of obsdocs waiting to be parsed")
+    cmdline.add_option('-w', '--workers', dest="workers",
+        action="store", type="int", default=1,
+        help="[1] Number of obsdoc parse/dispatch worker threads")
+    cmdline.add_option('--stats-interval', dest="stats_interval",
+        action="store", type="float", default=300.0,
+        help="[300] Seconds between ingest statistics reports (0 = off)")
+    cmdline.add_option('--ring', dest="ring",
+        action="store_true", default=False,
+        help="[False] Receive into a preallocated ring of --queue-size slots")
+    cmdline.add_option('--slot-size', dest="slot_size",
+        action="store", type="int", default=65536,
+        help="[65536] Size in bytes of each ring slot")
+    cmdline.add_option('--parser', dest="parser",
+        action="store", default="full", choices=sorted(mcaf_library.obsdoc_parsers),
+        help="[full] Obsdoc parser: 'full' (generateDS) or 'fast' (single pass)")
+    cmdline.add_option('--no-prefilter', dest="prefilter",
+        action="store_false", default=True,
+        help="[False] Parse every obsdoc instead of rejecting on the raw datagram")
+    cmdline.add_option('--no-coalesce', dest="coalesce",
+        action="store_false", default=True,
+        help="[False] Pass every subscan obsdoc on instead of only those that change the scan")
+    cmdline.add_option('--seq-window', dest="seq_window",
+        action="store", type="int", default=1024,
+        help="[1024] Duplicate-detection window per subarray, in seq numbers (0 = off)")
+    cmdline.add_option('--reorder-hold', dest="reorder_hold",
+        action="store", type="float", default=0.0,
+        help="[0] Seconds to hold obsdocs waiting for a seq gap to fill")
+    cmdline.add_option('-r', '--rules', dest="rules_file",
+        action="store", default=None,
+        help="[None] Trigger rules file; replaces --intent/--project")
+    cmdline.add_option('--rules-interval', dest="rules_interval",
+        action="store", type="float", default=5.0,
+        help="[5] Seconds between checks of the rules file for changes")
+    cmdline.add_option('--state-dir', dest="state_dir",
+        action="store", default=".",
+        help="[.] Directory for the dispatched-project log and snapshot")
+    cmdline.add_option('--session-timeout', dest="session_timeout",
+        action="store", type="float", default=10800.,
+        help="[10800] Session duration in seconds sent with each START")
+    cmdline.add_option('--expire', dest="expire_action",
+        action="store", default="stop", choices=['stop', 'reap'],
+        help="[stop] If no FINISH arrives before the session ends: send its STOP ('stop') or just forget it ('reap')")
+    cmdline.add_option('--stream', dest="streams",
+        action="append", default=[],
+        help="[] Also follow MCAF stream NAME=GROUP:PORT (repeatable)")
+    cmdline.add_option('--trace-log', dest="trace_log",
+        action="store", default=None,
+        help="[None] Append per-stage latency traces of every obsdoc to this file")
+    cmdline.add_option('--metrics-port', dest="metrics_port",
+        action="store", type="int", default=None,
+        help="[None] Serve Prometheus metrics on this localhost port")
     (opt,args) = cmdline.parse_args()
+    try:
+        streams = [mcaf_library.parse_stream_spec(spec) for spec in opt.streams]
+    except ValueError as exp:
+        cmdline.error(str(exp))
 
-    monitor(opt.intent, opt.project, opt.dispatch, opt.verbose)
+    monitor(opt.intent, opt.project, opt.dispatch, opt.verbose,
+            queue_size=opt.queue_size, workers=opt.workers, stats_interval=opt.stats_interval,
+            ring=opt.ring, slot_size=opt.slot_size, parser=opt.parser,
+            prefilter=opt.prefilter, seq_window=opt.seq_window, reorder_hold=opt.reorder_hold,
+            streams=streams, state_dir=opt.state_dir, rules_file=opt.rules_file, rules_interval=opt.rules_interval,
+            trace_log=opt.trace_log, session_timeout=opt.session_timeout, expire_action=opt.expire_action,
+            coalesce=opt.coalesce, metrics_port=opt.metrics_port)
@@ -0,0 +1,332 @@
+"""
+Minimal single-threaded event loop for the MCAF receive path.
+
+This replaces the bare asyncore.loop() that used to drive the
+multicast clients.  It provides the subset of the asyncio event loop
+interface the dispatcher needs (file descriptor readers, call_soon,
+call_later and datagram endpoints) on top of select.epoll/poll.  The
+code base is still Python 2.7, which has no asyncio; method names
+follow asyncio so the clients can move over unchanged when it does.
+"""
+
+import os
+import sys
+import errno
+import heapq
+import fcntl
+import select
+import socket
+import logging
+from collections import deque
+
+# The clock is shared with the tracing in vla_server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vla_server'))
+from fcn_trace import monotonic
+
+logger = logging.getLogger(__name__)
+
+# Largest number of datagrams pulled off one socket per wakeup.  Keeps
+# a flooded socket from starving the scheduled parse/dispatch tasks.
+MAX_READS_PER_WAKEUP = 256
+
+
+class Handle(object):
+    """A callback scheduled on the loop.  Can be cancelled before it runs."""
+
+    __slots__ = ('callback', 'args', 'when', 'cancelled')
+
+    def __init__(self, callback, args, when=None):
+        self.callback = callback
+        self.args = args
+        self.when = when
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.callback = None
+        self.args = None
+
+    def _run(self):
+        try:
+            self.callback(*self.args)
+        except Exception:
+            logger.exception('error in scheduled callback %r' % (self.callback,))
+
+
+class DatagramProtocol(object):
+    """Interface for datagram protocols, as in asyncio."""
+
+    def connection_made(self, transport):
+        pass
+
+    def datagram_received(self, data, addr):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class BufferedDatagramProtocol(DatagramProtocol):
+    """Datagram protocol that supplies its own receive buffers, in the
+    manner of asyncio.BufferedProtocol.  get_buffer() returns a
+    writable buffer for the next datagram; buffer_updated() is called
+    with the number of bytes written into it."""
+
+    def get_buffer(self):
+        raise NotImplementedError
+
+    def buffer_updated(self, nbytes, addr):
+        raise NotImplementedError
+
+
+class DatagramTransport(object):
+    """Non-blocking datagram socket registered with an EventLoop.
+
+    On each wakeup the socket is drained (up to MAX_READS_PER_WAKEUP
+    datagrams) before control returns to the loop, so datagrams move
+    from the kernel buffer into user space ahead of any parse work.
+
+    With buffered=True the protocol must provide get_buffer() and
+    buffer_updated() and datagrams are read with recvfrom_into().
+    """
+
+    max_size = 100000
+
+    def __init__(self, loop, sock, protocol, buffered=False):
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._closed = False
+        sock.setblocking(False)
+        if buffered:
+            loop.add_reader(sock.fileno(), self._read_ready_into)
+        else:
+            loop.add_reader(sock.fileno(), self._read_ready)
+        loop.call_soon(protocol.connection_made, self)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'socket':
+            return self._sock
+        if name == 'sockname':
+            return self._sock.getsockname()
+        return default
+
+    def _read_ready(self):
+        for i in xrange(MAX_READS_PER_WAKEUP):
+            try:
+                data, addr = self._sock.recvfrom(self.max_size)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                self._protocol.error_received(e)
+                return
+            self._protocol.datagram_received(data, addr)
+
+    def _read_ready_into(self):
+        protocol = self._protocol
+        for i in xrange(MAX_READS_PER_WAKEUP):
+            try:
+                nbytes, addr = self._sock.recvfrom_into(protocol.get_buffer())
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                protocol.error_received(e)
+                return
+            protocol.buffer_updated(nbytes, addr)
+
+    def sendto(self, data, addr):
+        self._sock.sendto(data, addr)
+
+    def is_closing(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._loop.call_soon(self._protocol.connection_lost, None)
+
+
+class EventLoop(object):
+    """select.epoll (or poll) based event loop with timers.
+
+    Ready callbacks run in FIFO order.  Between callbacks the loop
+    takes a zero-timeout look at its readers, so a long run of parse
+    and dispatch tasks does not leave datagrams sitting in the socket
+    buffer.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._pollin = select.EPOLLIN
+            self._ms = False
+        else:
+            self._poller = select.poll()
+            self._pollin = select.POLLIN
+            self._ms = True
+        self._readers = {}
+        self._ready = deque()
+        self._scheduled = []
+        self._sequence = 0
+        self._stopping = False
+        self._running = False
+
+        # Self-pipe so other threads can wake the loop up
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.add_reader(self._wake_r, self._drain_wakeup)
+
+    def time(self):
+        return monotonic()
+
+    # Readers
+    def add_reader(self, fd, callback, *args):
+        if fd in self._readers:
+            self._poller.modify(fd, self._pollin)
+        else:
+            self._poller.register(fd, self._pollin)
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is None:
+            return False
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+        return True
+
+    # Scheduling
+    def call_soon(self, callback, *args):
+        handle = Handle(callback, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        handle = self.call_soon(callback, *args)
+        self._write_wakeup()
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = Handle(callback, args, when)
+        self._sequence += 1
+        heapq.heappush(self._scheduled, (when, self._sequence, handle))
+        return handle
+
+    def _write_wakeup(self):
+        try:
+            os.write(self._wake_w, '\0')
+        except OSError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    # Endpoints
+    def create_datagram_endpoint(self, protocol_factory, sock, buffered=False):
+        """Wrap an already bound datagram socket; returns (transport, protocol)."""
+        protocol = protocol_factory()
+        transport = DatagramTransport(self, sock, protocol, buffered=buffered)
+        return transport, protocol
+
+    # Running
+    def _poll(self, timeout):
+        if timeout is not None and self._ms:
+            timeout = int(timeout * 1000)
+        elif timeout is None:
+            timeout = None if self._ms else -1
+        try:
+            events = self._poller.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for fd, mask in events:
+            try:
+                callback, args = self._readers[fd]
+            except KeyError:
+                continue
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('error in reader callback for fd %i' % fd)
+
+    def run_once(self):
+        """Wait for I/O or the next timer, then run what is ready."""
+        if self._ready or self._stopping:
+            timeout = 0
+        elif self._scheduled:
+            timeout = max(0, self._scheduled[0][0] - self.time())
+        else:
+            timeout = None
+        self._poll(timeout)
+
+        now = self.time()
+        while self._scheduled and self._scheduled[0][0] <= now:
+            when, seq, handle = heapq.heappop(self._scheduled)
+            if not handle.cancelled:
+                self._ready.append(handle)
+
+        # Only run what was ready at this point; anything queued by these
+        # callbacks waits for the next iteration.
+        ntodo = len(self._ready)
+        for i in xrange(ntodo):
+            handle = self._ready.popleft()
+            if handle.cancelled:
+                continue
+            handle._run()
+            if i + 1 < ntodo:
+                self._poll(0)
+
+        # Drop cancelled timers from the head of the heap
+        while self._scheduled and self._scheduled[0][2].cancelled:
+            heapq.heappop(self._scheduled)
+
+    def run_forever(self):
+        self._running = True
+        try:
+            while not self._stopping:
+                self.run_once()
+        finally:
+            self._stopping = False
+            self._running = False
+
+    def stop(self):
+        self._stopping = True
+        self._write_wakeup()
+
+    def is_running(self):
+        return self._running
+
+    def close(self):
+        self.remove_reader(self._wake_r)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+        self._ready.clear()
+        self._scheduled = []
+
+
+_default_loop = None
+def get_event_loop():
+    """Return the process-wide default loop, creating it on first use."""
+    global _default_loop
+    if _default_loop is None:
+        _default_loop = EventLoop()
+    return _default_loop
@@ -0,0 +1,340 @@
+"""
+Ingest pipeline between the MCAF sockets and the obsdoc controller.
+
+The receiver stage (McastClient.datagram_received, running in the
+event loop) only copies each datagram into a bounded IngestQueue.  A
+pool of IngestWorkers threads takes documents off the queue, decodes
+them and hands them to the client's dispatch step.  With a
+RingIngestQueue the datagrams are received straight into preallocated
+slots instead of being copied.  Queue depth,
+high-water mark, drops and per-stage latency are kept in IngestStats
+so the queue can be sized against real session load.
+"""
+
+import logging
+import threading
+from collections import deque
+
+from eventloop import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer(object):
+    """Latency accumulator for one pipeline stage (seconds).
+
+    Keeps count/total/max since start plus the most recent samples
+    for percentile estimates.
+    """
+
+    def __init__(self, name, nrecent=1024):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=nrecent)
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        self.recent.append(dt)
+
+    def percentile(self, pct):
+        samples = sorted(self.recent)
+        if not samples:
+            return 0.0
+        idx = int(round(pct / 100.0 * (len(samples) - 1)))
+        return samples[idx]
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def summary(self):
+        return '%s n=%i mean=%.2fms p50=%.2fms p99=%.2fms max=%.2fms' % (self.name,
+            self.count, 1e3*self.mean, 1e3*self.percentile(50), 1e3*self.percentile(99), 1e3*self.max)
+
+
+class IngestStats(object):
+    """Counters and stage timers shared by the queue and the workers."""
+
+    stages = ('queue', 'parse', 'dispatch', 'total')
+
+    def __init__(self):
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.errors = 0
+        self.high_water = 0
+        self.timers = dict((stage, StageTimer(stage)) for stage in self.stages)
+
+    def summary(self, depth=None):
+        lines = ['received=%i processed=%i dropped=%i errors=%i depth=%s high_water=%i' % (self.received,
+                 self.processed, self.dropped, self.errors, depth, self.high_water)]
+        lines.extend(self.timers[stage].summary() for stage in self.stages)
+        return lines
+
+
+class IngestQueue(object):
+    """Bounded FIFO of (client, data, t_received, slot, trace, serial) items.
+
+    put() never blocks: when the queue is full the new datagram is
+    dropped and counted, so the receiver stage always returns to the
+    socket immediately.  Queued items are numbered consecutively in
+    arrival order (serial) so the workers can dispatch them in order.
+    """
+
+    def __init__(self, maxsize=1024, stats=None):
+        self.maxsize = maxsize
+        self.stats = stats if stats is not None else IngestStats()
+        self._items = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._serial = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, client, data, trace=None):
+        stats = self.stats
+        with self._cond:
+            stats.received += 1
+            if len(self._items) >= self.maxsize:
+                stats.dropped += 1
+                return False
+            self._items.append((client, data, monotonic(), None, trace, self._serial))
+            self._serial += 1
+            if len(self._items) > stats.high_water:
+                stats.high_water = len(self._items)
+            self._cond.notify()
+        return True
+
+    def accepts(self, nbytes):
+        """Is there room to queue a datagram of nbytes?  Only the
+        receiving thread adds items, so the answer holds until it does."""
+        return len(self._items) < self.maxsize
+
+    def drop(self):
+        """Count a datagram turned away because accepts() was False."""
+        with self._cond:
+            self.stats.received += 1
+            self.stats.dropped += 1
+
+    def get(self, timeout=None):
+        """Return the next item, or None once the queue is closed (or
+        the timeout expires)."""
+        with self._cond:
+            while not self._items:
+                if self._closed:
+                    return None
+                self._cond.wait(timeout)
+                if timeout is not None and not self._items:
+                    return None
+            item = self._items.popleft()
+            self.stats.timers['queue'].add(monotonic() - item[2])
+        return item
+
+    def release(self, slot):
+        """Return storage used by an item once it has been decoded."""
+        pass
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class RingIngestQueue(IngestQueue):
+    """IngestQueue backed by a preallocated ring of receive buffers.
+
+    Used with a buffered datagram transport: the receiver asks for a
+    buffer with get_buffer(), the socket recv_into()s the next free
+    slot and commit() queues a read-only view of it, so no per-datagram
+    string is allocated.  Slots go back to the ring once the worker
+    has decoded them (release()).  When every slot is in use the
+    datagram is received into a scratch buffer and counted as dropped,
+    as is any datagram that fills a whole slot (it may be truncated).
+    discard() gives up the peeked slot without queueing anything, and
+    put() copies an existing string into a free slot.
+
+    Only the receiving thread takes slots; workers only return them.
+    """
+
+    def __init__(self, nslots=1024, slot_size=65536, stats=None):
+        IngestQueue.__init__(self, maxsize=nslots, stats=stats)
+        self.slot_size = slot_size
+        self._slots = [bytearray(slot_size) for i in xrange(nslots)]
+        self._free = deque(xrange(nslots))
+        self._scratch = bytearray(slot_size)
+        self._pending = None
+
+    def get_buffer(self):
+        # Peek at the next free slot; commit() claims it.  Workers only
+        # append to the free list so the head cannot change under us.
+        with self._cond:
+            if self._free:
+                self._pending = self._free[0]
+                return self._slots[self._pending]
+        self._pending = None
+        return self._scratch
+
+    def commit(self, client, nbytes, trace=None):
+        stats = self.stats
+        with self._cond:
+            stats.received += 1
+            slot = self._pending
+            self._pending = None
+            if slot is None or nbytes >= self.slot_size:
+                stats.dropped += 1
+                return False
+            self._free.popleft()
+            self._items.append((client, buffer(self._slots[slot], 0, nbytes), monotonic(), slot, trace, self._serial))
+            self._serial += 1
+            if len(self._items) > stats.high_water:
+                stats.high_water = len(self._items)
+            self._cond.notify()
+        return True
+
+    def accepts(self, nbytes):
+        return bool(self._free) and nbytes < self.slot_size
+
+    def discard(self):
+        self._pending = None
+
+    def put(self, client, data, trace=None):
+        buf = self.get_buffer()
+        nbytes = min(len(data), len(buf))
+        buf[:nbytes] = data[:nbytes]
+        return self.commit(client, len(data), trace)
+
+    def release(self, slot):
+        with self._cond:
+            self._free.append(slot)
+
+
+class IngestWorkers(object):
+    """Thread pool draining an IngestQueue.
+
+    Each item is decoded with client.decode(data) and the result passed
+    to client.dispatch(doc).  Decoding runs in parallel across workers,
+    but results are dispatched strictly in arrival (serial) order, one
+    at a time: a worker that finishes decoding parks its result, and
+    whichever worker holds the next serial dispatches it together with
+    any parked results that follow.  Items that carry a trace (see
+    McastClient) get their queue and parse stages recorded, and the
+    trace is activated for the dispatch.
+    """
+
+    def __init__(self, queue, nworkers=1, name='ingest'):
+        self.queue = queue
+        self.stats = queue.stats
+        self.nworkers = nworkers
+        self.name = name
+        self._threads = []
+        self._count_lock = threading.Lock()
+        self._order_lock = threading.Lock()
+        self._decoded = {}
+        self._next_serial = 0
+        self._dispatching = False
+
+    def start(self):
+        for i in xrange(self.nworkers):
+            t = threading.Thread(target=self._run, name='%s-%i' % (self.name, i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        self.queue.close()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.process(*item)
+
+    def process(self, client, data, t_received, slot=None, trace=None, serial=None):
+        stats = self.stats
+        doc = None
+        ok = False
+        try:
+            if trace is not None:
+                trace.record('queue')
+            t0 = monotonic()
+            try:
+                doc = client.decode(data)
+            finally:
+                if slot is not None:
+                    self.queue.release(slot)
+            with self._count_lock:
+                stats.timers['parse'].add(monotonic() - t0)
+            if trace is not None:
+                trace.record('parse')
+            ok = True
+        except Exception:
+            logger.exception("error handling '%s' message" % client.name)
+
+        result = (client, doc, t_received, trace, ok)
+        if serial is None:
+            self._dispatch(*result)
+            return
+        with self._order_lock:
+            self._decoded[serial] = result
+            if self._dispatching:
+                return
+            self._dispatching = True
+        while True:
+            with self._order_lock:
+                result = self._decoded.pop(self._next_serial, None)
+                if result is None:
+                    self._dispatching = False
+                    return
+                self._next_serial += 1
+            self._dispatch(*result)
+
+    def _dispatch(self, client, doc, t_received, trace, ok):
+        stats = self.stats
+        try:
+            if ok and doc is not None:
+                t1 = monotonic()
+                if trace is not None:
+                    trace.activate()
+                try:
+                    client.dispatch(doc)
+                finally:
+                    if trace is not None:
+                        trace.deactivate()
+                stats.timers['dispatch'].add(monotonic() - t1)
+        except Exception:
+            ok = False
+            logger.exception("error handling '%s' message" % client.name)
+        with self._count_lock:
+            if ok:
+                stats.processed += 1
+                stats.timers['total'].add(monotonic() - t_received)
+            else:
+                stats.errors += 1
+
+
+def report_lines(queue, reporters=()):
+    """Summary lines for the queue plus any other pipeline stages
+    (objects with a summary() method returning a list of lines)."""
+    lines = queue.stats.summary(depth=len(queue))
+    for reporter in reporters:
+        lines.extend(reporter.summary())
+    return lines
+
+
+def log_stats(loop, queue, interval=60.0, reporters=()):
+    """Log the pipeline summary every interval seconds from the loop."""
+    for line in report_lines(queue, reporters):
+        logger.info('ingest: %s', line)
+    loop.call_later(interval, log_stats, loop, queue, interval, reporters)
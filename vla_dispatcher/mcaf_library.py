@@ -1,10 +1,14 @@
 import os
 import struct
 import logging
-import asyncore, socket
+import socket
 import obsdocxml_parser
+import obsdoc_fastparse
+import obsdoc_sequence
 import ast
 import angles
+import eventloop
+from eventloop import monotonic
 from jdcal import mjd_now
 
 logger = logging.getLogger(__name__)
@@ -32,45 +36,220 @@ def utcjd_to_unix(utcJD):
         return unixTime
 
 
-class McastClient(asyncore.dispatcher):
-    """Generic class to receive the multicast XML docs."""
+# Obsdoc parsers, selectable per ObsdocClient.  'full' builds the whole
+# generateDS object tree; 'fast' extracts the MCAST_Config fields in a
+# single pass (see obsdoc_fastparse).
+obsdoc_parsers = {'full': obsdocxml_parser.parseString,
+                  'fast': obsdoc_fastparse.parseString}
+
+
+class McastClient(eventloop.BufferedDatagramProtocol):
+    """Generic class to receive the multicast XML docs.
+
+    The multicast socket is registered with an eventloop.EventLoop
+    (the default loop unless one is given).  Each datagram is handed
+    to parse() as a separately scheduled task, so the socket is
+    drained before any parsing or dispatch work runs.
+
+    If an ingest.IngestQueue is given, datagrams are instead copied
+    into that queue and the decode()/dispatch() steps run on the
+    ingest worker threads.  An ingest.RingIngestQueue switches the
+    socket to recv_into() on the queue's preallocated slots.
+
+    A recorder (obsdoc_capture.CaptureWriter) sees every raw datagram
+    before it is queued.  A sequencer (obsdoc_sequence.SequenceTracker)
+    then sees it and can drop duplicates or hold it back for
+    reordering; held datagrams come back later through deliver().
+    admit() is then asked whether the datagram should go any further;
+    like the sequencer it runs in the receiver stage, so it sees the
+    datagrams one at a time and in sequence order.  A datagram the
+    ingest queue has no room for is dropped before either sees it (or,
+    if the sequencer already has, it is told to forget it), so a
+    retransmission is not taken for a duplicate.
+    With listen=False no socket is opened; the client is then only
+    used for its decode()/dispatch() steps, e.g. when replaying a
+    capture in-process.
+
+    decoder, if given, replaces the default decode() (which passes
+    the raw datagram through).  The default dispatch() hands documents
+    to the McastSubscriber the client belongs to, if any.  bind_group
+    binds the socket to the group address rather than the wildcard,
+    so streams on different groups can share a port.
+
+    With a tracer (vla_server/fcn_trace.Tracer) every datagram that
+    enters the pipeline starts a trace, which records the queue and
+    parse stages and is the fcn_trace.current() trace of the thread
+    while the document is dispatched.  The trace starts when the
+    datagram was received, ahead of the sequencer and admit(), and
+    records the time they took as an 'admit' stage, or as a 'hold'
+    stage if the sequencer held the datagram back.
+    """
 
-    def __init__(self, group, port, name=""):
-        asyncore.dispatcher.__init__(self)
+    def __init__(self, group, port, name="", loop=None, rcvbuf=None, ingest=None, recorder=None, listen=True,
+                 sequencer=None, decoder=None, bind_group=False, tracer=None):
         self.name = name
         self.group = group
         self.port = port
-        addrinfo = socket.getaddrinfo(group, None)[0]
-        self.create_socket(addrinfo[0], socket.SOCK_DGRAM)
-        self.set_reuse_addr()
-        self.bind(('',port))
-        mreq = socket.inet_pton(addrinfo[0],addrinfo[4][0]) \
-                + struct.pack('=I', socket.INADDR_ANY)
-        self.socket.setsockopt(socket.IPPROTO_IP, 
-                socket.IP_ADD_MEMBERSHIP, mreq)
-        self.read = None
-
-    def handle_connect(self):
+        self.ingest = ingest
+        self.recorder = recorder
+        self.sequencer = sequencer
+        self.decoder = decoder
+        self.tracer = tracer
+        self.subscriber = None
+        if loop is None:
+            loop = eventloop.get_event_loop()
+        self.loop = loop
+        self.transport = None
+        self._rxbuf = None
+        # Receive time of the datagram being handled, for its trace
+        self._received = None
+        if listen:
+            sock = make_mcast_socket(group, port, rcvbuf=rcvbuf, bind_group=bind_group)
+            buffered = hasattr(ingest, 'get_buffer')
+            self.transport, protocol = loop.create_datagram_endpoint(lambda: self, sock, buffered=buffered)
+
+    def connection_made(self, transport):
         logger.debug('connect %s group=%s port=%d' % (self.name, 
             self.group, self.port))
 
-    def handle_close(self):
+    def connection_lost(self, exc):
         logger.debug('close %s group=%s port=%d' % (self.name, 
             self.group, self.port))
 
-    def writeable(self):
-        return False
+    def datagram_received(self, data, addr):
+        if self.tracer is not None:
+            self._received = monotonic()
+        logger.debug('read %s %s', self.name, data)
+        if self.recorder is not None:
+            self.recorder.write(data)
+        if self.sequencer is None or self.sequencer.observe(data, self.deliver) == obsdoc_sequence.ACCEPT:
+            self.deliver(data)
+        self._received = None
+
+    def admit(self, data):
+        """Return False to drop a raw datagram before it is queued.
+        Override in subclasses."""
+        return True
+
+    def deliver(self, data, received=None):
+        """Pass a datagram on to the ingest queue or the loop.
+        received is the monotonic time it arrived if it was held back."""
+        if self.ingest is not None and not self.ingest.accepts(len(data)):
+            self.ingest.drop()
+            if self.sequencer is not None:
+                self.sequencer.forget(data)
+            logger.debug('ingest queue full, dropped %s datagram', self.name)
+            return
+        if not self.admit(data):
+            return
+        trace = None
+        if self.tracer is not None:
+            if received is None:
+                trace = self.tracer.start(received=self._received, stream=self.name)
+                trace.record('admit')
+            else:
+                trace = self.tracer.start(received=received, stream=self.name)
+                trace.record('hold')
+        if self.ingest is not None:
+            if not self.ingest.put(self, data, trace):
+                logger.debug('ingest queue full, dropped %s datagram', self.name)
+        else:
+            self.loop.call_soon(self.handle_read, data, trace)
+
+    def get_buffer(self):
+        self._rxbuf = self.ingest.get_buffer()
+        return self._rxbuf
 
-    def handle_read(self):
-        self.read = self.recv(100000)
-        logger.debug('read ' + self.name + ' ' + self.read)
+    def buffer_updated(self, nbytes, addr):
+        if self.tracer is not None:
+            self._received = monotonic()
+        try:
+            self._commit(nbytes)
+        finally:
+            self._received = None
+
+    def _commit(self, nbytes):
+        if self.recorder is not None:
+            self.recorder.write(buffer(self._rxbuf, 0, nbytes))
+        if not self.ingest.accepts(nbytes):
+            self.ingest.discard()
+            self.ingest.drop()
+            logger.debug('no free ingest slot, dropped %i byte %s datagram', nbytes, self.name)
+            return
+        if self.sequencer is not None and \
+                self.sequencer.observe(buffer(self._rxbuf, 0, nbytes), self.deliver) != obsdoc_sequence.ACCEPT:
+            self.ingest.discard()
+            return
+        if not self.admit(buffer(self._rxbuf, 0, nbytes)):
+            self.ingest.discard()
+            return
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.start(received=self._received, stream=self.name)
+            trace.record('admit')
+        if not self.ingest.commit(self, nbytes, trace):
+            logger.debug('no free ingest slot, dropped %i byte %s datagram', nbytes, self.name)
+
+    def handle_read(self, data, trace=None):
         try:
-            self.parse()
+            self.parse(data, trace)
         except Exception as e:
             logger.exception("error handling '%s' message" % self.name)
 
-    def handle_error(self, type, val, trace):
-        logger.error('unhandled exception: ' + repr(val))
+    def parse(self, data, trace=None):
+        if trace is None:
+            doc = self.decode(data)
+            if doc is not None:
+                self.dispatch(doc)
+            return
+        trace.record('queue')
+        trace.activate()
+        try:
+            doc = self.decode(data)
+            trace.record('parse')
+            if doc is not None:
+                self.dispatch(doc)
+        finally:
+            trace.deactivate()
+
+    def decode(self, data):
+        """Turn a raw datagram into a document.  Override in subclasses.
+
+        data may be a view of a ring slot that is reused once decode()
+        returns, so the raw document is returned as a string."""
+        if self.decoder is not None:
+            return self.decoder(data)
+        return str(data)
+
+    def dispatch(self, doc):
+        """Act on a decoded document.  Override in subclasses."""
+        if self.subscriber is not None:
+            self.subscriber.route(self.name, doc)
+
+    def error_received(self, exc):
+        logger.error('unhandled exception: ' + repr(exc))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+def make_mcast_socket(group, port, rcvbuf=None, bind_group=False):
+    """Return a UDP socket bound to port and joined to the multicast
+    group.  rcvbuf optionally enlarges the kernel receive buffer.
+    With bind_group the socket is bound to the group address, so it
+    only sees that group's datagrams on the port."""
+    addrinfo = socket.getaddrinfo(group, None)[0]
+    sock = socket.socket(addrinfo[0], socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((group if bind_group else '',port))
+    mreq = socket.inet_pton(addrinfo[0],addrinfo[4][0]) \
+            + struct.pack('=I', socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, 
+            socket.IP_ADD_MEMBERSHIP, mreq)
+    return sock
 
 
 class ObsdocClient(McastClient):
@@ -80,17 +259,135 @@ class ObsdocClient(McastClient):
     controller.add_obsdoc(obsdoc) method will be called for every
     document received. Controller is defined as a class in the main
     controller script, and runs job launching.
+
+    parser names the obsdoc parser to use (a key of obsdoc_parsers);
+    it can be changed at runtime with set_parser().  An optional
+    prefilter (obsdoc_prefilter.ObsdocPrefilter) sees the raw datagram
+    in admit() and can drop it before it is queued or parsed, and so
+    can an optional coalescer (obsdoc_coalesce.ScanCoalescer), which
+    drops subscans that do not change the scan.  group, port and the
+    remaining arguments are passed to McastClient.  Documents also go
+    to the client's McastSubscriber, if it has one.
     """
 
-    def __init__(self,controller=None):
-        McastClient.__init__(self,'239.192.3.2',53001,'obsdoc')
+    group = '239.192.3.2'
+    port = 53001
+
+    def __init__(self,controller=None,loop=None,ingest=None,recorder=None,listen=True,parser='full',prefilter=None,
+                 sequencer=None,group=None,port=None,name='obsdoc',rcvbuf=None,bind_group=False,tracer=None,
+                 coalescer=None):
+        McastClient.__init__(self,group or self.group,port or self.port,name,loop=loop,rcvbuf=rcvbuf,ingest=ingest,
+                             recorder=recorder,listen=listen,sequencer=sequencer,bind_group=bind_group,tracer=tracer)
         self.controller = controller
+        self.prefilter = prefilter
+        self.coalescer = coalescer
+        self.set_parser(parser)
 
-    def parse(self):
-        obsdoc = obsdocxml_parser.parseString(self.read)
+    def set_parser(self, parser):
+        try:
+            self.parse_obsdoc = obsdoc_parsers[parser]
+        except KeyError:
+            raise ValueError("Unknown obsdoc parser '%s'" % parser)
+        self.parser = parser
+
+    def admit(self, data):
+        if self.prefilter is not None and not self.prefilter.accept(data):
+            return False
+        if self.coalescer is not None and not self.coalescer.accept(data):
+            return False
+        return True
+
+    def decode(self, data):
+        obsdoc = self.parse_obsdoc(data)
         logger.info("Read obsdoc for project %s scan %s subscan %s." % (obsdoc.datasetID,str(obsdoc.scanNo),str(obsdoc.subscanNo)))
+        return obsdoc
+
+    def dispatch(self, obsdoc):
         if self.controller is not None:
             self.controller.add_obsdoc(obsdoc)
+        McastClient.dispatch(self, obsdoc)
+
+
+# Client class per known MCAF stream name; other streams get a plain
+# McastClient.
+stream_clients = {'obsdoc': ObsdocClient}
+
+
+class McastSubscriber(object):
+    """Follows several MCAF multicast streams from one event loop.
+
+    Each stream is a McastClient (an ObsdocClient for 'obsdoc', see
+    stream_clients) on its own group/port socket, sharing the loop and
+    the ingest queue, so one set of workers decodes every stream with
+    its own parser.  Decoded documents are routed by stream name to the
+    handlers registered for it; a handler registered for '*' sees
+    every stream as handler(name, doc), the others as handler(doc).
+    """
+
+    def __init__(self, loop=None, ingest=None):
+        if loop is None:
+            loop = eventloop.get_event_loop()
+        self.loop = loop
+        self.ingest = ingest
+        self.streams = {}
+        self.handlers = {}
+
+    def add_stream(self, name, group=None, port=None, **kwargs):
+        """Join a stream and return its client.  group and port default
+        to the stream client class's own; other keyword arguments go to
+        the client constructor."""
+        if name in self.streams:
+            raise ValueError("Stream '%s' is already subscribed" % name)
+        cls = stream_clients.get(name, McastClient)
+        group = group or getattr(cls, 'group', None)
+        port = port or getattr(cls, 'port', None)
+        if group is None or port is None:
+            raise ValueError("Stream '%s' needs a group and port" % name)
+        kwargs.setdefault('ingest', self.ingest)
+        kwargs.setdefault('bind_group', True)
+        client = cls(group=group, port=port, name=name, loop=self.loop, **kwargs)
+        client.subscriber = self
+        self.streams[name] = client
+        logger.info('Subscribed to %s stream on %s:%i' % (name, group, port))
+        return client
+
+    def remove_stream(self, name):
+        client = self.streams.pop(name)
+        client.subscriber = None
+        client.close()
+
+    def register(self, name, handler):
+        """Call handler for every document decoded on stream name."""
+        self.handlers.setdefault(name, []).append(handler)
+
+    def unregister(self, name, handler):
+        self.handlers[name].remove(handler)
+
+    def route(self, name, doc):
+        for handler in self.handlers.get(name, ()):
+            self._call(name, handler, doc)
+        for handler in self.handlers.get('*', ()):
+            self._call(name, handler, name, doc)
+
+    def _call(self, name, handler, *args):
+        try:
+            handler(*args)
+        except Exception:
+            logger.exception("handler %r failed on '%s' document" % (handler, name))
+
+    def close(self):
+        for name in list(self.streams):
+            self.remove_stream(name)
+
+
+def parse_stream_spec(spec):
+    """Split a NAME=GROUP:PORT stream specification."""
+    try:
+        name, address = spec.split('=', 1)
+        group, port = address.rsplit(':', 1)
+        return name, group, int(port)
+    except ValueError:
+        raise ValueError("Bad stream '%s', expected NAME=GROUP:PORT" % spec)
 
 
 #A dumbed down version of EVLAconfig just for reading obsdoc info
@@ -282,7 +579,7 @@ class MCAST_Config(object):
 if __name__ == '__main__':
     obsdoc_client = ObsdocClient()
     try:
-        asyncore.loop()
+        eventloop.get_event_loop().run_forever()
     except KeyboardInterrupt:
         # Just exit without the trace barf on control-C
         logger.info('got SIGINT, exiting')
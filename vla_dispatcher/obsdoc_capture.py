@@ -0,0 +1,370 @@
+#!/usr/bin/env python2.7
+#
+# MCAF stream recorder and replayer.
+#
+# Records the raw obsdoc datagrams seen on the MCAF multicast group to
+# a capture file, and replays a capture into the parse/dispatch
+# pipeline for benchmarking FRBController or reproducing a session.
+#
+"""
+Capture file layout (all little-endian):
+
+  header   'MCAFCAP1', group (16s, NUL padded), port (H)
+  records  receive time (d, UNIX seconds), length (I), datagram bytes
+  index    record offsets (Q each), one per record
+  trailer  index offset (Q), record count (I), 'MCAFIDX1'
+
+The index and trailer are written when the recorder is closed.  A
+capture cut short by a crash has no trailer; the reader then falls
+back to scanning the records sequentially.
+"""
+
+import os
+import time
+import struct
+import socket
+import logging
+from optparse import OptionParser
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+import eventloop
+import ingest
+import mcaf_library
+import obsdoc_prefilter
+import obsdoc_sequence
+import obsdoc_coalesce
+
+CAPTURE_MAGIC = 'MCAFCAP1'
+INDEX_MAGIC = 'MCAFIDX1'
+_header = struct.Struct('<8s16sH')
+_record = struct.Struct('<dI')
+_offset = struct.Struct('<Q')
+_trailer = struct.Struct('<QI8s')
+
+
+class CaptureWriter(object):
+    """Appends timestamped datagrams to a capture file."""
+
+    def __init__(self, filename, group, port, flush_interval=1.0):
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+        self.fh.write(_header.pack(CAPTURE_MAGIC, group, port))
+        self.offsets = []
+        self.flush_interval = flush_interval
+        self._last_flush = time.time()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def write(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.offsets.append(self.fh.tell())
+        self.fh.write(_record.pack(timestamp, len(data)))
+        self.fh.write(data)
+        if timestamp - self._last_flush >= self.flush_interval:
+            self.fh.flush()
+            self._last_flush = timestamp
+
+    def close(self):
+        if self.fh is None:
+            return
+        index_offset = self.fh.tell()
+        self.fh.write(''.join(_offset.pack(offset) for offset in self.offsets))
+        self.fh.write(_trailer.pack(index_offset, len(self.offsets), INDEX_MAGIC))
+        self.fh.close()
+        self.fh = None
+
+
+class CaptureReader(object):
+    """Reads a capture file written by CaptureWriter.
+
+    Iterating yields (timestamp, datagram) pairs in receive order;
+    len() and record(i) use the index when the capture has one.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, 'rb')
+        magic, group, port = _header.unpack(self.fh.read(_header.size))
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("'%s' is not an MCAF capture file" % filename)
+        self.group = group.rstrip('\0')
+        self.port = port
+        self.offsets, self.end = self._read_index()
+
+    def _read_index(self):
+        self.fh.seek(0, os.SEEK_END)
+        size = self.fh.tell()
+        if size >= _header.size + _trailer.size:
+            self.fh.seek(size - _trailer.size)
+            index_offset, count, magic = _trailer.unpack(self.fh.read(_trailer.size))
+            if magic == INDEX_MAGIC:
+                self.fh.seek(index_offset)
+                raw = self.fh.read(count * _offset.size)
+                offsets = list(struct.unpack('<%iQ' % count, raw))
+                return offsets, index_offset
+
+        # No index (recorder did not exit cleanly); scan the records
+        logger.warning("'%s' has no index, scanning records", self.filename)
+        offsets = []
+        offset = _header.size
+        while offset + _record.size <= size:
+            self.fh.seek(offset)
+            timestamp, length = _record.unpack(self.fh.read(_record.size))
+            if offset + _record.size + length > size:
+                break
+            offsets.append(offset)
+            offset += _record.size + length
+        return offsets, offset
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def record(self, i):
+        self.fh.seek(self.offsets[i])
+        timestamp, length = _record.unpack(self.fh.read(_record.size))
+        return timestamp, self.fh.read(length)
+
+    def __iter__(self):
+        self.fh.seek(_header.size)
+        for i in xrange(len(self.offsets)):
+            timestamp, length = _record.unpack(self.fh.read(_record.size))
+            yield timestamp, self.fh.read(length)
+
+    def close(self):
+        self.fh.close()
+
+
+class Replayer(object):
+    """Feeds a capture into the parse/dispatch pipeline.
+
+    speed is the replay rate relative to the recording (1 = real time,
+    N = N times faster, 0 = as fast as possible).  In 'inproc' mode
+    datagrams are handed straight to the client's receive step; in 'mcast' mode they
+    are sent to the capture's group/port on the loopback interface and
+    picked up by a listening client.  The ingest queue statistics give
+    the per-stage and end-to-end latency for the run.
+    """
+
+    def __init__(self, reader, client, queue, loop, speed=1.0, mode='inproc', reporters=()):
+        self.reader = reader
+        self.reporters = reporters
+        self.client = client
+        self.queue = queue
+        self.loop = loop
+        self.speed = speed
+        self.mode = mode
+        self.sent = 0
+        self.t_start = None
+        self.t_end = None
+        if mode == 'mcast':
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            self.dest = (reader.group, reader.port)
+        elif mode != 'inproc':
+            raise ValueError("Unknown replay mode '%s'" % mode)
+
+    def _send(self, data):
+        if self.mode == 'mcast':
+            self.sock.sendto(data, self.dest)
+        else:
+            self.client.datagram_received(data, None)
+        self.sent += 1
+
+    def start(self):
+        self.t_start = self.loop.time()
+        self._records = iter(self.reader)
+        self._t0 = None
+        self._next()
+
+    def _next(self):
+        # Send everything that is due, then sleep until the next record
+        for timestamp, data in self._records:
+            if self._t0 is None:
+                self._t0 = timestamp
+            if self.speed > 0:
+                when = self.t_start + (timestamp - self._t0) / self.speed
+                if when > self.loop.time():
+                    self.loop.call_at(when, self._send_and_continue, data)
+                    return
+            self._send(data)
+            if self.mode == 'mcast' and self.sent % 64 == 0:
+                # Let the listening client drain its socket
+                self.loop.call_soon(self._next)
+                return
+        self._wait_done()
+
+    def _send_and_continue(self, data):
+        self._send(data)
+        self._next()
+
+    def _wait_done(self, last=None, t_last=None):
+        # Finish once every datagram is accounted for, or (in mcast mode,
+        # where the kernel may drop some) once nothing has moved for 2 s.
+        handled = self._handled()
+        now = self.loop.time()
+        if handled != last:
+            last, t_last = handled, now
+        if handled >= self.sent or now - t_last > 2.0:
+            self.t_end = t_last
+            self.loop.stop()
+        else:
+            self.loop.call_later(0.01, self._wait_done, last, t_last)
+
+    def _handled(self):
+        stats = self.queue.stats
+        handled = stats.processed + stats.errors + stats.dropped
+        if self.client.sequencer is not None:
+            handled += self.client.sequencer.duplicates
+        # Documents the client did not admit never reach the queue
+        prefilter = getattr(self.client, 'prefilter', None)
+        if prefilter is not None:
+            handled += prefilter.rejected
+        coalescer = getattr(self.client, 'coalescer', None)
+        if coalescer is not None:
+            handled += coalescer.coalesced
+        return handled
+
+    def report(self):
+        elapsed = (self.t_end or self.loop.time()) - self.t_start
+        lines = ['replayed %i datagrams in %.3f s (%.1f docs/s, speed %s, mode %s)' % (self.sent,
+                 elapsed, self.sent / elapsed if elapsed > 0 else 0.0,
+                 '%gx' % self.speed if self.speed > 0 else 'max', self.mode)]
+        lost = self.sent - self._handled()
+        if lost > 0:
+            lines.append('%i datagrams never reached the ingest queue' % lost)
+        lines.extend(ingest.report_lines(self.queue, self.reporters))
+        return lines
+
+
+def record(filename, duration=None, group=None, port=None):
+    """Record the obsdoc stream to filename until ctrl-c or duration s."""
+    loop = eventloop.get_event_loop()
+    group = group or mcaf_library.ObsdocClient.group
+    port = port or mcaf_library.ObsdocClient.port
+    writer = CaptureWriter(filename, group, port)
+    client = mcaf_library.McastClient(group, port, 'obsdoc', loop=loop, recorder=writer)
+    if duration:
+        loop.call_later(duration, loop.stop)
+    logger.info('Recording %s:%i to %s' % (group, port, filename))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    client.close()
+    writer.close()
+    logger.info('Recorded %i datagrams' % len(writer))
+
+
+def replay(filename, speed=1.0, mode='inproc', intent='', project='', dispatch=False, workers=1, ring=False, parser='full',
+           seq_window=1024, reorder_hold=0.0, trace_log=None, coalesce=True):
+    """Replay filename through an FRBController and report the run.
+    With trace_log the per-stage latencies of every document are
+    appended to that file."""
+    import dispatcher
+    tracer = dispatcher.fcn_trace.Tracer(trace_log, 'dispatcher') if trace_log else None
+    reader = CaptureReader(filename)
+    loop = eventloop.get_event_loop()
+    if ring:
+        queue = ingest.RingIngestQueue(nslots=max(len(reader), 1))
+    else:
+        queue = ingest.IngestQueue(maxsize=max(len(reader), 1))
+    pool = ingest.IngestWorkers(queue, nworkers=workers)
+    pool.start()
+    controller = dispatcher.FRBController(intent=intent, project=project, dispatch=dispatch)
+    reporters = []
+    prefilter = None
+    if intent or project:
+        prefilter = obsdoc_prefilter.ObsdocPrefilter(intent=intent, project=project)
+        reporters.append(prefilter)
+    sequencer = None
+    if seq_window > 0:
+        sequencer = obsdoc_sequence.SequenceTracker(window=seq_window, hold=reorder_hold, loop=loop)
+        reporters.append(sequencer)
+    coalescer = None
+    if coalesce:
+        coalescer = obsdoc_coalesce.ScanCoalescer()
+        reporters.append(coalescer)
+    client = mcaf_library.ObsdocClient(controller, loop=loop, ingest=queue, listen=(mode == 'mcast'),
+                                       parser=parser, prefilter=prefilter, sequencer=sequencer, tracer=tracer,
+                                       coalescer=coalescer)
+    replayer = Replayer(reader, client, queue, loop, speed=speed, mode=mode, reporters=reporters)
+    loop.call_soon(replayer.start)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    pool.stop(timeout=5.0)
+    client.close()
+    reader.close()
+    if tracer is not None:
+        tracer.close()
+    return replayer.report()
+
+
+if __name__ == '__main__':
+    cmdline = OptionParser(usage="%prog record FILE [options]\n       %prog replay FILE [options]")
+    cmdline.add_option('-t', '--duration', dest="duration",
+        action="store", type="float", default=None,
+        help="[None] record: stop after this many seconds")
+    cmdline.add_option('-s', '--speed', dest="speed",
+        action="store", default="1",
+        help="[1] replay: speed factor, or 'max'")
+    cmdline.add_option('-m', '--mode', dest="mode",
+        action="store", default="inproc",
+        help="[inproc] replay: 'inproc' or 'mcast' (loopback multicast)")
+    cmdline.add_option('-i', '--intent', dest="intent",
+        action="store", default="",
+        help="[] replay: trigger on what intent substring?")
+    cmdline.add_option('-p', '--project', dest="project",
+        action="store", default="",
+        help="[] replay: trigger on what project substring?")
+    cmdline.add_option('-d', '--dispatch', dest="dispatch",
+        action="store_true", default=False,
+        help="[False] replay: actually queue dispatch commands")
+    cmdline.add_option('-w', '--workers', dest="workers",
+        action="store", type="int", default=1,
+        help="[1] replay: number of parse/dispatch worker threads")
+    cmdline.add_option('--ring', dest="ring",
+        action="store_true", default=False,
+        help="[False] replay: use the recv_into slot ring")
+    cmdline.add_option('--parser', dest="parser",
+        action="store", default="full", choices=sorted(mcaf_library.obsdoc_parsers),
+        help="[full] replay: obsdoc parser, 'full' or 'fast'")
+    cmdline.add_option('--no-coalesce', dest="coalesce",
+        action="store_false", default=True,
+        help="[False] replay: pass every subscan on instead of only scan changes")
+    cmdline.add_option('--seq-window', dest="seq_window",
+        action="store", type="int", default=1024,
+        help="[1024] replay: duplicate-detection window per subarray (0 = no sequence tracking)")
+    cmdline.add_option('--reorder-hold', dest="reorder_hold",
+        action="store", type="float", default=0.0,
+        help="[0] replay: seconds to hold documents waiting for a seq gap to fill")
+    cmdline.add_option('--trace-log', dest="trace_log",
+        action="store", default=None,
+        help="[None] replay: append per-stage latency traces to this file")
+    cmdline.add_option('-v', '--verbose', dest="verbose",
+        action="store_true", default=False,
+        help="[False] Log every obsdoc during replay")
+    (opt,args) = cmdline.parse_args()
+
+    if len(args) != 2 or args[0] not in ('record', 'replay'):
+        cmdline.error("need 'record FILE' or 'replay FILE'")
+
+    if args[0] == 'record':
+        record(args[1], duration=opt.duration)
+    else:
+        if not opt.verbose:
+            logging.getLogger('mcaf_library').setLevel(logging.WARNING)
+            logging.getLogger('dispatcher').setLevel(logging.WARNING)
+            logging.getLogger('obsdoc_sequence').setLevel(logging.WARNING)
+        speed = 0.0 if opt.speed == 'max' else float(opt.speed)
+        for line in replay(args[1], speed=speed, mode=opt.mode, intent=opt.intent, project=opt.project,
+                           dispatch=opt.dispatch, workers=opt.workers, ring=opt.ring, parser=opt.parser,
+                           seq_window=opt.seq_window, reorder_hold=opt.reorder_hold, trace_log=opt.trace_log,
+                           coalesce=opt.coalesce):
+            logger.info(line)
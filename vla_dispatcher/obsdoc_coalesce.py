@@ -0,0 +1,79 @@
+"""
+Subscan coalescing for obsdoc datagrams.
+
+The VLA sends an obsdoc for every subscan, but FRBController only acts
+on scans: a new scan, a change of source or position within a scan,
+or the FINISH document at the end of a project.  ScanCoalescer keeps
+the last (scanNo, source, RA, Dec, scan intent) seen per project and
+drops any document that repeats it, so redundant subscans never reach
+the parser, the controller or the log.
+
+Like ObsdocPrefilter it reads the fields straight out of the raw
+datagram with compiled regular expressions.  Documents where a field
+cannot be found are passed through, and so is every FINISH document.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+_dataset_re = re.compile(r'''\bdataset(?:ID|Id)\s*=\s*["']([^"']*)["']''')
+_scan_re = re.compile(r'''<(?:\w+:)?scanNo>\s*([^<\s]*)''')
+_name_re = re.compile(r'''<(?:\w+:)?name>([^<]*)<''')
+_ra_re = re.compile(r'''<(?:\w+:)?ra>\s*([^<\s]*)''')
+_dec_re = re.compile(r'''<(?:\w+:)?dec>\s*([^<\s]*)''')
+_scan_intent_re = re.compile(r'''<(?:\w+:)?intent>\s*ScanIntent\s*=\s*(?:"|'|&quot;|&apos;)?([^<"'&]*)''')
+
+
+class ScanCoalescer(object):
+    """Passes only the obsdocs that change a project's scan state.
+
+    State is kept for the max_projects most recently seen projects.
+    """
+
+    def __init__(self, max_projects=1024):
+        self.max_projects = max_projects
+        self.seen = 0
+        self.passed = 0
+        self.coalesced = 0
+        self.finish = 0
+        self.unparsed = 0
+        self._state = OrderedDict()
+        self._lock = threading.Lock()
+
+    def accept(self, data):
+        """Return False if data repeats the current scan state."""
+        fields = []
+        for regex in (_dataset_re, _scan_re, _name_re, _ra_re, _dec_re, _scan_intent_re):
+            m = regex.search(data)
+            if m is None:
+                break
+            fields.append(m.group(1))
+
+        with self._lock:
+            self.seen += 1
+            if len(fields) < 6:
+                self.unparsed += 1
+                self.passed += 1
+                return True
+            project = fields[0]
+            state = tuple(fields[1:])
+            if fields[2].strip() in 'FINISH':
+                # FINISH always goes through; the project's next scan is new
+                self._state.pop(project, None)
+                self.finish += 1
+                self.passed += 1
+                return True
+            if self._state.get(project) == state:
+                self.coalesced += 1
+                return False
+            self._state.pop(project, None)
+            self._state[project] = state
+            if len(self._state) > self.max_projects:
+                self._state.popitem(last=False)
+            self.passed += 1
+        return True
+
+    def summary(self):
+        return ['coalesce seen=%i passed=%i coalesced=%i finish=%i unparsed=%i projects=%i' % (self.seen,
+                self.passed, self.coalesced, self.finish, self.unparsed, len(self._state))]
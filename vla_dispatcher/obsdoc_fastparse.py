@@ -0,0 +1,155 @@
+#!/usr/bin/env python2.7
+#
+# Fast-path obsdoc parser.
+#
+"""
+Single-pass obsdoc parser that skips the generateDS object build.
+
+obsdocxml_parser.parseString walks every element through
+Observation.build/buildAttributes/buildChildren.  The dispatcher only
+needs the handful of fields MCAST_Config reads, so this parser makes
+one pass over the root element using a tag -> (field, converter)
+table and constructs the Observation directly.  The result is an
+ordinary obsdocxml_parser.Observation; sslo entries are left for it to
+decode lazily and the ephemeris subtree is not decoded at all (it is
+left as None).
+
+Run as a script to compare the two parsers on a document or capture:
+
+  obsdoc_fastparse.py [-n N] FILE
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+import obsdocxml_parser
+from obsdocxml_parser import Observation, parsexmlstring_, raise_parse_error, sslo_raw_
+
+
+# Observation children: local tag -> (field, converter).  Converter
+# None means keep the text; fields in _list_fields are repeated.
+_child_table = {
+    'name': ('name', None),
+    'ra': ('ra', float),
+    'dec': ('dec', float),
+    'dra': ('dra', float),
+    'ddec': ('ddec', float),
+    'azoffs': ('azoffs', float),
+    'eloffs': ('eloffs', float),
+    'startLST': ('startLST', float),
+    'intent': ('intent', None),
+    'state': ('state', int),
+    'scanNo': ('scanNo', int),
+    'subscanNo': ('subscanNo', int),
+    'correlator': ('correlator', None),
+}
+_list_fields = ('intent',)
+_attributes = ('subarrayId', 'seq', 'configUrl', 'datasetID', 'startTime', 'configId', 'datasetId')
+
+# Fully qualified tag -> local tag, filled in as namespaces are seen
+_tag_cache = {}
+
+
+def _local(tag):
+    try:
+        return _tag_cache[tag]
+    except KeyError:
+        local = tag.rpartition('}')[2]
+        _tag_cache[tag] = local
+        return local
+
+
+def parseString(inString):
+    """Parse an obsdoc string or buffer into an Observation."""
+    root = parsexmlstring_(inString)
+    attrib = root.attrib
+    kwargs = {'intent': []}
+    sslo = []
+    for key in _attributes:
+        value = attrib.get(key)
+        if value is not None:
+            kwargs[key] = value
+
+    table = _child_table
+    for child in root:
+        tag = _local(child.tag)
+        try:
+            field, convert = table[tag]
+        except KeyError:
+            if tag == 'sslo':
+                sslo.append(sslo_raw_(child))
+            elif tag == 'modifier':
+                kwargs.setdefault('modifier', []).append(child.text)
+            continue
+        value = child.text
+        if convert is not None:
+            try:
+                value = convert(value)
+            except (TypeError, ValueError), exp:
+                raise_parse_error(child, 'requires %s: %s' % (convert.__name__, exp))
+        if field in _list_fields:
+            kwargs[field].append(value)
+        else:
+            kwargs[field] = value
+
+    try:
+        obs = Observation(**kwargs)
+    except ValueError, exp:
+        raise_parse_error(root, 'Bad attribute: %s' % exp)
+    if sslo:
+        obs.defer_sslo(sslo)
+    return obs
+
+
+def _summary(obs):
+    """Fields MCAST_Config relies on, for checking the two parsers agree."""
+    return (obs.subarrayId, obs.seq, obs.datasetID, obs.datasetId, obs.configId, obs.startTime,
+            obs.name, obs.ra, obs.dec, obs.startLST, obs.intent, obs.scanNo, obs.subscanNo,
+            [(s.IFid, s.freq, s.Sideband, s.Receiver) for s in obs.sslo])
+
+
+def _load_documents(filename):
+    with open(filename, 'rb') as fh:
+        head = fh.read(8)
+    if head == 'MCAFCAP1':
+        import obsdoc_capture
+        reader = obsdoc_capture.CaptureReader(filename)
+        docs = [data for timestamp, data in reader]
+        reader.close()
+        return docs
+    with open(filename, 'rb') as fh:
+        return [fh.read()]
+
+
+def benchmark(docs, repeat=1000):
+    """Return per-document seconds for (full parser, fast parser)."""
+    results = []
+    for parse in (obsdocxml_parser.parseString, parseString):
+        t0 = time.time()
+        for i in xrange(repeat):
+            for doc in docs:
+                parse(doc)
+        results.append((time.time() - t0) / (repeat * len(docs)))
+    return tuple(results)
+
+
+if __name__ == '__main__':
+    cmdline = OptionParser(usage="%prog [options] FILE (obsdoc XML or capture)")
+    cmdline.add_option('-n', '--repeat', dest="repeat",
+        action="store", type="int", default=1000,
+        help="[1000] Number of passes over the documents")
+    (opt,args) = cmdline.parse_args()
+    if len(args) != 1:
+        cmdline.error("need one obsdoc or capture file")
+
+    docs = _load_documents(args[0])
+    for doc in docs:
+        if _summary(obsdocxml_parser.parseString(doc)) != _summary(parseString(doc)):
+            print "Parsers disagree on document:\n%s" % doc
+            sys.exit(1)
+    full, fast = benchmark(docs, repeat=opt.repeat)
+    print "%i document(s) x %i passes" % (len(docs), opt.repeat)
+    print "generateDS parser: %8.1f us/doc" % (1e6*full)
+    print "fast parser:       %8.1f us/doc" % (1e6*fast)
+    print "speedup:           %8.2fx" % (full/fast)
@@ -0,0 +1,70 @@
+"""
+Early-reject prefilter for obsdoc datagrams.
+
+FRBController discards most documents on its intent/project check,
+but only after the full Observation has been built and every intent
+run through MCAST_Config.parse_intents.  ObsdocPrefilter pulls the
+datasetId/datasetID attribute and the ScanIntent intent straight out
+of the raw datagram (string or buffer) with two compiled regular
+expressions and applies the same substring test, so non-matching
+documents are dropped before any XML parsing.
+
+Documents where either field cannot be found are passed through for
+the full parser to decide.
+"""
+
+import re
+import threading
+
+_dataset_re = re.compile(r'''\bdataset(?:ID|Id)\s*=\s*["']([^"']*)["']''')
+_scan_intent_re = re.compile(r'''<(?:\w+:)?intent>\s*ScanIntent\s*=\s*(?:"|'|&quot;|&apos;)?([^<"'&]*)''')
+
+
+class ObsdocPrefilter(object):
+    """Substring filter on project and scan intent applied to raw bytes.
+
+    An empty intent or project matches everything, as in FRBController.
+    """
+
+    def __init__(self, intent='', project=''):
+        self.intent = intent
+        self.project = project
+        self.seen = 0
+        self.passed = 0
+        self.rejected_project = 0
+        self.rejected_intent = 0
+        self.unparsed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def rejected(self):
+        return self.rejected_project + self.rejected_intent
+
+    def accept(self, data):
+        """Return False if data can be dropped without parsing."""
+        project = intent = None
+        if self.project:
+            m = _dataset_re.search(data)
+            if m is not None:
+                project = m.group(1)
+        if self.intent:
+            m = _scan_intent_re.search(data)
+            if m is not None:
+                intent = m.group(1)
+
+        with self._lock:
+            self.seen += 1
+            if project is not None and self.project not in project:
+                self.rejected_project += 1
+                return False
+            if intent is not None and self.intent not in intent:
+                self.rejected_intent += 1
+                return False
+            if (self.project and project is None) or (self.intent and intent is None):
+                self.unparsed += 1
+            self.passed += 1
+        return True
+
+    def summary(self):
+        return ['prefilter seen=%i passed=%i rejected=%i (project=%i intent=%i) unparsed=%i' % (self.seen,
+                self.passed, self.rejected, self.rejected_project, self.rejected_intent, self.unparsed)]
@@ -0,0 +1,196 @@
+"""
+Sequence-number tracking for the obsdoc stream.
+
+MCAF is multicast UDP, so obsdocs can arrive twice or out of order.
+Every document carries a per-subarray seq attribute.  SequenceTracker
+reads seq and subarrayId from the raw datagram in the receiver stage,
+drops duplicates, and counts gaps and late (reordered) arrivals.
+
+Duplicate detection is O(1): per subarray it keeps the highest seq
+seen and a bitmask of which of the preceding window numbers have
+arrived.  A seq that falls more than window behind is taken as a
+restart of the numbering.
+
+With hold > 0, a document that arrives ahead of a gap is held for up
+to hold seconds waiting for the missing ones, and documents are then
+released in sequence order.  This needs the event loop for its timer.
+"""
+
+import re
+import logging
+
+from eventloop import monotonic
+
+logger = logging.getLogger(__name__)
+
+_seq_re = re.compile(r'''\bseq\s*=\s*["'](\d+)["']''')
+_subarray_re = re.compile(r'''\bsubarrayId\s*=\s*["']([^"']*)["']''')
+
+ACCEPT = 'accept'
+DROP = 'drop'
+HOLD = 'hold'
+
+
+class _Stream(object):
+    """Sequence state for one subarray."""
+
+    __slots__ = ('highest', 'mask', 'pending', 'timer')
+
+    def __init__(self, seq):
+        self.highest = seq
+        self.mask = 1
+        self.pending = {}
+        self.timer = None
+
+
+class SequenceTracker(object):
+    """Per-subarray duplicate, gap and reorder tracking.
+
+    observe() returns ACCEPT (forward the datagram now), DROP
+    (duplicate) or HOLD (the tracker took a copy and passes it to
+    deliver(data, received) itself, in order).  When a datagram fills a
+    gap it is delivered together with the held ones that follow it, so
+    data is never forwarded by both the caller and the tracker.
+    received is the monotonic time a held datagram arrived, or None if
+    it is delivered as it arrives.
+    """
+
+    def __init__(self, window=1024, hold=0.0, loop=None):
+        if hold > 0 and loop is None:
+            raise ValueError("A reorder hold needs an event loop")
+        self.window = window
+        self.hold = hold
+        self.loop = loop
+        self._full = (1 << window) - 1
+        self.streams = {}
+        self.seen = 0
+        self.duplicates = 0
+        self.gaps = 0
+        self.missing = 0
+        self.reordered = 0
+        self.held = 0
+        self.resets = 0
+        self.unsequenced = 0
+
+    def _advance(self, stream, seq):
+        shift = seq - stream.highest
+        if shift >= self.window:
+            # Nothing in the window survives; do not build a huge int
+            stream.mask = 1
+        else:
+            stream.mask = ((stream.mask << shift) | 1) & self._full
+        stream.highest = seq
+
+    def observe(self, data, deliver=None):
+        m = _seq_re.search(data)
+        if m is None:
+            self.unsequenced += 1
+            return ACCEPT
+        seq = int(m.group(1))
+        m = _subarray_re.search(data)
+        subarray = m.group(1) if m is not None else ''
+        self.seen += 1
+
+        stream = self.streams.get(subarray)
+        if stream is None:
+            self.streams[subarray] = _Stream(seq)
+            return ACCEPT
+
+        ahead = seq - stream.highest
+        if ahead == 1:
+            self._advance(stream, seq)
+            if not stream.pending:
+                return ACCEPT
+            deliver(str(data), None)
+            self._release_consecutive(stream, deliver)
+            return HOLD
+
+        if ahead > 1:
+            if self.hold > 0 and deliver is not None:
+                if seq in stream.pending:
+                    self.duplicates += 1
+                    return DROP
+                stream.pending[seq] = (str(data), monotonic())
+                self.held += 1
+                if stream.timer is None:
+                    stream.timer = self.loop.call_later(self.hold, self._expire, subarray, deliver)
+                return HOLD
+            self._gap(subarray, stream, seq)
+            self._advance(stream, seq)
+            return ACCEPT
+
+        back = -ahead
+        if back >= self.window:
+            logger.info("seq on subarray '%s' went from %i back to %i; assuming a restart" % (subarray,
+                        stream.highest, seq))
+            self.resets += 1
+            self.streams[subarray] = _Stream(seq)
+            if not stream.pending:
+                return ACCEPT
+            data = str(data)
+            self._flush(subarray, stream, deliver)
+            deliver(data, None)
+            return HOLD
+        bit = 1 << back
+        if stream.mask & bit:
+            self.duplicates += 1
+            return DROP
+        stream.mask |= bit
+        self.reordered += 1
+        if self.missing > 0:
+            self.missing -= 1
+        return ACCEPT
+
+    def forget(self, data):
+        """Clear the seen mark of a datagram that was accepted or
+        delivered but then lost downstream, so that a retransmission of
+        it is taken rather than dropped as a duplicate."""
+        m = _seq_re.search(data)
+        if m is None:
+            return
+        seq = int(m.group(1))
+        m = _subarray_re.search(data)
+        stream = self.streams.get(m.group(1) if m is not None else '')
+        if stream is None:
+            return
+        back = stream.highest - seq
+        if 0 <= back < self.window:
+            stream.mask &= ~(1 << back)
+
+    def _gap(self, subarray, stream, seq):
+        self.gaps += 1
+        self.missing += seq - stream.highest - 1
+        logger.info("seq gap on subarray '%s': expected %i, got %i" % (subarray, stream.highest + 1, seq))
+
+    def _release_consecutive(self, stream, deliver):
+        while stream.highest + 1 in stream.pending:
+            data, received = stream.pending.pop(stream.highest + 1)
+            self._advance(stream, stream.highest + 1)
+            deliver(data, received)
+        if not stream.pending and stream.timer is not None:
+            stream.timer.cancel()
+            stream.timer = None
+
+    def _flush(self, subarray, stream, deliver):
+        # Give up on the gap: release everything held, in order
+        for seq in sorted(stream.pending):
+            if seq > stream.highest + 1:
+                self._gap(subarray, stream, seq)
+            self._advance(stream, seq)
+            deliver(*stream.pending[seq])
+        stream.pending.clear()
+        if stream.timer is not None:
+            stream.timer.cancel()
+            stream.timer = None
+
+    def _expire(self, subarray, deliver):
+        stream = self.streams.get(subarray)
+        if stream is not None:
+            stream.timer = None
+            self._flush(subarray, stream, deliver)
+
+    def summary(self):
+        seen = float(max(self.seen, 1))
+        return ['sequence seen=%i duplicates=%i (%.2f%%) gaps=%i missing=%i (%.2f%%) reordered=%i held=%i resets=%i unsequenced=%i' % (
+                self.seen, self.duplicates, 100*self.duplicates/seen, self.gaps, self.missing,
+                100*self.missing/(seen + self.missing), self.reordered, self.held, self.resets, self.unsequenced)]
@@ -61,6 +61,17 @@ def parsexml_(*args, **kwargs):
     doc = etree_.parse(*args, **kwargs)
     return doc
 
+def parsexmlstring_(inString):
+    # Parse straight from a string or read-only buffer (such as a view
+    # into an ingest ring slot) and return the root element.
+    if XMLParser_import_library == XMLParser_import_lxml:
+        if not isinstance(inString, basestring):
+            inString = str(inString)
+        return etree_.fromstring(inString, parser=etree_.ETCompatXMLParser())
+    parser = etree_.XMLParser()
+    parser.feed(inString)
+    return parser.close()
+
 #
 # User methods
 #
@@ -73,6 +84,7 @@ try:
 except ImportError, exp:
 
     class GeneratedsSuper(object):
+        __slots__ = ()
         def gds_format_string(self, input_data, input_name=''):
             return input_data
         def gds_validate_string(self, input_data, node, input_name=''):
@@ -366,6 +378,14 @@ def _cast(typ, value):
 class Observation(GeneratedsSuper):
     subclass = None
     superclass = None
+    # Compact representation: no per-instance __dict__.  The rarely used
+    # ephemeris and sslo subtrees are kept undecoded (the serialized
+    # ephemeris element, raw sslo attribute tuples) until first accessed,
+    # so nothing holds on to the parsed document.
+    __slots__ = ('subarrayId', 'seq', 'configUrl', 'datasetID', 'startTime', 'configId', 'datasetId',
+                 'name', 'ra', 'dec', 'dra', 'ddec', '_ephemeris', '_ephemeris_raw', 'azoffs', 'eloffs',
+                 'startLST', 'intent', 'state', 'scanNo', 'subscanNo', '_modifier', 'correlator',
+                 '_sslo', '_sslo_raw')
     def __init__(self, subarrayId=None, seq=None, configUrl=None, datasetID=None, startTime=None, configId=None, datasetId=None, name=None, ra=None, dec=None, dra=None, ddec=None, ephemeris=None, azoffs=None, eloffs=None, startLST=None, intent=None, state=None, scanNo=None, subscanNo=None, modifier=None, correlator=None, sslo=None):
         self.subarrayId = _cast(None, subarrayId)
         self.seq = _cast(int, seq)
@@ -379,7 +399,8 @@ class Observation(GeneratedsSuper):
         self.dec = dec
         self.dra = dra
         self.ddec = ddec
-        self.ephemeris = ephemeris
+        self._ephemeris_raw = None
+        self._ephemeris = ephemeris
         self.azoffs = azoffs
         self.eloffs = eloffs
         self.startLST = startLST
@@ -390,15 +411,48 @@ class Observation(GeneratedsSuper):
         self.state = state
         self.scanNo = scanNo
         self.subscanNo = subscanNo
-        if modifier is None:
-            self.modifier = []
-        else:
-            self.modifier = modifier
+        self._modifier = modifier
         self.correlator = correlator
-        if sslo is None:
-            self.sslo = []
-        else:
-            self.sslo = sslo
+        self._sslo_raw = None
+        self._sslo = sslo
+    def _get_ephemeris(self):
+        if self._ephemeris_raw is not None:
+            obj_ = ephemerisType.factory()
+            obj_.build(parsexmlstring_(self._ephemeris_raw))
+            self._ephemeris = obj_
+            self._ephemeris_raw = None
+        return self._ephemeris
+    def _set_ephemeris(self, ephemeris):
+        self._ephemeris = ephemeris
+        self._ephemeris_raw = None
+    ephemeris = property(_get_ephemeris, _set_ephemeris)
+    def _get_modifier(self):
+        if self._modifier is None:
+            self._modifier = []
+        return self._modifier
+    def _set_modifier(self, modifier): self._modifier = modifier
+    modifier = property(_get_modifier, _set_modifier)
+    def _get_sslo(self):
+        if self._sslo is None:
+            self._sslo = []
+            if self._sslo_raw is not None:
+                for SolarCal, IFid, Sideband, Receiver, freq in self._sslo_raw:
+                    try:
+                        freq = _cast(float, freq)
+                    except ValueError, exp:
+                        raise ValueError('Bad float/double sslo freq: %s' % exp)
+                    self._sslo.append(ssloType.factory(SolarCal=SolarCal, IFid=IFid, Sideband=Sideband, Receiver=Receiver, freq=freq))
+                self._sslo_raw = None
+        return self._sslo
+    def _set_sslo(self, sslo):
+        self._sslo = sslo
+        self._sslo_raw = None
+    sslo = property(_get_sslo, _set_sslo)
+    def defer_sslo(self, raw):
+        """Store sslo entries as (SolarCal, IFid, Sideband, Receiver, freq)
+        string tuples, to be decoded into ssloType on first access."""
+        self._sslo = None
+        self._sslo_raw = list(raw)
     def factory(*args_, **kwargs_):
         if Observation.subclass:
             return Observation.subclass(*args_, **kwargs_)
@@ -745,9 +799,9 @@ class Observation(GeneratedsSuper):
             fval_ = self.gds_validate_float(fval_, node, 'ddec')
             self.ddec = fval_
         elif nodeName_ == 'ephemeris':
-            obj_ = ephemerisType.factory()
-            obj_.build(child_)
-            self.set_ephemeris(obj_)
+            # Decoded on first access to self.ephemeris
+            self._ephemeris = None
+            self._ephemeris_raw = ephemeris_raw_(child_)
         elif nodeName_ == 'azoffs':
             sval_ = child_.text
             try:
@@ -809,15 +863,17 @@ class Observation(GeneratedsSuper):
             correlator_ = self.gds_validate_string(correlator_, node, 'correlator')
             self.correlator = correlator_
         elif nodeName_ == 'sslo':
-            obj_ = ssloType.factory()
-            obj_.build(child_)
-            self.sslo.append(obj_)
+            # Decoded on first access to self.sslo
+            if self._sslo_raw is None:
+                self.defer_sslo([])
+            self._sslo_raw.append(sslo_raw_(child_))
 # end class Observation
 
 
 class polyType(GeneratedsSuper):
     subclass = None
     superclass = None
+    __slots__ = ('coeff',)
     def __init__(self, coeff=None):
         if coeff is None:
             self.coeff = []
@@ -895,6 +951,7 @@ class polyType(GeneratedsSuper):
 class ephemerisType(GeneratedsSuper):
     subclass = None
     superclass = None
+    __slots__ = ('referenceTime', 'ra_polynomial', 'dec_polynomial', 'dist_polynomial', 'origin')
     def __init__(self, referenceTime=None, ra_polynomial=None, dec_polynomial=None, dist_polynomial=None, origin=None):
         self.referenceTime = referenceTime
         self.ra_polynomial = ra_polynomial
@@ -1025,6 +1082,7 @@ class ephemerisType(GeneratedsSuper):
 class ssloType(GeneratedsSuper):
     subclass = None
     superclass = None
+    __slots__ = ('SolarCal', 'IFid', 'Sideband', 'Receiver', 'freq')
     def __init__(self, SolarCal=None, IFid=None, Sideband=None, Receiver=None, freq=None):
         self.SolarCal = _cast(int, SolarCal)
         self.IFid = _cast(None, IFid)
@@ -1149,9 +1207,26 @@ class ssloType(GeneratedsSuper):
 # end class ssloType
 
 
+def ephemeris_raw_(node):
+    # Detached copy of the ephemeris element, as kept by Observation
+    if XMLParser_import_library == XMLParser_import_lxml:
+        return etree_.tostring(node, with_tail=False)
+    return etree_.tostring(node)
+
+
+def sslo_raw_(node):
+    # Undecoded sslo entry, as stored by Observation.defer_sslo
+    freq = None
+    for child in node:
+        if Tag_pattern_.match(child.tag).groups()[-1] == 'freq':
+            freq = child.text
+    return (node.get('SolarCal'), node.get('IFid'), node.get('Sideband'), node.get('Receiver'), freq)
+
+
 class coeffType(GeneratedsSuper):
     subclass = None
     superclass = None
+    __slots__ = ('order', 'valueOf_')
     def __init__(self, order=None, valueOf_=None):
         self.order = _cast(int, order)
         self.valueOf_ = valueOf_
@@ -1256,9 +1331,7 @@ def parse(inFileName):
 
 
 def parseString(inString):
-    from StringIO import StringIO
-    doc = parsexml_(StringIO(inString))
-    rootNode = doc.getroot()
+    rootNode = parsexmlstring_(inString)
     rootTag, rootClass = get_root_tag(rootNode)
     if rootClass is None:
         rootTag = 'Observation'
@@ -1266,7 +1339,7 @@ def parseString(inString):
     rootObj = rootClass.factory()
     rootObj.build(rootNode)
     # Enable Python to collect the space used by the DOM.
-    doc = None
+    rootNode = None
 ##     sys.stdout.write('<?xml version="1.0" ?>\n')
 ##     rootObj.export(sys.stdout, 0, name_="Observation",
 ##         namespacedef_='')
@@ -0,0 +1,128 @@
+"""
+Timer buckets for large numbers of long, mostly cancelled timers.
+
+The dispatcher keeps a deadline for every session it has started and
+cancels it when the FINISH obsdoc arrives.  TimerWheel puts each timer
+in a bucket keyed by its expiry tick, so cancelling is O(1) whatever
+the number of timers, and keeps a heap of the bucket ticks.  Only one
+loop.call_at is ever pending, for the earliest non-empty bucket, so
+the loop sleeps until a timer is actually due instead of waking every
+tick.  When there are no timers nothing is scheduled on the event loop.
+
+schedule() and Timer.cancel() may be called from any thread (the
+controller runs on the ingest workers); callbacks run on the loop
+thread.  Expiry has the resolution of one tick, and a timer never
+fires early.
+"""
+
+import heapq
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """A scheduled callback.  cancel() is O(1) and may be called twice."""
+
+    __slots__ = ('wheel', 'expires', 'callback', 'args')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+
+    @property
+    def when(self):
+        """Loop time the timer fires at (to within a tick)."""
+        return self.wheel._start + self.expires * self.wheel.tick
+
+    def cancel(self):
+        self.wheel._cancel(self)
+
+
+class TimerWheel(object):
+    """Timers on loop (an eventloop.EventLoop) with tick seconds of
+    resolution.  Timers due in the same tick share a bucket and are
+    run by one loop callback."""
+
+    def __init__(self, loop, tick=1.0):
+        self.loop = loop
+        self.tick = tick
+        self._buckets = {}
+        self._ticks = []
+        self._count = 0
+        self._start = loop.time()
+        self._armed = None
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) on the loop thread after delay seconds."""
+        with self._lock:
+            elapsed = self.loop.time() - self._start + max(0.0, delay)
+            expires = int(-(-elapsed // self.tick))
+            bucket = self._buckets.get(expires)
+            if bucket is None:
+                bucket = self._buckets[expires] = set()
+                heapq.heappush(self._ticks, expires)
+            timer = Timer(self, expires, callback, args)
+            bucket.add(timer)
+            self._count += 1
+            rearm = self._armed is None or expires < self._armed
+            if rearm:
+                self._armed = expires
+        if rearm:
+            self.loop.call_soon_threadsafe(self._arm)
+        return timer
+
+    def _cancel(self, timer):
+        with self._lock:
+            bucket = self._buckets.get(timer.expires)
+            if bucket is not None and timer in bucket:
+                bucket.remove(timer)
+                self._count -= 1
+                # Its heap entry is skipped when the wheel is next armed
+                if not bucket:
+                    del self._buckets[timer.expires]
+            timer.callback = timer.args = None
+
+    def _arm(self):
+        # Runs on the loop thread: replace the pending call_at with one
+        # for the earliest non-empty bucket
+        with self._lock:
+            while self._ticks and self._ticks[0] not in self._buckets:
+                heapq.heappop(self._ticks)
+            if self._ticks:
+                self._armed = self._ticks[0]
+                when = self._start + self._armed * self.tick
+            else:
+                self._armed = when = None
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if when is not None:
+            self._handle = self.loop.call_at(when, self._expire)
+
+    def _expire(self):
+        self._handle = None
+        with self._lock:
+            now = self.loop.time()
+            due = []
+            while self._ticks and self._start + self._ticks[0] * self.tick <= now:
+                bucket = self._buckets.pop(heapq.heappop(self._ticks), None)
+                if bucket:
+                    due.extend(bucket)
+            self._count -= len(due)
+        for timer in due:
+            callback, args = timer.callback, timer.args
+            timer.callback = timer.args = None
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('error in timer callback %r' % (callback,))
+        self._arm()
@@ -0,0 +1,249 @@
+"""
+Indexed trigger rules for FRBController.
+
+A rules file lists any number of subscriptions (campaigns), one
+ConfigParser section each:
+
+  [frb121102]
+  projects = 16A-459, TRSR      ; project ID prefixes
+  intents = OBSERVE_TARGET      ; scan intents (exact, any of)
+  sources = FRB121102           ; source names (exact, any of)
+  region = 82.99 33.15 1.5      ; RA, Dec and radius in degrees
+
+Every key is optional; a missing key matches anything.  RuleSet
+compiles the rules into indexes (a grid of sky cells for the regions,
+dictionaries on source and intent, and a prefix trie on the project
+ID).  Each rule is indexed on its most selective field only, so a
+lookup yields the few rules that could apply and only those are
+checked in full; the cost of a match depends on how many rules could
+apply, not on how many are loaded.
+
+RuleSet.watch() rereads the file whenever its modification time
+changes; a file that fails to parse leaves the previous rules in force.
+"""
+
+import os
+import math
+import logging
+import ConfigParser
+
+logger = logging.getLogger(__name__)
+
+# Size in degrees of the sky cells used by the region index
+CELL_DEG = 1.0
+
+
+class Rule(object):
+    """One subscription.  Empty tuples and region None match anything."""
+
+    __slots__ = ('name', 'projects', 'intents', 'sources', 'region')
+
+    def __init__(self, name, projects=(), intents=(), sources=(), region=None):
+        self.name = name
+        self.projects = tuple(projects)
+        self.intents = tuple(intents)
+        self.sources = tuple(sources)
+        self.region = region
+
+    def __repr__(self):
+        return 'Rule(%r)' % self.name
+
+    def matches(self, projectID, intents, source, ra, dec):
+        """Full check of one document; intents is a set of scan intents."""
+        if self.projects and not projectID.startswith(self.projects):
+            return False
+        if self.intents and intents.isdisjoint(self.intents):
+            return False
+        if self.sources and source not in self.sources:
+            return False
+        if self.region is not None and not self.contains(ra, dec):
+            return False
+        return True
+
+    def contains(self, ra, dec):
+        """True if (ra, dec) in degrees is inside the rule's region."""
+        ra0, dec0, radius = self.region
+        return angular_separation(ra, dec, ra0, dec0) <= radius
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """Great-circle distance in degrees (haversine)."""
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    h = math.sin((dec2 - dec1)/2)**2 + math.cos(dec1)*math.cos(dec2)*math.sin((ra2 - ra1)/2)**2
+    return math.degrees(2*math.asin(min(1.0, math.sqrt(h))))
+
+
+class PrefixTrie(object):
+    """Character trie mapping prefixes to sets of rule indices."""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(value)
+
+    def lookup(self, key):
+        """Union of the values of every prefix of key."""
+        found = set()
+        node = self.root
+        if None in node:
+            found |= node[None]
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found |= node[None]
+        return found
+
+
+class SkyGrid(object):
+    """Rule indices bucketed by the CELL_DEG cells their regions touch."""
+
+    def __init__(self, cell=CELL_DEG):
+        self.cell = cell
+        self.nra = int(round(360.0 / cell))
+        self.cells = {}
+
+    def _key(self, ra, dec):
+        return (int(math.floor((ra % 360.0) / self.cell)) % self.nra, int(math.floor(dec / self.cell)))
+
+    def add(self, region, value):
+        ra, dec, radius = region
+        dec_lo = max(-90.0, dec - radius)
+        dec_hi = min(90.0, dec + radius)
+        # Widest RA extent of the circle over its Dec range
+        cosdec = min(math.cos(math.radians(dec_lo)), math.cos(math.radians(dec_hi)))
+        if dec_hi >= 90.0 or dec_lo <= -90.0 or cosdec <= 0 or radius / cosdec >= 180.0:
+            ra_cells = range(self.nra)
+        else:
+            half = radius / cosdec
+            first = int(math.floor((ra - half) / self.cell))
+            last = int(math.floor((ra + half) / self.cell))
+            ra_cells = set(i % self.nra for i in xrange(first, last + 1))
+        for j in xrange(int(math.floor(dec_lo / self.cell)), int(math.floor(dec_hi / self.cell)) + 1):
+            for i in ra_cells:
+                self.cells.setdefault((i, j), set()).add(value)
+
+    def lookup(self, ra, dec):
+        return self.cells.get(self._key(ra, dec), set())
+
+
+class RuleSet(object):
+    """Compiled, hot-reloadable set of Rules."""
+
+    def __init__(self, rules=(), filename=None):
+        self.filename = filename
+        self._mtime = None
+        self.compile(rules)
+
+    @classmethod
+    def from_file(cls, filename):
+        ruleset = cls(filename=filename)
+        ruleset.reload()
+        return ruleset
+
+    def compile(self, rules):
+        rules = list(rules)
+        projects, intents, sources, regions = PrefixTrie(), {}, {}, SkyGrid()
+        unconstrained = []
+        for index, rule in enumerate(rules):
+            # Index each rule once, on its most selective field; match()
+            # checks the other fields on the few candidates found
+            if rule.region is not None:
+                regions.add(rule.region, index)
+            elif rule.sources:
+                for source in rule.sources:
+                    sources.setdefault(source, set()).add(index)
+            elif rule.projects:
+                for prefix in rule.projects:
+                    projects.add(prefix, index)
+            elif rule.intents:
+                for intent in rule.intents:
+                    intents.setdefault(intent, set()).add(index)
+            else:
+                unconstrained.append(index)
+        # Swap in the new indexes in one assignment so a concurrent
+        # match() sees either the old or the new rules
+        self._index = (rules, projects, intents, sources, regions, unconstrained)
+
+    @property
+    def rules(self):
+        return self._index[0]
+
+    def __len__(self):
+        return len(self._index[0])
+
+    def match(self, projectID, scan_intent, source, ra_deg, dec_deg):
+        """Return the rules matching a document, in file order."""
+        rules, projects, intents, sources, regions, unconstrained = self._index
+        if not rules:
+            return []
+        projectID = projectID or ''
+        tokens = set(intent.strip() for intent in (scan_intent or '').split(','))
+        candidates = set(unconstrained)
+        candidates |= regions.lookup(ra_deg, dec_deg)
+        candidates |= sources.get(source, frozenset())
+        candidates |= projects.lookup(projectID)
+        for intent in tokens:
+            candidates |= intents.get(intent, frozenset())
+        return [rules[i] for i in sorted(candidates) if rules[i].matches(projectID, tokens, source, ra_deg, dec_deg)]
+
+    def match_config(self, config):
+        """match() on a mcaf_library.MCAST_Config."""
+        return self.match(config.projectID, config.scan_intent, config.source, config.ra_deg, config.dec_deg)
+
+    def reload(self):
+        """Reread the rules file.  Returns True if the rules changed."""
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError as exp:
+            logger.warning('Cannot read rules file %s: %s' % (self.filename, exp))
+            return False
+        if mtime == self._mtime:
+            return False
+        try:
+            rules = read_rules(self.filename)
+        except (ConfigParser.Error, ValueError) as exp:
+            logger.error('Keeping previous rules; cannot parse %s: %s' % (self.filename, exp))
+            self._mtime = mtime
+            return False
+        self.compile(rules)
+        self._mtime = mtime
+        logger.info('Loaded %i trigger rule(s) from %s' % (len(rules), self.filename))
+        return True
+
+    def watch(self, loop, interval=5.0):
+        """Check the rules file for changes every interval seconds."""
+        self.reload()
+        loop.call_later(interval, self.watch, loop, interval)
+
+
+def _split(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def read_rules(filename):
+    """Parse a rules file into a list of Rules."""
+    parser = ConfigParser.RawConfigParser()
+    with open(filename) as fh:
+        parser.readfp(fh)
+    rules = []
+    for name in parser.sections():
+        options = dict(parser.items(name))
+        region = None
+        if 'region' in options:
+            try:
+                ra, dec, radius = [float(x) for x in options['region'].split()]
+            except ValueError:
+                raise ValueError("[%s] region should be 'RA Dec radius' in degrees" % name)
+            region = (ra, dec, radius)
+        unknown = set(options) - set(['projects', 'intents', 'sources', 'region'])
+        if unknown:
+            raise ValueError('[%s] unknown key(s) %s' % (name, ', '.join(sorted(unknown))))
+        rules.append(Rule(name, _split(options.get('projects', '')), _split(options.get('intents', '')),
+                          _split(options.get('sources', '')), region))
+    return rules
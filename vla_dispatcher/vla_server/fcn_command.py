@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Command channel between the dispatcher (or queueFCNCommand.py) and
+fcn_server.py.
+
+Commands are single text lines in the incoming.cmd format:
+
+  EventType EventSN EventTime EventRA EventDec [EventDuration|EventDM] [project=ID] [trace=ID]
+
+and are sent over a Unix-domain stream socket.  The server answers each
+line as soon as the command is queued with 'OK <command number>' or
+'ERR <reason>', so producers get an acknowledgement without waiting
+for the notifications to go out and can send commands back-to-back.
+Once started, the server accepts and acknowledges commands on a thread
+of its own, so a producer is answered even while a burst of
+notifications is going out.
+When the producer runs in the same process as the server,
+LocalCommandClient hands commands straight to the CommandServer.
+
+Producers that cannot reach the server drop commands into a
+CommandSpool directory instead: each command is written to a hidden
+temporary file and renamed to a sequence-numbered .cmd file, so the
+server never sees a partial command and producers never wait.  The
+server drains every spooled command in order on each pass.
+
+A command line is never sent twice: once it has been written to the
+socket the server may have queued it, so a missing acknowledgement is
+reported with CommandUnknown instead of being retried or spooled.
+"""
+
+import os
+import errno
+import fcntl
+import socket
+import select
+import logging
+import threading
+from collections import deque
+
+from fcn_trace import monotonic
+from fcn_packet import notificationEventTypes
+
+__all__ = ['CommandError', 'CommandUnknown', 'formatCommand', 'parseCommand', 'CommandServer', 'CommandClient',
+		 'LocalCommandClient', 'CommandSpool', 'DEFAULT_SOCKET', 'DEFAULT_SPOOL', 'ACK_TIMEOUT']
+
+
+DEFAULT_SOCKET = 'fcn_server.sock'
+DEFAULT_SPOOL = 'incoming.spool'
+
+# Seconds to wait for an acknowledgement.  fcn_server answers from its
+# own thread as soon as a line arrives, independent of any sends, so
+# this only has to cover a stalled server.
+ACK_TIMEOUT = 5.0
+
+
+class CommandError(Exception):
+	"""
+	Raised when a command cannot be delivered or is rejected by the server.
+	"""
+
+	pass
+
+
+class CommandUnknown(CommandError):
+	"""
+	Raised when a command was sent but not acknowledged.  The server may
+	or may not have queued it, so it must not be sent again.
+	"""
+
+	pass
+
+
+def formatCommand(eventType, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None, project=None,
+				trace=None):
+	"""
+	Return the text line for a command.  project is only used by
+	fcn_server.py to route the event to the clients subscribed to it, and
+	trace to carry on the fcn_trace trace of the command.
+	"""
+
+	line = "%s %i %f %f %f" % (eventType, eventSN, eventTime, eventRA, eventDec)
+	if eventDuration is not None:
+		line += " %f" % eventDuration
+	if eventDM is not None:
+		line += " %f" % eventDM
+	if project:
+		line += " project=%s" % project
+	if trace:
+		line += " trace=%s" % trace
+	return line
+
+
+def parseCommand(data):
+	"""
+	Parse a command line into a dictionary of sendNotification() arguments
+	plus eventProject and eventTrace (None if not given).  Raises ValueError
+	if the command is malformed or its event type is unknown.
+	"""
+
+	fields = []
+	options = {}
+	for field in data.split():
+		key, sep, value = field.partition('=')
+		if sep:
+			options[key] = value
+		else:
+			fields.append(field)
+	unknown = set(options) - set(['project', 'trace'])
+	if unknown:
+		raise ValueError("Unknown option(s) %s" % ', '.join(sorted(unknown)))
+	if len(fields) < 5:
+		raise ValueError("Expected at least 5 fields, got %i" % len(fields))
+	command = {}
+	command['eventType'] = fields[0].upper()
+	if command['eventType'] not in notificationEventTypes:
+		raise ValueError("Unknown event type '%s'" % fields[0])
+	command['eventSN'] = int(fields[1], 10)
+	command['eventTime'] = float(fields[2])
+	command['eventRA'] = float(fields[3])
+	command['eventDec'] = float(fields[4])
+	command['eventDuration'] = None
+	command['eventDM'] = None
+	if command['eventType'] == 'VLA_FRB_SESSION':
+		command['eventDuration'] = float(fields[5])
+	if command['eventType'] == 'VLA_FRB_TRIGGER':
+		command['eventDM'] = float(fields[5])
+	command['eventProject'] = options.get('project')
+	command['eventTrace'] = options.get('trace')
+	return command
+
+
+class CommandServer(object):
+	"""
+	Listening side of the command channel.  Call poll() from the server's
+	main loop; it waits up to timeout seconds for socket activity,
+	acknowledges any complete command lines and queues them for next().
+	After start() the sockets are served by a thread instead, and poll()
+	only waits for commands to be queued.
+	"""
+
+	def __init__(self, path=DEFAULT_SOCKET, validate=parseCommand):
+		self.path = path
+		self.validate = validate
+		self.count = 0
+		self.rejected = 0
+		self.pending = deque()
+		self._clients = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._closing = False
+		self._wakeRead = self._wakeWrite = None
+
+		# Remove a socket left behind by an earlier server
+		try:
+			os.unlink(path)
+		except OSError as err:
+			if err.errno != errno.ENOENT:
+				raise
+		self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._listener.bind(path)
+		self._listener.listen(8)
+		self._listener.setblocking(0)
+
+	def sockets(self):
+		"""
+		Return the sockets to watch for readability.
+		"""
+
+		return [self._listener,] + list(self._clients)
+
+	def start(self):
+		"""
+		Accept and acknowledge commands on a thread of their own.
+		"""
+
+		self._wakeRead, self._wakeWrite = os.pipe()
+		for fd in (self._wakeRead, self._wakeWrite):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self._thread = threading.Thread(target=self._serve, name='command-server')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def _serve(self):
+		while not self._closing:
+			try:
+				readable, writable, errored = select.select(self.sockets(), [], [], 0.5)
+			except select.error as err:
+				if err.args[0] == errno.EINTR:
+					continue
+				raise
+			for sock in readable:
+				self.handleReadable(sock)
+
+	def submit(self, line):
+		"""
+		Validate and queue one command line.  Returns the reply line.  The
+		queued command records when it was queued as eventQueued (monotonic).
+		"""
+
+		try:
+			command = self.validate(line)
+		except (ValueError, IndexError) as err:
+			logging.getLogger(__name__).warning("Rejected command '%s': %s", line, str(err))
+			with self._lock:
+				self.rejected += 1
+			return 'ERR %s' % str(err)
+		command['eventQueued'] = monotonic()
+		with self._lock:
+			self.count += 1
+			number = self.count
+			self.pending.append(command)
+		if self._wakeWrite is not None:
+			try:
+				os.write(self._wakeWrite, 'c')
+			except OSError as err:
+				# Already full, so poll() will wake anyway
+				if err.errno != errno.EAGAIN:
+					raise
+		return 'OK %i' % number
+
+	def poll(self, timeout=None, extra=()):
+		"""
+		Wait up to timeout seconds for activity and handle it.  extra lists
+		other objects with a fileno() to wait on; those that are readable
+		are returned for the caller to handle.
+		"""
+
+		if self._thread is not None:
+			sockets = [self._wakeRead,]
+		else:
+			sockets = self.sockets()
+		try:
+			readable, writable, errored = select.select(sockets + list(extra), [], [], timeout)
+		except select.error as err:
+			if err.args[0] == errno.EINTR:
+				return []
+			raise
+		ready = []
+		for sock in readable:
+			if sock in extra:
+				ready.append(sock)
+			elif sock == self._wakeRead:
+				try:
+					os.read(self._wakeRead, 4096)
+				except OSError:
+					pass
+			else:
+				self.handleReadable(sock)
+		return ready
+
+	def handleReadable(self, sock):
+		if sock is self._listener:
+			try:
+				client, addr = self._listener.accept()
+			except socket.error:
+				return
+			client.setblocking(1)
+			self._clients[client] = ''
+			return
+
+		try:
+			data = sock.recv(4096)
+		except socket.error:
+			data = ''
+		if not data:
+			self._drop(sock)
+			return
+		buf = self._clients[sock] + data
+		while '\n' in buf:
+			line, buf = buf.split('\n', 1)
+			if line.strip():
+				try:
+					sock.sendall(self.submit(line.strip()) + '\n')
+				except socket.error:
+					self._drop(sock)
+					return
+		self._clients[sock] = buf
+
+	def next(self):
+		"""
+		Return the oldest queued command, or None.
+		"""
+
+		try:
+			return self.pending.popleft()
+		except IndexError:
+			return None
+
+	def _drop(self, sock):
+		sock.close()
+		del self._clients[sock]
+
+	def close(self):
+		if self._thread is not None:
+			self._closing = True
+			self._thread.join()
+			self._thread = None
+			os.close(self._wakeRead)
+			os.close(self._wakeWrite)
+			self._wakeRead = self._wakeWrite = None
+		for sock in list(self._clients):
+			self._drop(sock)
+		self._listener.close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+
+class CommandClient(object):
+	"""
+	Producer side of the command channel.  The connection is opened on
+	first use and kept open.  A connection found broken while sending is
+	reopened once, but only before the line has been written.
+	"""
+
+	def __init__(self, path=DEFAULT_SOCKET, timeout=ACK_TIMEOUT):
+		self.path = path
+		self.timeout = timeout
+		self._sock = None
+		self._buf = ''
+
+	def available(self):
+		"""
+		Return True if a server socket exists at path.
+		"""
+
+		return os.path.exists(self.path)
+
+	def _connect(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(self.timeout)
+		sock.connect(self.path)
+		self._sock = sock
+		self._buf = ''
+
+	def _write(self, line):
+		if self._sock is None:
+			self._connect()
+		self._sock.sendall(line + '\n')
+
+	def _reply(self):
+		while '\n' not in self._buf:
+			data = self._sock.recv(4096)
+			if not data:
+				raise socket.error(errno.ECONNRESET, 'Server closed the connection')
+			self._buf += data
+		reply, self._buf = self._buf.split('\n', 1)
+		return reply
+
+	def send(self, line):
+		"""
+		Send one command line and return its command number once the server
+		has acknowledged it.  Raises CommandError if the server cannot be
+		reached or rejects the command, and CommandUnknown if the line was
+		sent but no acknowledgement came back.
+		"""
+
+		for attempt in (1, 2):
+			try:
+				self._write(line)
+				break
+			except socket.error as err:
+				# The server only queues complete lines, so nothing was queued
+				self.close()
+				if attempt == 2:
+					raise CommandError("Cannot reach fcn_server at '%s': %s" % (self.path, str(err)))
+		try:
+			reply = self._reply()
+		except socket.error as err:
+			self.close()
+			raise CommandUnknown("No acknowledgement from fcn_server for '%s', it may have been queued: %s" % (line, str(err)))
+		status, _, detail = reply.partition(' ')
+		if status != 'OK':
+			raise CommandError("fcn_server rejected '%s': %s" % (line, detail))
+		return int(detail)
+
+	def close(self):
+		if self._sock is not None:
+			self._sock.close()
+			self._sock = None
+
+
+class LocalCommandClient(object):
+	"""
+	CommandClient stand-in for a producer running in the same process as
+	the CommandServer; commands are queued directly.
+	"""
+
+	def __init__(self, server):
+		self.server = server
+
+	def available(self):
+		return True
+
+	def send(self, line):
+		status, _, detail = self.server.submit(line).partition(' ')
+		if status != 'OK':
+			raise CommandError("fcn_server rejected '%s': %s" % (line, detail))
+		return int(detail)
+
+	def close(self):
+		pass
+
+
+class CommandSpool(object):
+	"""
+	Spool directory of command files, one command per file.  File names
+	are <sequence, hex>-<pid>.cmd so sorting them gives the order the
+	commands were spooled in.  The sequence is one past the highest
+	spooled command and is taken with the directory's .lock file held
+	until the command is in place, so it holds across processes and
+	does not depend on the clock.
+	"""
+
+	def __init__(self, path=DEFAULT_SPOOL):
+		self.path = path
+		try:
+			os.makedirs(path)
+		except OSError as err:
+			if err.errno != errno.EEXIST:
+				raise
+
+	def put(self, line):
+		"""
+		Atomically add a command to the spool.  Returns the file name.
+		"""
+
+		lockfd = os.open(os.path.join(self.path, '.lock'), os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			fcntl.flock(lockfd, fcntl.LOCK_EX)
+			seq = 0
+			for name in self.pending():
+				try:
+					seq = max(seq, int(name.split('-', 1)[0], 16))
+				except ValueError:
+					pass
+			name = '%016x-%08i.cmd' % (seq + 1, os.getpid())
+			tmpname = os.path.join(self.path, '.' + name)
+			fh = open(tmpname, 'w')
+			fh.write(line + '\n')
+			fh.flush()
+			os.fsync(fh.fileno())
+			fh.close()
+			os.rename(tmpname, os.path.join(self.path, name))
+		finally:
+			os.close(lockfd)
+		return name
+
+	def pending(self):
+		"""
+		Return the names of the spooled commands, oldest first.
+		"""
+
+		return sorted(name for name in os.listdir(self.path) if name.endswith('.cmd') and not name.startswith('.'))
+
+	def drain(self):
+		"""
+		Remove and return every spooled command line, oldest first.
+		"""
+
+		lines = []
+		for name in self.pending():
+			filename = os.path.join(self.path, name)
+			try:
+				fh = open(filename, 'r')
+				data = fh.read()
+				fh.close()
+				os.unlink(filename)
+			except (IOError, OSError) as err:
+				logging.getLogger(__name__).warning("Cannot read spooled command '%s': %s", name, str(err))
+				continue
+			if data.strip():
+				lines.append(data.strip())
+		return lines
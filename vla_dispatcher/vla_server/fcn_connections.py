@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Connections from fcn_server.py to its clients.
+
+A ConnectionManager owns one TCP connection per client and keeps it
+up from a background thread.  A client that cannot be reached, or
+whose connection fails or is closed by the client, is marked down
+and reconnected after a jittered, exponentially growing delay (base
+seconds, doubling per failed attempt up to cap).  Idle connections
+are watched so a client going away is noticed before the next event
+is sent to it.
+
+The event path only uses connections that are already up: checkout()
+hands one over (or returns None if the client is down) and release()
+gives it back, or reports why it failed.
+
+  connections = ConnectionManager([('127.0.0.1', 5000),]).start()
+  sock = connections.checkout(('127.0.0.1', 5000))
+  ...
+  connections.release(('127.0.0.1', 5000), sock)
+"""
+
+import os
+import time
+import errno
+import random
+import select
+import socket
+import logging
+import threading
+
+import fcn_metrics
+from fcn_trace import monotonic
+
+__all__ = ['CONNECT_TIMEOUT', 'ConnectionManager']
+
+
+# Seconds a client gets to accept a connection
+CONNECT_TIMEOUT = 5.0
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Client(object):
+	"""
+	Connection state of one client: 'down' (waiting to retry), 'connecting',
+	'up' (idle) or 'busy' (checked out).
+	"""
+
+	def __init__(self, address):
+		self.address = address
+		self.host = '%s:%i' % address
+		self.state = 'down'
+		self.sock = None
+		self.attempts = 0
+		self.retryAt = 0.0
+		self.deadline = 0.0
+		self.everUp = False
+		self.tried = False
+
+
+class ConnectionManager(object):
+	"""
+	Background connection keeper for a list of (ip, port) client
+	addresses.  Connection counts and client states go into registry (a
+	fcn_metrics.Registry).
+	"""
+
+	def __init__(self, addresses=(), timeout=CONNECT_TIMEOUT, base=0.5, cap=60.0, registry=fcn_metrics.REGISTRY):
+		self.timeout = timeout
+		self.base = base
+		self.cap = cap
+		self.registry = registry
+		self._clients = {}
+		self._lock = threading.Lock()
+		self._cond = threading.Condition(self._lock)
+		self._wakeRead, self._wakeWrite = os.pipe()
+		self._closed = False
+		self._thread = None
+		for address in addresses:
+			self.add(address)
+
+	def add(self, address):
+		"""
+		Start keeping a connection to address up.
+		"""
+
+		with self._lock:
+			if address in self._clients:
+				return
+			client = _Client(address)
+			self._clients[address] = client
+			self.registry.gauge('fcn_host_up', 'Whether the connection to each client is up', host=client.host)
+		self._wake()
+
+	def start(self):
+		self._thread = threading.Thread(target=self._run, name='connections')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def close(self):
+		"""
+		Stop the thread and close every connection.
+		"""
+
+		with self._lock:
+			self._closed = True
+		self._wake()
+		if self._thread is not None:
+			self._thread.join()
+		with self._lock:
+			for client in self._clients.values():
+				if client.sock is not None:
+					client.sock.close()
+					client.sock = None
+				client.state = 'down'
+		os.close(self._wakeRead)
+		os.close(self._wakeWrite)
+
+	def waitReady(self, addresses=None, timeout=None):
+		"""
+		Wait until every client (or those in addresses) has had its first
+		connection attempt.  Returns the number of them that are up.
+		"""
+
+		with self._cond:
+			clients = [self._clients[address] for address in (addresses or self._clients)]
+			tEnd = None if timeout is None else monotonic() + timeout
+			while not all(client.tried for client in clients):
+				remaining = None if tEnd is None else tEnd - monotonic()
+				if remaining is not None and remaining <= 0:
+					break
+				self._cond.wait(remaining)
+			return len([client for client in clients if client.state in ('up', 'busy')])
+
+	def known(self, address):
+		with self._lock:
+			return address in self._clients
+
+	def isUp(self, address):
+		with self._lock:
+			client = self._clients.get(address)
+			return client is not None and client.state in ('up', 'busy')
+
+	def up(self):
+		"""
+		Return the number of clients that are connected.
+		"""
+
+		with self._lock:
+			return len([client for client in self._clients.values() if client.state in ('up', 'busy')])
+
+	def checkout(self, address):
+		"""
+		Return the connected socket for address for the caller's exclusive
+		use, or None if the client is not up (or already checked out).
+		"""
+
+		with self._lock:
+			client = self._clients.get(address)
+			if client is None or client.state != 'up':
+				return None
+			client.state = 'busy'
+		# Stop watching it for reads
+		self._wake()
+		return client.sock
+
+	def release(self, address, sock, error=None, close=False):
+		"""
+		Give back a socket from checkout().  With an error (the reason the
+		connection failed) the client is marked down and reconnected after a
+		backoff; with close the connection is closed and reopened after base
+		seconds.
+		"""
+
+		with self._lock:
+			client = self._clients.get(address)
+			if client is None or client.sock is not sock:
+				sock.close()
+				return
+			if error is not None:
+				self._down(client, error)
+			elif close:
+				self._disconnect(client)
+				client.attempts = 0
+				client.retryAt = monotonic() + self.base
+			else:
+				client.state = 'up'
+		self._wake()
+
+	def _wake(self):
+		try:
+			os.write(self._wakeWrite, 'x')
+		except OSError:
+			pass
+
+	def _setUp(self, client, value):
+		self.registry.gauge('fcn_host_up', host=client.host).set(value)
+
+	def _disconnect(self, client):
+		if client.sock is not None:
+			client.sock.close()
+			client.sock = None
+		client.state = 'down'
+		self._setUp(client, 0)
+
+	def _down(self, client, error):
+		"""
+		Close the connection to a client and schedule the next attempt.
+		"""
+
+		wasUp = client.state in ('up', 'busy')
+		self._disconnect(client)
+		if wasUp:
+			logger.warning('Client %s is down: %s', client.host, str(error))
+			client.attempts = 0
+		elif client.attempts == 0:
+			logger.warning('Cannot connect to %s: %s', client.host, str(error))
+		else:
+			logger.debug('Cannot connect to %s (attempt %i): %s', client.host, client.attempts + 1, str(error))
+
+		delay = min(self.cap, self.base * 2**client.attempts)
+		client.retryAt = monotonic() + delay/2 + random.uniform(0, delay/2)
+		client.attempts += 1
+		client.tried = True
+		self._cond.notify_all()
+
+	def _connect(self, client):
+		try:
+			client.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			client.sock.setblocking(0)
+			# Packets are pipelined; do not hold them back waiting for acks
+			client.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			client.state = 'connecting'
+			client.deadline = monotonic() + self.timeout
+			code = client.sock.connect_ex(client.address)
+		except socket.error as err:
+			# Out of file descriptors, for example
+			self.registry.counter('fcn_connect_failures_total', 'Failed connection attempts to each client', host=client.host).inc()
+			self._down(client, err)
+			return
+		if code == 0:
+			self._connected(client)
+		elif code not in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+			self.registry.counter('fcn_connect_failures_total', 'Failed connection attempts to each client', host=client.host).inc()
+			self._down(client, socket.error(code, os.strerror(code)))
+
+	def _connected(self, client):
+		client.state = 'up'
+		client.attempts = 0
+		client.tried = True
+		self._setUp(client, 1)
+		self.registry.counter('fcn_connects_total', 'TCP connections opened to each client', host=client.host).inc()
+		if client.everUp:
+			self.registry.counter('fcn_reconnects_total', 'Connections reopened after a failure or KILL', host=client.host).inc()
+			logger.info('Client %s is up again', client.host)
+		else:
+			logger.info('Connected to client %s', client.host)
+		client.everUp = True
+		self._cond.notify_all()
+
+	def _run(self):
+		"""
+		Body of the background thread.  An error in one pass is logged and
+		the next pass starts over, so the thread only ends on close().
+		"""
+
+		try:
+			while True:
+				try:
+					if not self._step():
+						return
+				except Exception:
+					logger.exception('Error in the connection manager, carrying on')
+					with self._lock:
+						if self._closed:
+							return
+					time.sleep(self.base)
+		finally:
+			logger.debug('Connection manager thread stopped')
+
+	def _step(self):
+		"""
+		Start and finish connection attempts and watch idle connections
+		until something happens.  Returns False once closed.
+		"""
+
+		# The sockets to watch are a snapshot taken under the lock
+		with self._lock:
+			if self._closed:
+				return False
+			now = monotonic()
+			wakeAt = now + 60.0
+			readers = {self._wakeRead: None}
+			writers = {}
+			for client in self._clients.values():
+				if client.state == 'down' and client.retryAt <= now:
+					self._connect(client)
+				elif client.state == 'connecting' and client.deadline <= now:
+					self.registry.counter('fcn_connect_failures_total', 'Failed connection attempts to each client', host=client.host).inc()
+					self._down(client, socket.timeout('timed out'))
+
+				if client.state == 'down':
+					wakeAt = min(wakeAt, client.retryAt)
+				elif client.state == 'connecting':
+					wakeAt = min(wakeAt, client.deadline)
+					writers[client.sock] = client
+				elif client.state == 'up':
+					readers[client.sock] = client
+
+		try:
+			readable, writable, errored = select.select(list(readers), list(writers), [], max(0.0, wakeAt - now))
+		except (select.error, socket.error) as err:
+			# A socket closed by release() since the snapshot was taken gives
+			# EBADF; take a new snapshot
+			if err.args[0] in (errno.EINTR, errno.EBADF):
+				return True
+			raise
+
+		with self._lock:
+			for sock in writable:
+				client = writers[sock]
+				if client.state != 'connecting' or client.sock is not sock:
+					continue
+				code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if code == 0:
+					self._connected(client)
+				else:
+					self.registry.counter('fcn_connect_failures_total', 'Failed connection attempts to each client', host=client.host).inc()
+					self._down(client, socket.error(code, os.strerror(code)))
+
+			for sock in readable:
+				if sock == self._wakeRead:
+					os.read(self._wakeRead, 4096)
+					continue
+				client = readers[sock]
+				if client.state != 'up' or client.sock is not sock:
+					continue
+				# An idle connection only becomes readable if the client
+				# closed it or sent something stray
+				try:
+					data = sock.recv(4096)
+				except socket.error as err:
+					if err.errno in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+						continue
+					self._down(client, err)
+					continue
+				if not data:
+					self._down(client, 'connection closed by the client')
+		return True
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Client list and per-client subscription filters for fcn_server.py.
+
+Each non-comment line of hosts.cfg names a client and, optionally, what
+it wants to receive:
+
+  IP PORT [key=value ...]
+
+with the keys
+
+  types=T1,T2       event types (e.g. VLA_FRB_SESSION,VLA_FRB_TRIGGER)
+  ra=LO:HI          RA window in degrees; LO > HI wraps through 0
+  dec=LO:HI         declination window in degrees
+  site=LAT,LON      client site latitude and east longitude in degrees
+  minel=DEG         minimum elevation of the event at the site
+  projects=P1,P2    project ID prefixes
+
+A line without keys receives everything, as before.  IAMALIVE and KILL
+always go to every client.  The STOP of a session (negative duration)
+goes to the clients its START went to, so a source setting below minel
+does not leave a client observing.  Sessions are told apart by serial
+number and project; a STOP whose START is not remembered (after a
+restart, say) goes to every client subscribed to sessions.
+
+RoutingTable groups the clients by event type once, when hosts.cfg is
+read, so routing an event only looks at the clients subscribed to its
+type and only evaluates the filters of those that have any.
+"""
+
+import math
+import time
+import logging
+from collections import OrderedDict
+
+__all__ = ['HostFilter', 'RoutingTable', 'readHosts', 'CONTROL_TYPES']
+
+
+# Event types that every client gets
+CONTROL_TYPES = ('IAMALIVE', 'KILL')
+
+# Number of session STARTs to remember the destinations of
+MAX_SESSIONS = 1024
+
+
+def _range(value):
+	lo, hi = value.split(':', 1)
+	return (float(lo), float(hi))
+
+
+def _list(value):
+	return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def elevation(ra, dec, unixTime, lat, lon):
+	"""
+	Return the elevation in degrees of (ra, dec) (degrees, J2000.0) seen
+	from latitude lat and east longitude lon at unixTime.  Precession is
+	ignored, which is plenty for a horizon cut.
+	"""
+
+	jd = unixTime / 86400.0 + 2440587.5
+	gmst = (280.46061837 + 360.98564736629*(jd - 2451545.0)) % 360.0
+	ha = math.radians(gmst + lon - ra)
+	dec = math.radians(dec)
+	lat = math.radians(lat)
+	sinel = math.sin(dec)*math.sin(lat) + math.cos(dec)*math.cos(lat)*math.cos(ha)
+	return math.degrees(math.asin(max(-1.0, min(1.0, sinel))))
+
+
+class HostFilter(object):
+	"""
+	Subscription of one client.  A None attribute matches anything.
+	"""
+
+	def __init__(self, types=None, ra=None, dec=None, site=None, minel=None, projects=None):
+		if minel is not None and site is None:
+			raise ValueError("minel needs site=LAT,LON")
+		self.types = types
+		self.ra = ra
+		self.dec = dec
+		self.site = site
+		self.minel = minel
+		self.projects = projects
+
+	@classmethod
+	def fromOptions(cls, options):
+		"""
+		Build a filter from a list of key=value strings.
+		"""
+
+		kwds = {}
+		for option in options:
+			key, sep, value = option.partition('=')
+			if not sep:
+				raise ValueError("Expected key=value, got '%s'" % option)
+			if key == 'types':
+				kwds['types'] = tuple(t.upper() for t in _list(value))
+			elif key in ('ra', 'dec'):
+				kwds[key] = _range(value)
+			elif key == 'site':
+				lat, lon = [float(v) for v in value.split(',')]
+				kwds['site'] = (lat, lon)
+			elif key == 'minel':
+				kwds['minel'] = float(value)
+			elif key == 'projects':
+				kwds['projects'] = _list(value)
+			else:
+				raise ValueError("Unknown key '%s'" % key)
+		return cls(**kwds)
+
+	@property
+	def conditional(self):
+		"""
+		True if the filter looks at more than the event type.
+		"""
+
+		return self.ra is not None or self.dec is not None or self.minel is not None or self.projects is not None
+
+	def accepts(self, eventRA, eventDec, eventTime, project=None):
+		if self.ra is not None:
+			lo, hi = self.ra
+			ra = eventRA % 360.0
+			if lo <= hi:
+				if not lo <= ra <= hi:
+					return False
+			elif hi < ra < lo:
+				return False
+		if self.dec is not None:
+			if not self.dec[0] <= eventDec <= self.dec[1]:
+				return False
+		if self.projects is not None:
+			if project is None or not project.startswith(self.projects):
+				return False
+		if self.minel is not None:
+			lat, lon = self.site
+			if elevation(eventRA, eventDec, eventTime or time.time(), lat, lon) < self.minel:
+				return False
+		return True
+
+
+def readHosts(filename):
+	"""
+	Parse a hosts file into a list of ((ip, port), HostFilter) tuples.
+	Lines that cannot be parsed are logged and skipped.
+	"""
+
+	logger = logging.getLogger(__name__)
+	hosts = []
+	with open(filename, 'r') as fh:
+		for line in fh:
+			if line[0] == '#':
+				continue
+			if len(line) < 3:
+				continue
+			try:
+				fields = line.split()
+				ip, port = fields[0], int(fields[1], 10)
+				hosts.append( ((ip,port), HostFilter.fromOptions(fields[2:])) )
+			except Exception as e:
+				logger.warning('WARNING: Cannot parse line \'%s\': %s', line.rstrip(), str(e))
+	return hosts
+
+
+class RoutingTable(object):
+	"""
+	Per event type lists of destinations, built once from the output of
+	readHosts().
+	"""
+
+	def __init__(self, hosts, eventTypes):
+		self.hosts = [dest for dest, hostFilter in hosts]
+		# (eventSN, project) of each remembered session START -> destinations
+		self._sessions = OrderedDict()
+
+		# eventType -> (unconditional destinations, [(destination, filter), ...])
+		self._table = {}
+		for eventType in eventTypes:
+			always, conditional = [], []
+			for dest, hostFilter in hosts:
+				if eventType not in CONTROL_TYPES:
+					if hostFilter.types is not None and eventType not in hostFilter.types:
+						continue
+					if hostFilter.conditional:
+						conditional.append( (dest, hostFilter) )
+						continue
+				always.append(dest)
+			self._table[eventType] = (tuple(always), tuple(conditional))
+
+	def subscribers(self, eventType):
+		"""
+		Return the number of clients that may receive eventType.
+		"""
+
+		always, conditional = self._table.get(eventType, ((), ()))
+		return len(always) + len(conditional)
+
+	def route(self, eventType, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventProject=None, **kwds):
+		"""
+		Return the destinations for an event.  Takes the same keywords as
+		sendNotification() plus the event's project.
+		"""
+
+		try:
+			always, conditional = self._table[eventType]
+		except KeyError:
+			raise ValueError("Unknown event type '%s'" % eventType)
+
+		isSession = (eventType == 'VLA_FRB_SESSION')
+		isStop = isSession and eventDuration is not None and eventDuration < 0
+		if isStop:
+			try:
+				return self._sessions.pop((eventSN, eventProject))
+			except KeyError:
+				# Not knowing where the START went, make sure nobody is left
+				# observing
+				return list(always) + [dest for dest, hostFilter in conditional]
+
+		dests = list(always)
+		for dest, hostFilter in conditional:
+			if hostFilter.accepts(eventRA, eventDec, eventTime, eventProject):
+				dests.append(dest)
+
+		if isSession and not isStop and conditional:
+			self._sessions[(eventSN, eventProject)] = dests
+			if len(self._sessions) > MAX_SESSIONS:
+				self._sessions.popitem(last=False)
+		return dests
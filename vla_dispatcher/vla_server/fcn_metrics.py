@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Metrics registry and HTTP endpoint shared by dispatcher.py,
+fcn_server.py and client_software.py.
+
+Counters and histograms are updated without locks: each thread adds
+into its own cell and a scrape sums the cells, so an update on a hot
+path is a dictionary lookup and an addition.  Values the programs
+already keep (queue depths, ingest statistics, ...) are exposed as
+callback metrics that are only evaluated when scraped.
+
+MetricsServer serves the registry in the Prometheus text format at
+http://HOST:PORT/metrics from a background thread:
+
+  registry = fcn_metrics.REGISTRY
+  sent = registry.counter('fcn_notifications_total', 'Notifications sent', type='TEST')
+  sent.inc()
+  fcn_metrics.MetricsServer(registry, port=9310).start()
+"""
+
+import math
+import thread
+import bisect
+import threading
+import BaseHTTPServer
+import SocketServer
+from collections import OrderedDict
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Summary', 'Registry', 'MetricsServer', 'REGISTRY', 'DEFAULT_BUCKETS']
+
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _formatValue(value):
+	if value == float('inf'):
+		return '+Inf'
+	if isinstance(value, float) and math.isnan(value):
+		return 'NaN'
+	return repr(value) if isinstance(value, float) else str(value)
+
+
+def _formatLabels(labels, extra=()):
+	labels = tuple(labels) + tuple(extra)
+	if not labels:
+		return ''
+	escaped = []
+	for key, value in labels:
+		value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+		escaped.append('%s="%s"' % (key, value))
+	return '{%s}' % ','.join(escaped)
+
+
+class Counter(object):
+	"""
+	Monotonically increasing count.  If func is given the value is
+	func() at scrape time instead.
+	"""
+
+	kind = 'counter'
+
+	def __init__(self, labels=(), func=None):
+		self.labels = labels
+		self.func = func
+		self._cells = {}
+
+	def inc(self, amount=1):
+		try:
+			self._cells[thread.get_ident()][0] += amount
+		except KeyError:
+			self._cells.setdefault(thread.get_ident(), [0])[0] += amount
+
+	@property
+	def value(self):
+		if self.func is not None:
+			return self.func()
+		return sum(cell[0] for cell in self._cells.values())
+
+	def samples(self, name):
+		return [(name, self.labels, self.value)]
+
+
+class Gauge(Counter):
+	"""
+	Value that can go up and down; set() it or give func.
+	"""
+
+	kind = 'gauge'
+
+	def __init__(self, labels=(), func=None):
+		Counter.__init__(self, labels, func)
+		self._value = 0
+
+	def set(self, value):
+		self._value = value
+
+	@property
+	def value(self):
+		if self.func is not None:
+			return self.func()
+		return self._value
+
+
+class Histogram(object):
+	"""
+	Distribution of observed values in cumulative buckets.
+	"""
+
+	kind = 'histogram'
+
+	def __init__(self, labels=(), buckets=DEFAULT_BUCKETS):
+		self.labels = labels
+		self.buckets = tuple(sorted(buckets))
+		self._cells = {}
+
+	def observe(self, value):
+		try:
+			cell = self._cells[thread.get_ident()]
+		except KeyError:
+			# Per bucket counts, then the +Inf count and the sum
+			cell = self._cells.setdefault(thread.get_ident(), [0]*(len(self.buckets) + 1) + [0.0])
+		cell[bisect.bisect_left(self.buckets, value)] += 1
+		cell[-1] += value
+
+	def samples(self, name):
+		totals = [0]*(len(self.buckets) + 2)
+		for cell in self._cells.values():
+			for i, value in enumerate(cell):
+				totals[i] += value
+		samples = []
+		cumulative = 0
+		for bound, count in zip(self.buckets + (float('inf'),), totals[:-1]):
+			cumulative += count
+			samples.append( (name + '_bucket', self.labels + (('le', _formatValue(float(bound))),), cumulative) )
+		samples.append( (name + '_sum', self.labels, totals[-1]) )
+		samples.append( (name + '_count', self.labels, cumulative) )
+		return samples
+
+
+class Summary(object):
+	"""
+	Distribution kept elsewhere: func() returns (count, sum, quantiles)
+	at scrape time, quantiles being a list of (quantile, value) pairs.
+	"""
+
+	kind = 'summary'
+
+	def __init__(self, labels=(), func=None):
+		self.labels = labels
+		self.func = func
+
+	def samples(self, name):
+		count, total, quantiles = self.func()
+		samples = [(name, self.labels + (('quantile', _formatValue(float(q))),), value) for q, value in quantiles]
+		samples.append( (name + '_sum', self.labels, total) )
+		samples.append( (name + '_count', self.labels, count) )
+		return samples
+
+
+class Registry(object):
+	"""
+	Named metric families, each holding one metric per label set.
+	"""
+
+	def __init__(self):
+		self._families = {}
+		self._order = []
+		self._lock = threading.Lock()
+
+	def _get(self, cls, name, help, labels, **kwds):
+		labels = tuple(sorted(labels.items()))
+		with self._lock:
+			try:
+				kind, help, metrics = self._families[name]
+			except KeyError:
+				kind, metrics = cls.kind, OrderedDict()
+				self._families[name] = (kind, help, metrics)
+				self._order.append(name)
+			if kind != cls.kind:
+				raise ValueError("Metric '%s' is a %s, not a %s" % (name, kind, cls.kind))
+			try:
+				return metrics[labels]
+			except KeyError:
+				metric = cls(labels, **kwds)
+				metrics[labels] = metric
+				return metric
+
+	def counter(self, name, help='', func=None, **labels):
+		"""
+		Return the counter name{labels}, creating it if needed.
+		"""
+
+		metric = self._get(Counter, name, help, labels)
+		if func is not None:
+			metric.func = func
+		return metric
+
+	def gauge(self, name, help='', func=None, **labels):
+		metric = self._get(Gauge, name, help, labels)
+		if func is not None:
+			metric.func = func
+		return metric
+
+	def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+		return self._get(Histogram, name, help, labels, buckets=buckets)
+
+	def summary(self, name, help='', func=None, **labels):
+		metric = self._get(Summary, name, help, labels)
+		if func is not None:
+			metric.func = func
+		return metric
+
+	def render(self):
+		"""
+		Return every metric in the Prometheus text exposition format.
+		"""
+
+		with self._lock:
+			families = [(name,) + self._families[name] for name in self._order]
+			families = [(name, kind, help, list(metrics.values())) for name, kind, help, metrics in families]
+		lines = []
+		for name, kind, help, metrics in families:
+			if help:
+				lines.append('# HELP %s %s' % (name, help.replace('\\', '\\\\').replace('\n', '\\n')))
+			lines.append('# TYPE %s %s' % (name, kind))
+			for metric in metrics:
+				try:
+					samples = metric.samples(name)
+				except Exception:
+					continue
+				for sampleName, labels, value in samples:
+					lines.append('%s%s %s' % (sampleName, _formatLabels(labels), _formatValue(value)))
+		return '\n'.join(lines) + '\n'
+
+
+# Registry used by default
+REGISTRY = Registry()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+			self.send_error(404)
+			return
+		body = self.server.registry.render()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class MetricsServer(object):
+	"""
+	HTTP endpoint for a Registry, served from a daemon thread.  Binds to
+	the loopback interface unless told otherwise.
+	"""
+
+	def __init__(self, registry=REGISTRY, port=9310, host='127.0.0.1'):
+		self.registry = registry
+		self._server = _HTTPServer((host, port), _Handler)
+		self._server.registry = registry
+		self.address = self._server.server_address
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._server.serve_forever, name='metrics')
+		self._thread.daemon = True
+		self._thread.start()
+		return self
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
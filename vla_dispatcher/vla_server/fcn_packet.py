@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Binary encoding of VLA/FRB notification packets.
+
+A packet is 40 big-endian 32-bit integers laid out after the GCN packets:
+
+Type:   2            3            4             11                  12
+Loc:    TEST         IMALIVE      KILL          VLA_FRB_SESSION     VLA_FRB_TRIGGER
+
+0      pkt_type     pkt_type     pkt_type       pkt_type            pkt_type
+1      pkt_sernum   pkt_sernum   pkt_sernum     pkt_sernum          pkt_sernum
+2      pkt_hopcnt   pkt_hopcnt   pkt_hopcnt     pkt_hopcnt          pkt_hopcnt
+3      pkt_sod      pkt_sod      pkt_sod        pkt_sod             pkt_sod
+4      trig_num     -            -              session_num         trig_num     (unsigned)
+5      burst_tjd    burst_tjd    burst_tjd      session_tjd         burst_tjd
+6      burst_sod    burst_sod    burst_sod      session_sod         burst_sod
+7      burst_ra     -            -              session_ra          burst_ra
+8      burst_dec    -            -              session_dec         burst_dec
+9      spare        spare        -              session_dur         burst_dm
+10-38  spare        spare        -              spare               spare
+39     pkt_term     pkt_term     pkt_term       pkt_term            pkt_term
+
+Word 4 is unsigned so that the dispatcher's YYMMDDHHMM session numbers
+fit it (up to and including 2042); all other words are signed.
+PacketEncoder keeps a precompiled struct.Struct for each event type
+that packs only the words the type uses; the spares are pad bytes.
+"""
+
+import math
+import time
+import struct
+
+__all__ = ['notificationEventTypes', 'PACKET_SIZE', 'PACKET_TERMINATOR', 'getGCNTime', 'PacketEncoder']
+
+
+# Dictionary that maps event types into their numerical counterparts
+notificationEventTypes = {'TEST': 2,
+					 'IAMALIVE': 3,
+					 'KILL': 4,
+					 'VLA_FRB_SESSION': 11,
+					 'VLA_FRB_TRIGGER': 12, }
+
+
+# Size of a packet in bytes and the value of its last word
+PACKET_SIZE = 4*40
+PACKET_TERMINATOR = 10
+
+
+# The type-specific word 9 of each event type, if any
+_EXTRA_FIELD = {'VLA_FRB_SESSION': 'eventDuration',
+			 'VLA_FRB_TRIGGER': 'eventDM', }
+
+
+def getGCNTime(timestamp=None):
+	"""
+	Convert a UNIX timestamp into a TJD/SoD pair, where the seconds of day
+	are in centi-seconds.
+	"""
+
+	# Is there a time?
+	if timestamp is None:
+		timestamp = time.time()
+
+	# Convert to Julian Day
+	jd = float(timestamp) / 86400.0 + 2440587.5
+
+	# Calculate TJD
+	tjd = int(math.floor(jd - 2440000.5))
+
+	# Calculate the second in the day and convert to centiseconds
+	sod = (timestamp % 86400)
+	sod = int(sod*100)
+
+	return tjd, sod
+
+
+class PacketEncoder(object):
+	"""
+	Encoder for notification packets.  encode() returns one packet as an
+	(immutable) string that can be sent to every client; encodeBatch()
+	packs several events back to back into one buffer.
+	"""
+
+	def __init__(self, eventTypes=notificationEventTypes):
+		self.layouts = {}
+		for name, code in eventTypes.items():
+			extra = _EXTRA_FIELD.get(name, None)
+			nWords = 9 if extra is None else 10
+			layout = struct.Struct('>4lL%il%ixl' % (nWords - 5, 4*(39 - nWords)))
+			assert layout.size == PACKET_SIZE
+			self.layouts[name] = (code, layout, extra)
+
+	def _values(self, eventType, packetSN, packetTJDSoD, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None):
+		try:
+			code, layout, extra = self.layouts[eventType]
+		except KeyError:
+			raise ValueError("Unknown event type '%s'" % eventType)
+
+		if eventDuration is not None and extra != 'eventDuration':
+			raise ValueError("%s packets have no duration" % eventType)
+		if eventDM is not None and extra != 'eventDM':
+			raise ValueError("%s packets have no DM" % eventType)
+
+		eventTJD, eventSoD = getGCNTime(eventTime)
+		values = [code, int(packetSN), 1, packetTJDSoD[1], int(eventSN), eventTJD, eventSoD,
+				int(eventRA * 10000), int(eventDec * 10000)]
+		if extra == 'eventDuration':
+			values.append( int(eventDuration or 0) )
+		elif extra == 'eventDM':
+			values.append( int(eventDM or 0) )
+		values.append( PACKET_TERMINATOR )
+		return layout, values
+
+	def encode(self, eventType, packetSN, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None, packetTime=None):
+		"""
+		Return the packet for an event.  packetTime is the UNIX time stamped
+		on the packet (default now).  Raises ValueError for an unknown event
+		type, a duration or DM given for a type without one, or a value that
+		does not fit in a packet word.
+		"""
+
+		layout, values = self._values(eventType, packetSN, getGCNTime(packetTime), eventSN, eventTime, eventRA, eventDec,
+								eventDuration=eventDuration, eventDM=eventDM)
+		try:
+			return layout.pack(*values)
+		except struct.error as err:
+			raise ValueError("Cannot encode %s packet: %s" % (eventType, str(err)))
+
+	def encodeBatch(self, events, packetTime=None):
+		"""
+		Return the packets for a sequence of events, each a dictionary of
+		encode() arguments, as one string.  All of them get the same
+		packet time.
+		"""
+
+		packetTJDSoD = getGCNTime(packetTime)
+		buf = bytearray(PACKET_SIZE*len(events))
+		for i, event in enumerate(events):
+			layout, values = self._values(packetTJDSoD=packetTJDSoD, **event)
+			try:
+				layout.pack_into(buf, i*PACKET_SIZE, *values)
+			except struct.error as err:
+				raise ValueError("Cannot encode %s packet: %s" % (event['eventType'], str(err)))
+		return str(buf)
@@ -13,25 +13,37 @@ This is the FCN server script that sends out commands.
 import os
 import sys
 import math
+import errno
+import fcntl
 import time
 import getopt
 import signal
 import socket
+import select
 import struct
 import thread
 import logging
+import threading
 import traceback
+import fcn_hosts
+import fcn_trace
+import fcn_packet
+import fcn_connections
+import fcn_metrics
+import fcn_command
+import fcn_watch
 try:
 	import cStringIO as StringIO
 except ImportError:
 	import StringIO
-from collections import deque
+from collections import deque, OrderedDict
 from datetime import datetime, timedelta
+from fcn_packet import notificationEventTypes, getGCNTime
 
 __version__ = '0.1'
 __revision__ = '$Rev: 479 $'
 __date__ = '$LastChangedDate: 2015-08-27 12:45:57 -0600 (Thu, 27 Aug 2015) $'
-__all__ = ['SerialNumber', 'sendNotification', 'notificationEventTypes', 
+__all__ = ['SerialNumber', 'sendNotification', 'sendNotifications', 'notificationEventTypes', 
 		 '__version__', '__revision__', '__date__', '__all__']
 
 
@@ -43,6 +55,12 @@ Options:
 -h, --help             Display this help information
 -f, --hosts-file       Hosts configuration file (Default = hosts.cfg)
 -c, --command-file     Incoming command file (Default = incoming.cmd)
+-s, --socket           Command channel socket (Default = fcn_server.sock)
+-p, --spool-dir        Command spool directory (Default = incoming.spool)
+-t, --trace-log        Append per-stage latency traces of the commands
+                       to this file (Default = no tracing)
+-m, --metrics-port     Serve Prometheus metrics on this localhost port
+                       (Default = no metrics)
 -d, --debug            Run in debugging mode (Default = no)
 """
 	
@@ -57,11 +75,15 @@ def parseConfig(args):
 	# Command line flags - default values
 	config['hosts'] = 'hosts.cfg'
 	config['commands'] = 'incoming.cmd'
+	config['socket'] = fcn_command.DEFAULT_SOCKET
+	config['spool'] = fcn_command.DEFAULT_SPOOL
+	config['trace'] = None
+	config['metrics'] = None
 	config['debug'] = False
 	
 	# Read in and process the command line flags
 	try:
-		opts, arg = getopt.getopt(args, "hf:c:d", ["help", "hosts-file=", "command-file=", "debug"])
+		opts, arg = getopt.getopt(args, "hf:c:s:p:t:m:d", ["help", "hosts-file=", "command-file=", "socket=", "spool-dir=", "trace-log=", "metrics-port=", "debug"])
 	except getopt.GetoptError, err:
 		# Print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -75,6 +97,14 @@ def parseConfig(args):
 			config['hosts'] = value
 		elif opt in ('-c', '--command-file'):
 			config['commands'] = value
+		elif opt in ('-s', '--socket'):
+			config['socket'] = value
+		elif opt in ('-p', '--spool-dir'):
+			config['spool'] = value
+		elif opt in ('-t', '--trace-log'):
+			config['trace'] = value
+		elif opt in ('-m', '--metrics-port'):
+			config['metrics'] = int(value, 10)
 		elif opt in ('-d', '--debug'):
 			config['debug'] = True
 		else:
@@ -115,248 +145,418 @@ def getTime():
 	return (mjd, mpm)
 
 
-def getGCNTime(timestamp=None):
-	"""
-	Convert a UNIX timestamp into a TJD/SoD pair, where the seconds of day 
-	are in centi-seconds.
-	"""
-	
-	# Is there a time?
-	if timestamp is None:
-		timestamp = time.time()
-		
-	# Convert to Julian Day
-	jd = float(timestamp) / 86400.0 + 2440587.5
-	
-	# Calculate TJD
-	tjd = int(math.floor(jd - 2440000.5))
-	
-	# Calculate the second in the day and convert to centiseconds
-	sod = (timestamp % 86400)
-	sod = int(sod*100)
-	
-	return tjd, sod
-
-
 class SerialNumber(object):
 	"""
-	Simple class for a file-backed serial number generator.
+	Packet serial number generator backed by the '.sn' file beside this
+	script, which holds the first number nobody has reserved yet.
+	
+	Numbers are reserved blockSize at a time: the file is advanced past
+	the block (temporary file, fsync, rename) before any number in it is
+	handed out, and the block is then used up from memory.  A crash only
+	skips the rest of the block, so a number is never sent twice, and
+	the file is locked while it is advanced so several servers can share
+	one numbering.
+	
+	A generator holding a block also holds a shared lock on '.sn.lease'
+	(released when its process exits), and reset() only restarts the
+	numbering if no other generator does: it cannot invalidate numbers
+	another server has already reserved.
 	"""
 	
-	def __init__(self):
-		self.filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.sn')
+	def __init__(self, filename=None, blockSize=1000):
+		if filename is None:
+			filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.sn')
+		self.filename = filename
+		self.blockSize = blockSize
 		
-		self.sn = self._getFromFile()
-			
-	def _getFromFile(self):
+		self.sn = None
+		self.limit = None
+		self._lock = threading.Lock()
+		self._leasefd = None
+		
+	def _update(self, advance):
+		"""
+		With the file locked, pass its current value to advance and store
+		the value returned.  Returns the old value, or None if advance
+		returned None and the file was left as it was.
+		"""
+		
+		lockfd = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT, 0644)
 		try:
-			fh = open(self.filename, 'r')
-			sn = int(fh.read(), 10)
+			fcntl.flock(lockfd, fcntl.LOCK_EX)
+			try:
+				fh = open(self.filename, 'r')
+				sn = int(fh.read(), 10)
+				fh.close()
+			except (IOError, ValueError):
+				sn = 1
+				
+			new = advance(sn)
+			if new is None:
+				return None
+			tmpname = '%s.%i.tmp' % (self.filename, os.getpid())
+			fh = open(tmpname, 'w')
+			fh.write( str(new) )
+			fh.flush()
+			os.fsync(fh.fileno())
 			fh.close()
-		except IOError:
-			sn = 1
+			os.rename(tmpname, self.filename)
+			dirfd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+			try:
+				os.fsync(dirfd)
+			finally:
+				os.close(dirfd)
+		finally:
+			os.close(lockfd)
 			
 		return sn
 		
-	def _putToFile(self, sn):
-		status = False
-		try:
-			fh = open(self.filename, 'w')
-			fh.write( str(sn) )
-			fh.close()
-			
-			status = True
-		except IOError:
-			pass
+	def _lease(self):
+		# Called with the file locked, so no reset() can slip in between
+		if self._leasefd is None:
+			fd = os.open(self.filename + '.lease', os.O_RDWR | os.O_CREAT, 0644)
+			fcntl.flock(fd, fcntl.LOCK_SH)
+			self._leasefd = fd
 			
-		return status
+	def _reserve(self, sn):
+		self._lease()
+		return sn + self.blockSize
 		
-	def get(self):
-		out = self.sn
-		self.sn = self.sn + 1
-		self._putToFile(self.sn)
+	def _restart(self, sn):
+		self._lease()
+		try:
+			fcntl.flock(self._leasefd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError as err:
+			if err.errno not in (errno.EAGAIN, errno.EACCES):
+				raise
+			return None
+		fcntl.flock(self._leasefd, fcntl.LOCK_SH)
+		return 1 + self.blockSize
 		
+	def get(self):
+		with self._lock:
+			if self.sn is None or self.sn >= self.limit:
+				try:
+					self.sn = self._update(self._reserve)
+				except (IOError, OSError) as err:
+					# Keep sending; the numbers may be reused after a restart
+					logging.getLogger(__name__).warning("Cannot reserve serial numbers in '%s': %s", self.filename, str(err))
+					if self.sn is None:
+						self.sn = 1
+				self.limit = self.sn + self.blockSize
+			out = self.sn
+			self.sn = self.sn + 1
+			
 		return out
 		
 	def reset(self):
-		oldSN = self.sn*1
+		"""
+		Start the numbering again from 1.  Returns False if the file could
+		not be updated or another generator holds a block, in which case
+		the numbering carries on.
+		"""
 		
-		self.sn = 1
-		status = self._putToFile(self.sn)
-		if not status:
-			self.sn = oldSN
-			return False
-		else:
-			return True
+		with self._lock:
+			try:
+				if self._update(self._restart) is None:
+					logging.getLogger(__name__).info("Not restarting serial numbers in '%s', another server holds a block", self.filename)
+					return False
+			except (IOError, OSError):
+				return False
+			self.sn = 1
+			self.limit = 1 + self.blockSize
+			
+		return True
+
 
+# Seconds each client gets to echo a packet back
+CLIENT_TIMEOUT = 5.0
 
-# Dictionary that maps event types into their numerical counterparts
-notificationEventTypes = {'TEST': 2, 
-					 'IAMALIVE': 3, 
-					 'KILL': 4, 
-					 'VLA_FRB_SESSION': 11, 
-					 'VLA_FRB_TRIGGER': 12, }
+# Packets that may be waiting for their echo on one connection
+ACK_WINDOW = 8
 
 
-def _buildPacket(packetType, packetSN, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None):
+_connections = None
+_metrics = fcn_metrics.REGISTRY
+_encoder = fcn_packet.PacketEncoder()
+
+
+class _Packet(object):
 	"""
-	Build a binary packed representation of a VLA/FRB program event.  The
-	packet formats are based off those used by the GCN and are:
-	
-	Type:   2            3            4             11                  12
-	Loc:    TEST         IMALIVE      KILL          VLA_FRB_SESSION     VLA_FRB_TRIGGER
-	
-	0      pkt_type     pkt_type     pkt_type       pkt_type            pkt_type
-	1      pkt_sernum   pkt_sernum   pkt_sernum     pkt_sernum          pkt_sernum  
-	2      pkt_hopcnt   pkt_hopcnt   pkt_hopcnt     pkt_hopcnt          pkt_hopcnt
-	3      pkt_sod      pkt_sod      pkt_sod        pkt_sod             pkt_sod
-	4      trig_num     -            -              session_num         trig_num
-	5      burst_tjd    burst_tjd    burst_tjd      session_tjd         burst_tjd
-	6      burst_sod    burst_sod    burst_sod      session_sod         burst_sod
-	7      burst_ra     -            -              session_ra          burst_ra
-	8      burst_dec    -            -              session_dec         burst_dec
-	9      spare        spare        -              session_dur         burst_dm
-	10     spare        spare        -              spare               spare
-	11     spare        spare        -              spare               spare
-	12     spare        spare        -              spare               spare
-	13     spare        spare        -              spare               spare
-	14     spare        spare        -              spare               spare
-	15     spare        spare        -              spare               spare
-	16     spare        spare        -              spare               spare
-	17     spare        spare        -              spare               spare
-	18     spare        spare        -              spare               spare
-	19     spare        spare        -              spare               spare
-	20     spare        spare        -              spare               spare
-	21     spare        spare        -              spare               spare
-	22     spare        spare        -              spare               spare
-	23     spare        spare        -              spare               spare
-	24     spare        spare        -              spare               spare
-	25     spare        spare        -              spare               spare
-	26     spare        spare        -              spare               spare
-	27     spare        spare        -              spare               spare
-	28     spare        spare        -              spare               spare
-	29     spare        spare        -              spare               spare
-	30     spare        spare        -              spare               spare
-	31     spare        spare        -              spare               spare
-	32     spare        spare        -              spare               spare
-	33     spare        spare        -              spare               spare
-	34     spare        spare        -              spare               spare
-	35     spare        spare        -              spare               spare
-	36     spare        spare        -              spare               spare
-	37     spare        spare        -              spare               spare
-	38     spare        spare        -              spare               spare
-	39     pkt_term     pkt_term     pkt_term       pkt_term            pkt_term
+	One event packet for one client.
 	"""
 	
-	# Packet time marker
-	tPacket = time.time()
+	def __init__(self, sn, data, wantReply=True, trace=None):
+		self.sn = sn
+		self.data = data
+		self.wantReply = wantReply
+		self.trace = trace
+		self.tSent = 0.0
+		self.done = False
+
+
+class _Channel(object):
+	"""
+	Packets on their way to one client over a connection checked out of
+	a fcn_connections.ConnectionManager.  Up to window packets are sent
+	ahead of their echoes, which are matched back to them by serial
+	number.  A packet not echoed within CLIENT_TIMEOUT seconds fails the
+	connection and with it every packet still in flight or queued.
+	"""
 	
-	# Numeric type
-	try:
-		packetType = notificationEventTypes[packetType]
-	except KeyError:
-		raise ValueError("Unknown event type '%s'" % packetType)
+	def __init__(self, connections, address, window=ACK_WINDOW):
+		self.connections = connections
+		self.address = address
+		self.host = '%s:%i' % address
+		self.window = window
+		self.packets = []
+		self.queue = deque()
+		self.outstanding = OrderedDict()
+		self.sock = None
+		self.state = None
+		self.wbuf = ''
+		self.rbuf = ''
 		
-	# Serial number
-	packetSN = int(packetSN)
-	
-	# Hop count
-	packetHops = 1
-	
-	# Packet seconds of day
-	packetTJD, packetSoD = getGCNTime()
-	
-	# Event information
-	eventSN = int(eventSN)
-	eventTJD, eventSoD = getGCNTime(eventTime)
-	eventRA = int(eventRA * 10000)
-	eventDec = int(eventDec * 10000)
-	if eventDuration is not None:
-		eventDuration = int(eventDuration)
+		# Per-client metrics, looked up once rather than per packet
+		self.skipped = _metrics.counter('fcn_skipped_total', 'Notifications not sent because the client was down', host=self.host)
+		self.sendTime = _metrics.histogram('fcn_send_seconds', 'Time to send a notification and receive its echo', host=self.host)
+		self.failures = _metrics.counter('fcn_send_failures_total', 'Notifications that could not be sent to each client', host=self.host)
+		
+	def add(self, packet):
+		self.packets.append(packet)
+		self.queue.append(packet)
+		
+	@property
+	def deadline(self):
+		return min(packet.tSent for packet in self.outstanding.itervalues()) + CLIENT_TIMEOUT
+		
+	def start(self):
+		"""
+		Check out the connection to the client, if it is up.
+		"""
 		
-	# Pack and return
-	data = [packetType, packetSN, packetHops, packetSoD, eventSN, eventTJD, eventSoD, eventRA, eventDec]
-	if eventDuration is not None:
-		data.append( eventDuration )
-	if eventDM is not None:
-		data.append( eventDM )
-	while len(data) < 39:
-		data.append( 0 )
-	data.append( 10 )
+		self.sock = self.connections.checkout(self.address)
+		if self.sock is None:
+			logging.getLogger(__name__).debug('Client %s is down, skipping it', self.host)
+			self.skipped.inc(len(self.packets))
+			self.state = 'failed'
+			return
+		self.state = 'open'
+		self._fill()
+		
+	def _fill(self):
+		"""
+		Move queued packets into the window, or finish if all are done.
+		"""
+		
+		now = fcn_trace.monotonic()
+		while self.queue and len(self.outstanding) < self.window:
+			packet = self.queue.popleft()
+			packet.tSent = now
+			self.outstanding[packet.sn] = packet
+			self.wbuf += packet.data
+		if not self.outstanding:
+			self.state = 'done'
+			# The client hangs up after a KILL
+			self.connections.release(self.address, self.sock, close=not self.packets[-1].wantReply)
+			self.sock = None
+			
+	def _acked(self, packet):
+		packet.done = True
+		dt = fcn_trace.monotonic() - packet.tSent
+		self.sendTime.observe(dt)
+		if packet.trace is not None:
+			packet.trace.record('send', dt, host=self.host)
+			
+	def fail(self, err):
+		lost = len(self.outstanding) + len(self.queue)
+		logging.getLogger(__name__).warning('Cannot send %i packet(s) to %s @ %i: %s', lost, self.address[0], self.address[1], str(err))
+		self.failures.inc(lost)
+		self.connections.release(self.address, self.sock, error=err)
+		self.sock = None
+		self.state = 'failed'
+		
+	def handleWritable(self):
+		try:
+			nSent = self.sock.send(self.wbuf)
+		except socket.error as err:
+			if err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+				self.fail(err)
+			return
+		self.wbuf = self.wbuf[nSent:]
+		if not self.wbuf:
+			# Nothing comes back for a KILL
+			for sn, packet in self.outstanding.items():
+				if not packet.wantReply:
+					del self.outstanding[sn]
+					self._acked(packet)
+			self._fill()
+			
+	def handleReadable(self):
+		try:
+			data = self.sock.recv(65536)
+		except socket.error as err:
+			if err.errno not in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+				self.fail(err)
+			return
+		if not data:
+			self.fail(socket.error(errno.ECONNRESET, 'connection closed by the client'))
+			return
+		self.rbuf += data
+		while len(self.rbuf) >= fcn_packet.PACKET_SIZE:
+			echo, self.rbuf = self.rbuf[:fcn_packet.PACKET_SIZE], self.rbuf[fcn_packet.PACKET_SIZE:]
+			sn, = _packetSN.unpack_from(echo, 4)
+			packet = self.outstanding.pop(sn, None)
+			if packet is None or echo != packet.data:
+				self.fail(socket.error(errno.EPROTO, 'unexpected echo (serial# %i)' % sn))
+				return
+			self._acked(packet)
+		self._fill()
+
+
+# Serial number word of a packet
+_packetSN = struct.Struct('>l')
+
+
+def _deliver(channels):
+	"""
+	Run a list of _Channel instances to completion concurrently: all
+	clients are sent to at the same time and each has a window of packets
+	in flight, so a burst of events costs about one round trip to the
+	slowest client.
+	"""
 	
-	packet = struct.pack('>40l',*data)
-	return packet
+	for channel in channels:
+		channel.start()
+		
+	active = [channel for channel in channels if channel.state == 'open']
+	while active:
+		now = fcn_trace.monotonic()
+		for channel in active:
+			if channel.deadline <= now:
+				channel.fail(socket.timeout('timed out'))
+		active = [channel for channel in active if channel.state == 'open']
+		if not active:
+			break
+			
+		readers = dict((channel.sock, channel) for channel in active if channel.outstanding)
+		writers = dict((channel.sock, channel) for channel in active if channel.wbuf)
+		timeout = max(0.0, min(channel.deadline for channel in active) - now)
+		try:
+			readable, writable, errored = select.select(list(readers), list(writers), [], timeout)
+		except select.error as err:
+			if err.args[0] == errno.EINTR:
+				continue
+			raise
+		for sock in writable:
+			if writers[sock].state == 'open':
+				writers[sock].handleWritable()
+		for sock in readable:
+			if readers[sock].state == 'open':
+				readers[sock].handleReadable()
+		active = [channel for channel in active if channel.state == 'open']
 
 
-_socketState = {}
-def sendNotification(dests, eventType, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None, snGenerator=SerialNumber()):
+def sendNotifications(events, snGenerator=SerialNumber(), connections=None, window=ACK_WINDOW):
 	"""
-	Send an event to one or more clients via TCP.
+	Send a burst of events, each a dictionary of sendNotification()
+	arguments (dests, eventType, eventSN, ...).  Every event gets its own
+	packet, built once for all of its clients; the packets for a client
+	are pipelined over its connection with up to window of them awaiting
+	their echoes.  Returns the number of clients each event reached.
 	"""
 	
-	# Setup logging
-	logger = logging.getLogger(__name__)
+	global _connections
 	
-	# What are we dealing with here?
-	try:
-		len(dests)
-	except TypeError:
-		dests = [dests,]
+	if connections is None:
+		if _connections is None:
+			_connections = fcn_connections.ConnectionManager().start()
+		connections = _connections
 		
-	# Generate the serial number
-	packetSN = snGenerator.get()
-	
-	# Loop through the clients
-	hostsReached = 0
-	for ip,port in dests:
-		## Get the port
-		try:
-			### Already open?
-			socketOut = _socketState[(ip,port)]
-			
-		except KeyError:
-			### Try to open the port
-			try:
-				socketOut = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #!!!
-				socketOut.settimeout(5)
-				socketOut.connect((ip, port))
-				
-				_socketState[(ip,port)] = socketOut
-				
-			except socket.error as err:
-				logger.warning('Cannot connect to %s @ %i: %s', ip, port, str(err))
-				continue
-				
-		## Build the binary packet
+	# Clients not seen before get their first connection attempt now
+	new = []
+	for event in events:
+		dests = event['dests']
 		try:
-			data = _buildPacket(eventType, packetSN, eventSN, eventTime, eventRA, eventDec, eventDuration=eventDuration, eventDM=eventDM)
-		except ValueError:
-			continue
+			len(dests)
+		except TypeError:
+			event['dests'] = dests = [dests,]
+		new.extend(address for address in dests if address not in new and not connections.known(address))
+	if new:
+		for address in new:
+			connections.add(address)
+		connections.waitReady(new, fcn_connections.CONNECT_TIMEOUT + 1.0)
 		
-		## Send and receive
+	# A KILL ends the connections, so it goes out on its own after any
+	# events before it
+	hostsReached = []
+	segment = []
+	for event in events:
+		if event['eventType'] == 'KILL':
+			if segment:
+				hostsReached.extend(_sendSegment(segment, snGenerator, connections, window))
+			hostsReached.extend(_sendSegment([event,], snGenerator, connections, window))
+			snGenerator.reset()
+			segment = []
+		else:
+			segment.append(event)
+	if segment:
+		hostsReached.extend(_sendSegment(segment, snGenerator, connections, window))
+		
+	return hostsReached
+
+
+def _sendSegment(events, snGenerator, connections, window):
+	channels = OrderedDict()
+	packets = []
+	for event in events:
+		event = dict(event)
+		dests = event.pop('dests')
+		trace = event.pop('trace', None)
+		
+		## Build the packet, once for all the clients
+		packetSN = snGenerator.get()
+		_metrics.counter('fcn_notifications_total', 'Notifications sent, by event type', type=event['eventType']).inc()
 		try:
-			socketOut.send(data)
-			if eventType != 'KILL':
-				reply = socketOut.recv(len(data))
-				
-			hostsReached += 1
-			
-		except socket.error as err:
-			logger.warning('Cannot send to %s @ %i: %s', ip, port, str(err))
-			
-			socketOut.close()
-			del _socketState[(ip,port)]
-			
-		## Cleanup for 'Kill'
-		if eventType == 'KILL':
-			socketOut.close()
-			del _socketState[(ip,port)]
+			data = _encoder.encode(packetSN=packetSN, **event)
+		except ValueError as err:
+			logging.getLogger(__name__).error('%s', str(err))
+			packets.append([])
+			continue
+		if trace is not None:
+			trace.record('build')
 			
-	# Reset the serial number if the command is 'Kill'
-	if eventType == 'KILL':
-		snGenerator.reset()
+		eventPackets = []
+		for address in dests:
+			if address not in channels:
+				channels[address] = _Channel(connections, address, window=window)
+			if packetSN not in [packet.sn for packet in channels[address].packets]:
+				packet = _Packet(packetSN, data, wantReply=(event['eventType'] != 'KILL'), trace=trace)
+				channels[address].add(packet)
+				eventPackets.append(packet)
+		packets.append(eventPackets)
 		
-	return hostsReached
+	## Send them out
+	_deliver(channels.values())
+	return [len([packet for packet in eventPackets if packet.done]) for eventPackets in packets]
+
+
+def sendNotification(dests, eventType, eventSN, eventTime, eventRA, eventDec, eventDuration=None, eventDM=None, snGenerator=SerialNumber(), trace=None, connections=None):
+	"""
+	Send an event to one or more clients via TCP.  The clients are sent
+	the same packet concurrently over the connections kept by connections
+	(a fcn_connections.ConnectionManager, by default one shared by all
+	calls), and clients that are down are skipped.  Each client gets
+	CLIENT_TIMEOUT seconds to echo the packet back, so one slow client
+	does not hold up the others.  If trace (a fcn_trace.Trace) is given,
+	the build time and the send/ack time for each client are recorded in
+	it.  Sends and failures are counted per client in
+	fcn_metrics.REGISTRY.  Returns the number of clients reached.
+	"""
+	
+	event = {'dests': dests, 'eventType': eventType, 'eventSN': eventSN, 'eventTime': eventTime, 'eventRA': eventRA,
+		    'eventDec': eventDec, 'eventDuration': eventDuration, 'eventDM': eventDM, 'trace': trace}
+	return sendNotifications([event,], snGenerator=snGenerator, connections=connections)[0]
 
 
 def main(args):
@@ -381,6 +581,8 @@ def main(args):
 		logger.setLevel(logging.DEBUG)
 	else:
 		logger.setLevel(logging.INFO)
+	for module in (fcn_hosts, fcn_command, fcn_watch, fcn_connections):
+		logging.getLogger(module.__name__).addHandler(logHandler)
 		
 	# Get current MJD and MPM
 	mjd, mpm = getTime()
@@ -409,80 +611,143 @@ def main(args):
 		sys.exit()
 		
 
-	# Setup the list of hosts to send notifications to
-	hosts = []
-	with open(config['hosts'], 'r') as fh:
-	        for line in fh:
-		        if line[0] == '#':
-			        continue
-		        if len(line) < 3:
-			        continue
-		        try:
-			        ip, port = line.split(None, 1)
-			        port = int(port, 10)
-			        hosts.append( (ip,port) )
-		        except Exception as e:
-			        logger.warning('WARNING: Cannot parse line \'%s\': %s', line.rstrip(), str(e))
+	# Setup the list of hosts to send notifications to and which events
+	# each of them wants
+	routing = fcn_hosts.RoutingTable(fcn_hosts.readHosts(config['hosts']), notificationEventTypes)
+	hosts = routing.hosts
 
 	logger.info('Loaded %i hosts from \'%s\'', len(hosts), os.path.basename(config['hosts']))
+	for eventType in sorted(notificationEventTypes):
+		logger.debug('%i host(s) subscribed to %s', routing.subscribers(eventType), eventType)
 	
 	# Report on the incoming command filename
 	logger.info('Using \'%s\' for incoming commands', os.path.basename(config['commands']))
 	
+	# Open the command channel
+	commandServer = fcn_command.CommandServer(config['socket']).start()
+	logger.info('Listening for commands on \'%s\'', config['socket'])
+	commandSpool = fcn_command.CommandSpool(config['spool'])
+	logger.info('Using \'%s\' for spooled commands', config['spool'])
+	
+	# Watch for new command files
+	watcher = fcn_watch.CommandWatcher([config['spool'], os.path.dirname(os.path.abspath(config['commands']))])
+	if watcher.active:
+		logger.info('Watching for command files with inotify')
+	else:
+		logger.info('inotify is not available, checking for command files every %.1f s', fcn_watch.POLL_INTERVAL)
+	
+	# Open the trace log
+	tracer = None
+	if config['trace']:
+		tracer = fcn_trace.Tracer(config['trace'], 'fcn_server')
+		logger.info('Writing command traces to \'%s\'', config['trace'])
+		
 	# Setup the packet serial number generator
 	snGenerator = SerialNumber()
 	
+	# Connect to the clients
+	connections = fcn_connections.ConnectionManager(hosts).start()
+	logger.info('Connected to %i of %i hosts', connections.waitReady(timeout=fcn_connections.CONNECT_TIMEOUT + 1.0), len(hosts))
+	
+	# Serve the metrics
+	metrics = None
+	if config['metrics']:
+		registry = fcn_metrics.REGISTRY
+		registry.counter('fcn_commands_total', 'Commands accepted from the dispatcher', func=lambda: commandServer.count)
+		registry.counter('fcn_commands_rejected_total', 'Malformed commands rejected', func=lambda: commandServer.rejected)
+		registry.gauge('fcn_commands_pending', 'Commands waiting to be sent', func=lambda: len(commandServer.pending))
+		registry.gauge('fcn_hosts', 'Configured client hosts', func=lambda: len(hosts))
+		registry.gauge('fcn_connections_open', 'Open client connections', func=connections.up)
+		metrics = fcn_metrics.MetricsServer(registry, port=config['metrics']).start()
+		logger.info('Serving metrics at http://%s:%i/metrics', *metrics.address)
+	
 	# Loop and process the MCS data packets as they come in - exit if ctrl-c is 
 	# received
 	logger.info('Ready to communicate')
 	t0 = time.time() - 120.0
+	checkFiles = True
 	try:
 		while True:
 			try:
-				## Is there a command file to read from?
-				try:
-					fh = open(config['commands'], 'r')
-					data = fh.read()
-					fh.close()
-					# Remove the commands file
-					os.unlink(config['commands'])
-				except IOError:
-					data = None
-					pass
+				## Sleep until a command arrives or the next 'IAMALIVE' is due
+				timeout = max(0.0, t0 + 60.0 - time.time())
+				if checkFiles or not watcher.active:
+					timeout = min(timeout, fcn_watch.POLL_INTERVAL)
+				if watcher.active:
+					if commandServer.poll(timeout, extra=[watcher,]):
+						watcher.clear()
+						checkFiles = True
+				else:
+					commandServer.poll(timeout)
+					checkFiles = True
+					
+				## Are there command files to read?
+				data = None
+				spooled = []
+				if checkFiles:
+					### The legacy command file
+					try:
+						fh = open(config['commands'], 'r')
+						data = fh.read()
+						fh.close()
+						# Remove the commands file
+						os.unlink(config['commands'])
+					except IOError:
+						pass
+						
+					### The spool directory, oldest first
+					spooled = commandSpool.drain()
+					checkFiles = False
 					
-				## Is there a command to send?
 				if data is not None:
-					### Parse out the various fields
-					fields = data.split()
-					eventType = fields[0].upper()
-					eventSN = int(fields[1], 10)
-					eventTime = float(fields[2])
-					eventRA = float(fields[3])
-					eventDec = float(fields[4])
-					if eventType.upper() == 'VLA_FRB_SESSION':
-						eventDuration = float(fields[5])
-					else:
-						eventDuration = None
-					if eventType.upper() == 'VLA_FRB_TRIGGER':
-						eventDM = float(fields[5])
-					else:
-						eventDM = None
-					logger.info("Found new %s command in \'%s\'", eventType, os.path.basename(config['commands']))
+					logger.info("Found new command in \'%s\'", os.path.basename(config['commands']))
+					commandServer.submit(data)
+					
+				if spooled:
+					logger.info("Found %i new command(s) in \'%s\'", len(spooled), config['spool'])
+				for line in spooled:
+					commandServer.submit(line)
 					
-					### Send it along!H
-					hostsReached = sendNotification(hosts, eventType, eventSN, eventTime, eventRA, eventDec, eventDuration=eventDuration, eventDM=eventDM, snGenerator=snGenerator)
-					logger.debug("Sent '%s' to %i hosts", eventType, hostsReached)
+				## Are there commands to send?  They go out together.
+				events = []
+				command = commandServer.next()
+				while command is not None:
+					logger.info("Sending %s command %i", command['eventType'], command['eventSN'])
+					project = command.pop('eventProject')
+					traceID = command.pop('eventTrace')
+					queued = command.pop('eventQueued')
+					trace = None
+					if tracer is not None and traceID:
+						trace = tracer.resume(traceID)
+						trace.record('server_queue', fcn_trace.monotonic() - queued)
+					try:
+						command['dests'] = routing.route(eventProject=project, **command)
+					except ValueError as err:
+						# Skip just this command, not the others queued with it
+						logger.error("Cannot route %s command %i: %s", command['eventType'], command['eventSN'], str(err))
+						command = commandServer.next()
+						continue
+					command['trace'] = trace
+					if trace is not None:
+						trace.record('route', hosts=len(command['dests']))
+					events.append(command)
+					command = commandServer.next()
 					
+				if events:
+					tNotify = fcn_trace.monotonic()
+					for command, hostsReached in zip(events, sendNotifications(events, snGenerator=snGenerator, connections=connections)):
+						if command['trace'] is not None:
+							command['trace'].record('notify', fcn_trace.monotonic() - tNotify, hosts=hostsReached)
+						logger.debug("Sent '%s' to %i of %i hosts", command['eventType'], hostsReached, len(hosts))
+						
 				## Is it time to send an 'IAMALIVE' packet?
 				t1 = time.time()
 				if t1-t0 >= 60.0:
 					t0 = t1
 					
-					hostsReached = sendNotification(hosts, 'IAMALIVE', 0, time.time(), 0, 0, snGenerator=snGenerator)
+					hostsReached = sendNotification(hosts, 'IAMALIVE', 0, time.time(), 0, 0, snGenerator=snGenerator, connections=connections)
 					logger.debug("Sent 'Iamalive' to %i hosts", hostsReached)
 					
-				time.sleep(0.1)
-				
 			except Exception, e:
 				exc_type, exc_value, exc_traceback = sys.exc_info()
 				logger.error("fcn_server.py failed with: %s at line %i", str(e), traceback.tb_lineno(exc_traceback))
@@ -499,7 +764,14 @@ def main(args):
 	except KeyboardInterrupt:
 		logger.info('Exiting on ctrl-c')
 		
-		hostsReached = sendNotification(hosts, 'KILL', 0, time.time(), 0, 0, snGenerator=snGenerator)
+		hostsReached = sendNotification(hosts, 'KILL', 0, time.time(), 0, 0, snGenerator=snGenerator, connections=connections)
+	connections.close()
+	commandServer.close()
+	watcher.close()
+	if tracer is not None:
+		tracer.close()
+	if metrics is not None:
+		metrics.close()
 	
 	# If we've made it this far, we have finished so shutdown DP and close the 
 	# communications channels
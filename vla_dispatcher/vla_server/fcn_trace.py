@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end latency tracing of dispatches, from the obsdoc datagram
+arriving at dispatcher.py to the last client acknowledging the
+notification sent by fcn_server.py.
+
+dispatcher.py starts a Trace for every obsdoc it receives and records
+each stage it passes through: receive, admit (sequencing and
+filtering, or hold if it was held back for reordering), queue
+(waiting for a worker), parse, select (the controller's decision)
+and handoff (the command reaching fcn_server).  The trace ID travels
+with the command as a trailing trace=ID field, and fcn_server.py
+carries on with server_queue, route, build, send per client and
+notify.
+
+Every stage is one JSON line in the trace log:
+
+  {"trace": ID, "proc": "dispatcher", "stage": "parse", "t": ..., "dt": ..., "wall": ...}
+
+t is CLOCK_MONOTONIC at the end of the stage and dt the time the stage
+took, both in seconds, so the records of the two processes line up
+when they run on the same host; wall is the UNIX time, for matching
+traces against the logs.  Run this script on one or more trace logs
+to get p50/p99 per stage:
+
+  fcn_trace.py dispatcher.trace fcn_server.trace
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import threading
+
+__all__ = ['monotonic', 'current', 'Trace', 'Tracer', 'readTraces', 'summarize']
+
+
+def _makeMonotonic():
+	"""
+	Return a CLOCK_MONOTONIC clock function (Python 2.7 has no
+	time.monotonic), falling back to time.time.  This is the one clock
+	of the dispatcher and the server; eventloop.monotonic is the same
+	function.  Each call gets its own timespec, as clock_gettime runs
+	without the GIL.
+	"""
+
+	try:
+		import ctypes
+		import ctypes.util
+
+		class timespec(ctypes.Structure):
+			_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+		librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+		clock_gettime = librt.clock_gettime
+		clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+		CLOCK_MONOTONIC = 1
+
+		def monotonic():
+			ts = timespec()
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+				return time.time()
+			return ts.tv_sec + ts.tv_nsec * 1e-9
+		monotonic()
+		return monotonic
+	except (OSError, AttributeError, ImportError):
+		return time.time
+
+monotonic = _makeMonotonic()
+
+
+_local = threading.local()
+
+
+def current():
+	"""
+	Return the Trace activated in this thread, or None.
+	"""
+
+	return getattr(_local, 'trace', None)
+
+
+class Trace(object):
+	"""
+	One traced document or command.  Stages are recorded as they end.
+	"""
+
+	def __init__(self, tracer, traceID):
+		self.tracer = tracer
+		self.id = traceID
+		self.tLast = monotonic()
+
+	def record(self, stage, dt=None, **fields):
+		"""
+		Record a stage that ended now.  dt defaults to the time since the
+		previous record of this trace.
+		"""
+
+		t = monotonic()
+		if dt is None:
+			dt = t - self.tLast
+		self.tLast = t
+		self.tracer.write(self.id, stage, t, dt, fields)
+
+	def activate(self):
+		"""
+		Make this the current() trace of the calling thread.
+		"""
+
+		_local.trace = self
+
+	def deactivate(self):
+		if current() is self:
+			_local.trace = None
+
+
+class Tracer(object):
+	"""
+	Writer for the trace log of one process.
+	"""
+
+	def __init__(self, filename, process):
+		self.filename = filename
+		self.process = process
+		self._prefix = '%x-%i-' % (int(time.time()), os.getpid())
+		self._count = 0
+		self._lock = threading.Lock()
+		self._fh = open(filename, 'a', 1)
+
+	def start(self, received=None, **fields):
+		"""
+		Start a new trace and record its 'receive' stage, at received (a
+		monotonic time) if it was earlier than now.
+		"""
+
+		with self._lock:
+			self._count += 1
+			traceID = '%s%i' % (self._prefix, self._count)
+		trace = Trace(self, traceID)
+		if received is None:
+			trace.record('receive', 0.0, **fields)
+		else:
+			trace.tLast = received
+			self.write(traceID, 'receive', received, 0.0, fields)
+		return trace
+
+	def resume(self, traceID):
+		"""
+		Carry on with a trace started by another process.
+		"""
+
+		return Trace(self, traceID)
+
+	def write(self, traceID, stage, t, dt, fields):
+		record = {'trace': traceID, 'proc': self.process, 'stage': stage, 't': t, 'dt': dt, 'wall': time.time()}
+		record.update(fields)
+		line = json.dumps(record) + '\n'
+		with self._lock:
+			if self._fh is not None:
+				self._fh.write(line)
+
+	def close(self):
+		with self._lock:
+			if self._fh is not None:
+				self._fh.close()
+				self._fh = None
+
+
+def readTraces(filenames):
+	"""
+	Return a dictionary of trace ID -> records (ordered by t) from trace
+	logs.  Unreadable lines are skipped.
+	"""
+
+	traces = {}
+	for filename in filenames:
+		fh = open(filename, 'r')
+		for line in fh:
+			try:
+				record = json.loads(line)
+				traces.setdefault(record['trace'], []).append(record)
+			except (ValueError, KeyError):
+				continue
+		fh.close()
+	for records in traces.itervalues():
+		records.sort(key=lambda record: record['t'])
+	return traces
+
+
+def _percentile(samples, pct):
+	idx = int(round(pct / 100.0 * (len(samples) - 1)))
+	return samples[idx]
+
+
+def summarize(traces):
+	"""
+	Return a list of (stage, n, p50, p99, max) tuples, in seconds.  Client
+	stages are also broken down per host as stage@host.  The 'end_to_end'
+	stage runs from receipt to the last record of every trace that
+	reached fcn_server.
+	"""
+
+	samples = {}
+	order = []
+	def add(stage, dt):
+		if stage not in samples:
+			samples[stage] = []
+			order.append(stage)
+		samples[stage].append(dt)
+
+	for records in traces.itervalues():
+		for record in records:
+			add(record['stage'], record['dt'])
+			if 'host' in record:
+				add('%s@%s' % (record['stage'], record['host']), record['dt'])
+		if records[0]['stage'] == 'receive' and any(record['stage'] == 'notify' for record in records):
+			add('end_to_end', records[-1]['t'] - records[0]['t'])
+
+	summary = []
+	for stage in order:
+		values = sorted(samples[stage])
+		summary.append( (stage, len(values), _percentile(values, 50), _percentile(values, 99), values[-1]) )
+	return summary
+
+
+def usage(exitCode=None):
+	print """fcn_trace.py - Per-stage latency summary of dispatcher/fcn_server trace logs
+
+Usage: fcn_trace.py [OPTIONS] TRACE_LOG [TRACE_LOG ...]
+
+Options:
+-h, --help             Display this help information
+"""
+
+	if exitCode is not None:
+		sys.exit(exitCode)
+	else:
+		return True
+
+
+def main(args):
+	try:
+		opts, arg = getopt.getopt(args, "h", ["help",])
+	except getopt.GetoptError, err:
+		print str(err)
+		usage(exitCode=2)
+	for opt, value in opts:
+		if opt in ('-h', '--help'):
+			usage(exitCode=0)
+	if not arg:
+		usage(exitCode=2)
+
+	traces = readTraces(arg)
+	print "%i trace(s)" % len(traces)
+	print "%-32s %8s %10s %10s %10s" % ('stage', 'n', 'p50 [ms]', 'p99 [ms]', 'max [ms]')
+	for stage, n, p50, p99, tMax in summarize(traces):
+		print "%-32s %8i %10.3f %10.3f %10.3f" % (stage, n, 1e3*p50, 1e3*p99, 1e3*tMax)
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
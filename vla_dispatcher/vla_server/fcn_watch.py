@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Wake-up source for fcn_server.py when a command file lands.
+
+CommandWatcher puts an inotify watch (through ctypes) on the spool
+directory and on the directory holding the legacy command file, and can
+be passed to select() alongside the command socket.  Any file closed
+after writing or renamed into those directories makes it readable; the
+server then drains the spool.  Where inotify is not available (not
+Linux, or no libc found) the watcher is inactive and the server falls
+back to checking every POLL_INTERVAL seconds.
+"""
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import logging
+
+__all__ = ['CommandWatcher', 'POLL_INTERVAL']
+
+
+# Seconds between spool checks without inotify
+POLL_INTERVAL = 0.1
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+
+def _loadLibc():
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		libc.inotify_init1
+		libc.inotify_add_watch
+	except (OSError, AttributeError):
+		return None
+	libc.inotify_init1.argtypes = [ctypes.c_int,]
+	libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+	return libc
+
+
+class CommandWatcher(object):
+	"""
+	inotify watch on a set of directories.  active is False if inotify
+	could not be set up, in which case fileno() must not be used.
+	"""
+
+	def __init__(self, directories, mask=IN_CLOSE_WRITE|IN_MOVED_TO):
+		self.directories = directories
+		self.fd = None
+
+		libc = _loadLibc()
+		if libc is None:
+			return
+		fd = libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+		if fd < 0:
+			logging.getLogger(__name__).warning('inotify_init1 failed: %s', os.strerror(ctypes.get_errno()))
+			return
+		for directory in directories:
+			if libc.inotify_add_watch(fd, directory, mask) < 0:
+				logging.getLogger(__name__).warning('Cannot watch \'%s\': %s', directory, os.strerror(ctypes.get_errno()))
+				os.close(fd)
+				return
+		self.fd = fd
+
+	@property
+	def active(self):
+		return self.fd is not None
+
+	def fileno(self):
+		return self.fd
+
+	def clear(self):
+		"""
+		Discard the pending events.  Call before looking at the files so
+		nothing that lands afterwards is missed.
+		"""
+
+		while True:
+			try:
+				if not os.read(self.fd, 65536):
+					return
+			except OSError as err:
+				if err.errno in (errno.EAGAIN, errno.EINTR):
+					return
+				raise
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
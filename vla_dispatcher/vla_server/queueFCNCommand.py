@@ -10,6 +10,7 @@ import os
 import sys
 import time
 import getopt
+import fcn_command
 
 
 def usage(exitCode=None):
@@ -27,8 +28,14 @@ EventDM: Required for VLA_FRB_TRIGGER, event DM in pc/cm^2
 
 Options:
 -h, --help             Display this help information
--c, --command-file     Incoming command file to write to (Default = 
-                       incoming.cmd)
+-s, --socket           fcn_server command socket (Default = fcn_server.sock)
+-p, --spool-dir        Command spool directory to use if the server
+                       socket is not there (Default = incoming.spool)
+-c, --command-file     Write to this legacy incoming command file
+                       instead of the spool directory if the server
+                       socket is not there
+-j, --project          Project ID of the event, for routing to the
+                       clients subscribed to it (Default = none)
 """
 	
 	if exitCode is not None:
@@ -40,12 +47,15 @@ Options:
 def parseConfig(args):
 	config = {}
 	# Command line flags - default values
-	config['commands'] = 'incoming.cmd'
+	config['spool'] = fcn_command.DEFAULT_SPOOL
+	config['socket'] = fcn_command.DEFAULT_SOCKET
+	config['project'] = None
+	config['commands'] = None
 	config['args'] = []
 	
 	# Read in and process the command line flags
 	try:
-		opts, arg = getopt.getopt(args, "hc:", ["help", "command-file=",])
+		opts, arg = getopt.getopt(args, "hp:s:j:c:", ["help", "spool-dir=", "socket=", "project=", "command-file="])
 	except getopt.GetoptError, err:
 		# Print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -55,13 +65,19 @@ def parseConfig(args):
 	for opt, value in opts:
 		if opt in ('-h', '--help'):
 			usage(exitCode=0)
+		elif opt in ('-p', '--spool-dir'):
+			config['spool'] = value
+		elif opt in ('-s', '--socket'):
+			config['socket'] = value
+		elif opt in ('-j', '--project'):
+			config['project'] = value
 		elif opt in ('-c', '--command-file'):
 			config['commands'] = value
 		else:
 			assert False
 			
 	# Add in the arguments
-	config['args'] = args
+	config['args'] = arg
 	
 	# Return configuration
 	return config
@@ -76,7 +92,7 @@ def main(args):
 	## Type
 	eventType = fields[0]
 	if eventType not in ('TEST', 'VLA_FRB_SESSION', 'VLA_FRB_TRIGGER'):
-		raise RuntimeErrror("Unsupported FCN event type '%s'", eventType)
+		raise RuntimeError("Unsupported FCN event type '%s'" % eventType)
 	## ID number
 	eventSN = int(fields[1], 10)
 	## Time
@@ -96,22 +112,42 @@ def main(args):
 	else:
 		eventDM = None
 		
-	# Get ready to send...
-	print "Waiting for command queue to clear...",
-	while os.path.exists(config['commands']):
-		time.sleep(1)
-	print "Done"
-	
-	# Go!
-	print "Queueing...", 
-	fh = open(config['commands'], 'w')
-	fh.write("%s %i %f %f %f" % (eventType, eventSN, eventTime, eventRA, eventDec))
-	if eventType == 'VLA_FRB_SESSION':
-		fh.write("  %s" % eventDur)
-	if eventType == 'VLA_FRB_TRIGGER':
-		fh.write("  %s" % eventDM)
-	fh.close()
-	print "Done, wrote %i B" % os.path.getsize(config['commands'])
+	# Send it over the command channel if fcn_server is listening
+	line = fcn_command.formatCommand(eventType, eventSN, eventTime, eventRA, eventDec, eventDuration=eventDur, eventDM=eventDM, project=config['project'])
+	client = fcn_command.CommandClient(config['socket'])
+	if client.available():
+		print "Sending...",
+		try:
+			number = client.send(line)
+			print "Done, queued as command %i" % number
+			return
+		except fcn_command.CommandUnknown as err:
+			# It may already be queued; spooling it too could send it twice
+			print "Failed: %s" % str(err)
+			sys.exit(1)
+		except fcn_command.CommandError as err:
+			print "Failed: %s" % str(err)
+		finally:
+			client.close()
+			
+	# Otherwise leave it for the server to pick up, in the legacy command
+	# file if one was given
+	if config['commands'] is not None:
+		print "Waiting for command queue to clear...",
+		while os.path.exists(config['commands']):
+			time.sleep(1)
+		print "Done"
+		
+		print "Queueing...",
+		fh = open(config['commands'], 'w')
+		fh.write(line)
+		fh.close()
+		print "Done, wrote %i B" % os.path.getsize(config['commands'])
+		return
+		
+	print "Spooling...",
+	name = fcn_command.CommandSpool(config['spool']).put(line)
+	print "Done, wrote %s" % name
 
 
 if __name__ == "__main__":